@@ -0,0 +1,272 @@
+#!/usr/bin/env python
+
+#    Lines - a python plotting program
+#    Copyright (C) 2015 Stef Smeets
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License along
+#    with this program; if not, write to the Free Software Foundation, Inc.,
+#    51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""Headless batch processing of powder patterns (lines_batch).
+
+Runs the data transforms of lines (binning, smoothing, wavelength conversion,
+background/capillary subtraction) without importing matplotlib, for use in
+scripts and cron jobs."""
+
+import time
+t_start = time.time()
+
+import sys
+import os
+import argparse
+import multiprocessing as mp
+
+import cache
+
+from core import Data, read_data, read_patterns, f_bg_correct_out, parse_wl
+
+__version__ = '2018-10-03'
+
+t_startup = time.time() - t_start
+
+
+def process(fn, binsize=None, bin_mode='mean', smooth=None, convert=None,
+            capillary=None, bg_xy=None, kind='linear', offset=0, wl=1.0):
+    """Reads fn and applies the requested transforms in order: wavelength conversion
+    (convert = (wl_in, wl_out)), binning, smoothing.
+
+    If a capillary pattern (Data) or background (bg_xy, 2d array with x,y) is given, it
+    is subtracted from the result and written by f_bg_correct_out. Otherwise the
+    result is written to a file named after the steps applied.
+
+    returns a list of processed Data objects, one for every scan in fn"""
+
+    ret = []
+
+    for d in read_patterns(fn, wl=wl):
+        processed = False
+
+        if convert:
+            wl_in, wl_out = convert
+            d = d.convert_wavelength(wl_in, wl_out)
+            root, ext = os.path.splitext(d.filename)
+            d.filename = root + '_{:.2f}'.format(wl_out) + ext
+            processed = True
+
+        if binsize:
+            d = d.bin(binsize, mode=bin_mode)
+            processed = True
+
+        if smooth:
+            d = d.smooth(smooth)
+            processed = True
+
+        if capillary is not None:
+            print ' >> Removing contribution of {} from {}'.format(capillary.filename, d.filename)
+            f_bg_correct_out(d, capillary.xy, kind=kind,
+                             offset=offset, suffix_corr='_rem_cap')
+        elif bg_xy is not None:
+            f_bg_correct_out(d, bg_xy, kind=kind, offset=offset)
+        elif processed:
+            d.print_pattern()
+        else:
+            print ' >> Nothing to do for {}'.format(d.filename)
+
+        ret.append(d)
+
+    return ret
+
+
+def _init_worker(plot_range, use_cache):
+    """Copies the global settings to the worker processes (needed on Windows)"""
+    Data.plot_range = plot_range
+    cache.enabled = use_cache
+
+
+def _call(task):
+    """Returns (fn, func(fn, **kwargs), error). Errors are returned as string instead of
+    raised, so that one bad file does not stop the other files from being processed"""
+    func, fn, kwargs = task
+    try:
+        return fn, func(fn, **kwargs), None
+    except (Exception, SystemExit), e:  # read_file calls exit() on IOError
+        return fn, None, '{}: {}'.format(type(e).__name__, e)
+
+
+def imap_files(func, fns, jobs=1, **kwargs):
+    """Calls func(fn, **kwargs) for every fn in fns, using a pool of jobs processes if
+    jobs > 1 (jobs=0 -> number of cpus). func must be a module level function.
+
+    yields (fn, result, error) in the order of fns as soon as they are available.
+    error is None on success, otherwise result is None"""
+    tasks = ((func, fn, kwargs) for fn in fns)
+
+    if jobs == 1:
+        for task in tasks:
+            yield _call(task)
+        return
+
+    pool = mp.Pool(jobs or None, initializer=_init_worker,
+                   initargs=(Data.plot_range, cache.enabled))
+    try:
+        for result in pool.imap(_call, tasks):
+            yield result
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def run(fns, binsize=None, bin_mode='mean', smooth=None, convert=None,
+        capillary=None, bg_input=None, kind='linear', offset=0, wl=1.0, jobs=1):
+    """Library entry point: processes all files in fns (see process()) using jobs
+    processes. Files that fail are reported and skipped. capillary and bg_input are
+    file names
+
+    returns the list of processed Data objects, and the list of files that failed"""
+
+    if capillary:
+        capillary = read_data(capillary).smooth(
+            window='hanning', window_len=101)
+
+    if bg_input:
+        bg_xy = read_data(bg_input).xy
+    else:
+        bg_xy = None
+
+    ret = []
+    failed = []
+
+    for fn, patterns, error in imap_files(process, fns, jobs=jobs,
+                                   binsize=binsize, bin_mode=bin_mode, smooth=smooth, convert=convert,
+                                   capillary=capillary, bg_xy=bg_xy, kind=kind, offset=offset, wl=wl):
+        if error:
+            print ' >> Failed: {} ({})'.format(fn, error)
+            failed.append(fn)
+        else:
+            ret.extend(patterns)
+
+    if failed:
+        print
+        print '{} of {} file(s) failed:'.format(len(failed), len(fns))
+        for fn in failed:
+            print '   ', fn
+
+    return ret, failed
+
+
+def main():
+    description = """Process powder patterns without plotting. Does not import matplotlib,
+so no display is needed. Steps are applied in the order: --convert, --bin, --smooth,
+then --capillary or --bgin subtraction.
+"""
+
+    epilog = 'Updated: {}'.format(__version__)
+
+    parser = argparse.ArgumentParser(description=description,
+                                     epilog=epilog,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+
+    parser.add_argument("args",
+                        type=str, metavar="FILE", nargs='+',
+                        help="Paths to input files.")
+
+    parser.add_argument("--bin", metavar='binsize',
+                        action="store", type=float, dest="bin",
+                        help="Bin the patterns with the given bin size.")
+
+    parser.add_argument("--binmode", metavar='mode',
+                        action="store", type=str, dest="bin_mode", choices=('mean', 'sum', 'weighted'),
+                        help="How intensities are combined with --bin: 'mean' (default), 'sum' or 'weighted' (1/esd^2).")
+
+    parser.add_argument("--smooth",
+                        action="store", type=str, dest="smooth",
+                        help="Smooth data set according to smoothing algorithm given. Choice from: 'flat', 'hanning', 'hamming', 'bartlett', 'blackman','savitzky_golay', 'moving_avg'.")
+
+    parser.add_argument("--convert",
+                        action='store', type=parse_wl, nargs=2, dest="convert_2theta", metavar="WL",
+                        help="Convert powder pattern to a different wavelength [wavelength_in wavelength_out].")
+
+    parser.add_argument("--capillary",
+                        action="store", type=str, dest='capillary',
+                        help="Give capillary file to be subtracted from the patterns.")
+
+    parser.add_argument("-i", "--bgin",
+                        action="store", type=str, dest="bg_input",
+                        help="Background points (2 column list; also works with stepco.inp) to subtract from the patterns.")
+
+    parser.add_argument("-c", "--bgcorrect", metavar='OPTION',
+                        action="store", type=str, dest="bg_correct",
+                        help="Interpolation used for --bgin and --capillary. Valid options: 'linear','nearest','zero', 'slinear', 'quadratic, 'cubic') or an integer. Default: 'linear'.")
+
+    parser.add_argument("--offset",
+                        action="store", type=float, dest="bg_offset",
+                        help="Y offset added to the patterns after background subtraction. Default = 0.")
+
+    parser.add_argument("-r", "--range",
+                        action='store', type=float, nargs=2, dest="plot_range",
+                        help="Only use the given 2theta range of the data files.")
+
+    parser.add_argument("--wavelength",
+                        action="store", type=parse_wl, dest='wavelength',
+                        help="Wavelength to use for the powder pattern generation from cif files/IZA codes. Default = 1.0 Angstrom")
+
+    parser.add_argument("-j", "--jobs", metavar='N',
+                        action="store", type=int, dest="jobs",
+                        help="Number of files to process in parallel. 0 = number of cpus. Default = 1.")
+
+    parser.add_argument("--nocache",
+                        action="store_false", dest="use_cache",
+                        help="Do not read or write parsed patterns from/to the binary cache.")
+
+    parser.set_defaults(bin=None,
+                        bin_mode='mean',
+                        smooth=None,
+                        convert_2theta=None,
+                        capillary=None,
+                        bg_input=None,
+                        bg_correct='linear',
+                        bg_offset=0,
+                        plot_range=None,
+                        wavelength=1.0,
+                        jobs=1,
+                        use_cache=True)
+
+    options = parser.parse_args()
+
+    Data.plot_range = options.plot_range
+    cache.enabled = options.use_cache
+
+    t0 = time.time()
+
+    processed, failed = run(options.args,
+                            binsize=options.bin,
+                            bin_mode=options.bin_mode,
+                            smooth=options.smooth,
+                            convert=options.convert_2theta,
+                            capillary=options.capillary,
+                            bg_input=options.bg_input,
+                            kind=options.bg_correct,
+                            offset=options.bg_offset,
+                            wl=options.wavelength,
+                            jobs=options.jobs)
+
+    print
+    print 'Startup: {:.3f} s, processing {} file(s): {:.3f} s'.format(t_startup, len(options.args), time.time() - t0)
+
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
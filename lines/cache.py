@@ -0,0 +1,161 @@
+#!/usr/bin/env python
+
+#    Lines - a python plotting program
+#    Copyright (C) 2015 Stef Smeets
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License along
+#    with this program; if not, write to the Free Software Foundation, Inc.,
+#    51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""Binary cache for parsed powder patterns.
+
+Parsed text files are stored as .npy files in CACHE_DIR, so that the next run
+can memory map them instead of going through np.loadtxt again. Every entry has
+a small .json file next to it with the path, mtime, size and sha1 of the source
+file. An entry is only used if size and mtime still match, or, if only the
+mtime changed, when the content hash is still the same."""
+
+import os
+import json
+import hashlib
+
+import numpy as np
+
+CACHE_DIR = os.environ.get('LINES_CACHE_DIR',
+                           os.path.join(os.path.expanduser('~'), '.cache', 'lines'))
+
+enabled = True
+
+# small files are parsed faster than they are hashed and written
+min_size = 2**20
+
+
+def file_digest(fn, blocksize=2**20):
+    """Returns sha1 hex digest of the contents of fn"""
+    h = hashlib.sha1()
+    with open(fn, 'rb') as f:
+        for block in iter(lambda: f.read(blocksize), ''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def entry_root(fn, usecols=None, cache_dir=None):
+    """Returns path (without extension) of the cache entry for fn/usecols"""
+    if not cache_dir:
+        cache_dir = CACHE_DIR
+    if usecols is not None:
+        usecols = tuple(np.atleast_1d(usecols).tolist())
+    key = '{}|{}'.format(os.path.abspath(fn), usecols)
+    return os.path.join(cache_dir, hashlib.sha1(key).hexdigest())
+
+
+def _replace(src, dst):
+    """os.rename that overwrites dst on Windows as well"""
+    try:
+        os.rename(src, dst)
+    except OSError:
+        os.remove(dst)
+        os.rename(src, dst)
+
+
+def _write_meta(root, meta):
+    tmp = '{}.{}.json.tmp'.format(root, os.getpid())
+    with open(tmp, 'w') as f:
+        json.dump(meta, f)
+    _replace(tmp, root+'.json')
+
+
+def load(fn, usecols=None, cache_dir=None):
+    """Returns the cached array for fn as a copy-on-write memory map, or None if
+    there is no valid entry. Stale entries are ignored and overwritten by the next save()"""
+    if not enabled:
+        return None
+
+    root = entry_root(fn, usecols=usecols, cache_dir=cache_dir)
+
+    try:
+        st = os.stat(fn)
+        with open(root+'.json', 'r') as f:
+            meta = json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+
+    if meta.get('size') != st.st_size:
+        return None
+
+    if meta.get('mtime') != st.st_mtime:
+        # touched or rewritten, only valid if the content is the same
+        if meta.get('digest') != file_digest(fn):
+            return None
+        meta['mtime'] = st.st_mtime
+        try:
+            _write_meta(root, meta)
+        except (IOError, OSError):
+            pass
+
+    try:
+        # 'c' -> copy-on-write, Data.convert_wavelength modifies the array in place
+        return np.load(root+'.npy', mmap_mode='c')
+    except (IOError, ValueError):
+        return None
+
+
+def save(fn, arr, usecols=None, cache_dir=None):
+    """Stores arr as the parsed contents of fn"""
+    if not enabled:
+        return
+
+    try:
+        st = os.stat(fn)
+    except OSError:
+        return
+
+    if st.st_size < min_size:
+        return
+
+    root = entry_root(fn, usecols=usecols, cache_dir=cache_dir)
+    drc = os.path.dirname(root)
+
+    try:
+        if not os.path.isdir(drc):
+            os.makedirs(drc)
+
+        tmp = '{}.{}.npy.tmp'.format(root, os.getpid())
+        with open(tmp, 'wb') as f:
+            np.save(f, np.ascontiguousarray(arr, dtype=float))
+        _replace(tmp, root+'.npy')
+
+        meta = {'source': os.path.abspath(fn),
+                'usecols': usecols,
+                'mtime': st.st_mtime,
+                'size': st.st_size,
+                'digest': file_digest(fn)}
+        _write_meta(root, meta)
+    except (IOError, OSError), e:
+        print ' >> Could not write cache entry for {}: {}'.format(fn, e)
+
+
+def clear(cache_dir=None):
+    """Removes all cache entries"""
+    if not cache_dir:
+        cache_dir = CACHE_DIR
+    if not os.path.isdir(cache_dir):
+        return
+    for fn in os.listdir(cache_dir):
+        if fn.endswith(('.npy', '.npz', '.json', '.tmp')):
+            os.remove(os.path.join(cache_dir, fn))
+    # patterns generated by cif2xy
+    drc = os.path.join(cache_dir, 'cif2xy')
+    if os.path.isdir(drc):
+        for fn in os.listdir(drc):
+            os.remove(os.path.join(drc, fn))
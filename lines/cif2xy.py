@@ -17,14 +17,26 @@
 #    with this program; if not, write to the Free Software Foundation, Inc.,
 #    51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 
-import subprocess as sp
+"""Powder pattern generation from cif files.
+
+The pattern is calculated in-process with crystal.py (structure factors as a
+matrix product over reflections and atoms, pseudo-Voigt profiles). Output
+files are written atomically, so that several jobs can run in the same working
+directory at the same time. Patterns are cached in CACHE_DIR/cif2xy, by the
+sha1 of the cif file, the wavelength and the profile settings, so that
+unchanged structures are not calculated again."""
+
 import sys
 import os
+import json
+import shutil
+import hashlib
 import argparse
 
-import numpy as np
+import cache
 
-from xcore.formats import read_cif
+from crystal import Crystal
+from writer import write_columns
 
 __version__ = "2015-10-01"
 
@@ -32,6 +44,11 @@ planck_constant = 6.62606957E-34
 elementary_charge = 1.60217656E-19
 speed_of_light = 2.99792458E8
 
+# fwhm^2 = U tan^2(th) + V tan(th) + W (see calc_fwhm), eta = Lorentzian fraction,
+# peak_range in fwhm, the strongest point is scaled to max
+profile_settings = {'start': 2.0, 'stop': 49.99, 'step': 0.002,
+                    'uvw': (0.001, 0.0, 0.0), 'eta': 0.5, 'peak_range': 25, 'max': 50000}
+
 
 def energy2wavelength(E):
     """Takes wavelength in keV, returns energy in Angstrom"""
@@ -47,95 +64,88 @@ def replace_extension(fn, new=".xy"):
     return xy_out
 
 
-def cif2xy(cif, wl=1.0):
-    print "Reading CIF:", cif
+def cache_path(cif, wl, settings):
+    """Returns path of the cached pattern for cif at wavelength wl"""
+    h = hashlib.sha1(cache.file_digest(cif))
+    h.update(json.dumps([wl, sorted(settings.items())]))
+    return os.path.join(cache.CACHE_DIR, 'cif2xy', h.hexdigest() + '.xy')
+
+
+def copy_atomic(src, dst):
+    """Copies src to dst, so that other processes never see a partial dst"""
+    tmp = '{}.{}.tmp'.format(dst, os.getpid())
+    shutil.copyfile(src, tmp)
+    cache._replace(tmp, dst)
 
-    cell, atoms = read_cif(cif)
 
-    a, b, c, al, be, ga = cell.parameters
+def calc_pattern(cif, wl=1.0, settings=None):
+    """Returns 2theta and intensity of the powder pattern of cif. settings: see profile_settings"""
+    s = dict(profile_settings)
+    if settings:
+        s.update(settings)
 
-    spgr = cell.spgr_name
+    x, y = Crystal.from_cif(cif).pattern(wl=wl, start=s['start'], stop=s['stop'], step=s['step'],
+                                         uvw=s['uvw'], eta=s['eta'], peak_range=s['peak_range'])
+    if s['max'] and y.max() > 0:
+        y *= s['max'] / y.max()
+    return x, y
 
-    title = 'lines'
+
+def cif2xy(cif, wl=1.0, settings=None, use_cache=True):
+    """Generates powder pattern for cif, and writes it to the working directory
+    (basename.xy). settings: see profile_settings"""
+    print "Reading CIF:", cif
+
+    s = dict(profile_settings)
+    if settings:
+        s.update(settings)
 
     xy_out = replace_extension(cif, new="xy")
 
-    focus_inp = open("focus.inp", 'w')
-    focus_out = "focus.out"
-
-    print >> focus_inp, """
-Title  {title}
-
-SpaceGroup  {spgr}
-UnitCell  {a} {b} {c} {al} {be} {ga}
-
-Lambda  {wl}
-
-ProfileStartEndStep 2 49.99 0.002
-ProfilePOLRA 1.0
-ProfileFWHM UVW 0.001 0.0 0.0
-#ProfileAsym  a(i) -0.005 0.003 0
-ProfilePeakShape  PseudoVoigt
-PseudoVoigtPeakRange  25
-PseudoVoigtFracLorentz  0.5
-ProfileBackground  0
-#ProfileReferenceRefl
-ProfileReferenceMax  50000
-
-""".format(title=title,
-           spgr=spgr,
-           a=a,
-           b=b,
-           c=c,
-           al=al,
-           be=be,
-           ga=ga,
-           wl=wl)
-
-    for i, atom in atoms.iterrows():
-        label = atom.label
-        element = atom.symbol
-        if element == 'T':
-            element = 'Si'
-        x, y, z = atom.x, atom.y, atom.z
-        occ = atom.occ
-        u_iso = atom.biso / (8*np.pi**2)
-
-        print >> focus_inp, '{label:8} {element:4} {x:8.5f} {y:8.5f} {z:8.5f} {occ:.4f} {u_iso:.4f}'.format(label=label,
-                                                                                                            element=element,
-                                                                                                            x=x, y=y, z=z,
-                                                                                                            occ=occ,
-                                                                                                            u_iso=u_iso)
-    print >> focus_inp, "End"
-    focus_inp.close()
+    use_cache = use_cache and cache.enabled
+    cached = cache_path(cif, wl, s)
+    if use_cache and os.path.exists(cached):
+        print "Using cached powder pattern (wl = {} A)".format(wl)
+        copy_atomic(cached, xy_out)
+        return xy_out
 
     print "Generating powder pattern... (wl = {} A)".format(wl)
-    sp.call(
-        "focus -PowderStepScan {} > {}".format(focus_inp.name, focus_out), shell=True)
-
-    begin_switch = ">Begin stepscan"
-    end_switch = "&"
-
-    focus_stepscan = open(focus_out, 'r')
-    xye = open(xy_out, 'w')
-
-    do_print = 0
-    for line in focus_stepscan:
-        if line.startswith(end_switch):
-            break
-        elif do_print:
-            print >> xye, line,
-        elif line.startswith(begin_switch):
-            do_print = 1
-            focus_stepscan.next()
-    focus_stepscan.close()
-    xye.close()
+    x, y = calc_pattern(cif, wl=wl, settings=s)
+
+    tmp = '{}.{}.tmp'.format(xy_out, os.getpid())
+    write_columns(tmp, (x, y), ('%10.4f', '%15.3f'))
+
+    if use_cache:
+        try:
+            if not os.path.isdir(os.path.dirname(cached)):
+                os.makedirs(os.path.dirname(cached))
+            copy_atomic(tmp, cached)
+        except (IOError, OSError), e:
+            print ' >> Could not write cache entry for {}: {}'.format(cif, e)
+
+    cache._replace(tmp, xy_out)
 
     return xy_out
 
 
+def cif2xy_batch(cifs, wl=1.0, settings=None, use_cache=True, jobs=0):
+    """Runs cif2xy for all cifs, using a pool of jobs processes (0 = number of cpus).
+    Returns list of written files and list of files that failed"""
+    from batch import imap_files
+
+    done, failed = [], []
+    for cif, out, error in imap_files(cif2xy, cifs, jobs=jobs, wl=wl, settings=settings, use_cache=use_cache):
+        if error:
+            print ' >> {} failed: {}'.format(cif, error)
+            failed.append(cif)
+        else:
+            print "Printed powder pattern to", out
+            done.append(out)
+    return done, failed
+
+
 def main():
-    description = """"""
+    description = """Calculates the powder patterns of the given cif files and writes them to the working directory (basename.xy)."""
     
     epilog = 'Updated: {}'.format(__version__)
 
@@ -157,8 +167,6 @@ def main():
         else:
             return float(string)
 
-    parser = argparse.ArgumentParser()
-
     parser.add_argument("args",
                         type=str, metavar="FILE", nargs='*',
                         help="Paths to cif files.")
@@ -167,15 +175,51 @@ def main():
                         action="store", type=parse_wl, dest='wavelength',
                         help="Specify the wavelength to use for the powder pattern generation. Default = 1.0 Angstrom")
 
-    parser.set_defaults(wavelength=1.0)
+    parser.add_argument("--range", metavar=('START', 'STOP'),
+                        action="store", type=float, nargs=2, dest="range",
+                        help="Range of the powder pattern in degrees 2theta. Default = {} {}".format(profile_settings['start'], profile_settings['stop']))
+
+    parser.add_argument("--step",
+                        action="store", type=float, dest="step",
+                        help="Step size in degrees 2theta. Default = {}".format(profile_settings['step']))
+
+    parser.add_argument("--uvw", metavar=("U", "V", "W"),
+                        action="store", type=float, nargs=3, dest="uvw",
+                        help="Peak width: fwhm^2 = U tan^2(th) + V tan(th) + W. Default = {} {} {}".format(*profile_settings['uvw']))
+
+    parser.add_argument("--eta",
+                        action="store", type=float, dest="eta",
+                        help="Lorentzian fraction of the pseudo-Voigt peaks. Default = {}".format(profile_settings['eta']))
+
+    parser.add_argument("-j", "--jobs", metavar='N',
+                        action="store", type=int, dest="jobs",
+                        help="Number of cif files to process in parallel (0 = number of cpus). Default = 1")
+
+    parser.add_argument("--nocache",
+                        action="store_false", dest="use_cache",
+                        help="Always calculate the patterns, do not read or write cached patterns (location can be set with environment variable LINES_CACHE_DIR).")
+
+    parser.set_defaults(wavelength=1.0,
+                        jobs=1,
+                        use_cache=True)
 
     options = parser.parse_args()
     args = options.args
 
-    for arg in args:
-        out = cif2xy(arg, wl=options.wavelength)
-        print "Printed powder pattern to", out
-        print
+    settings = {}
+    if options.range:
+        settings['start'], settings['stop'] = options.range
+    if options.step:
+        settings['step'] = options.step
+    if options.uvw:
+        settings['uvw'] = tuple(options.uvw)
+    if options.eta is not None:
+        settings['eta'] = options.eta
+
+    done, failed = cif2xy_batch(args, wl=options.wavelength, settings=settings,
+                                use_cache=options.use_cache, jobs=options.jobs)
+    if failed:
+        sys.exit(1)
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,1315 @@
+#!/usr/bin/env python
+
+#    Lines - a python plotting program
+#    Copyright (C) 2015 Stef Smeets
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License along
+#    with this program; if not, write to the Free Software Foundation, Inc.,
+#    51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""Reading, writing and processing of powder patterns.
+
+Everything in here works without matplotlib, so that it can be used from
+scripts and batch jobs (see batch.py) without paying for the import of pyplot
+and without requiring a display. Scipy is only imported when needed."""
+
+import sys
+import os
+import math
+
+import numpy as np
+
+import cache
+
+from writer import write_columns
+from filters import smooth, savitzky_golay
+
+LINESDIR = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+
+planck_constant = 6.62606957E-34
+elementary_charge = 1.60217656E-19
+speed_of_light = 2.99792458E8
+
+wavelengths = {"cra1": 2.28970, "cra2": 2.29361, "cr": 2.2909,
+               "fea1": 1.93604, "fea2": 1.93998, "fe": 1.9373,
+               "cua1": 1.54056, "cua2": 1.54439, "cu": 1.5418,
+               "moa1": 0.70930, "moa2": 0.71359, "mo": 0.7107,
+               "aga1": 0.55941, "aga2": 0.56380, "ag": 0.5608, "sls": 1.0000}
+
+iza_codes = ["ABW", "ACO", "AEI", "AEL", "AEN", "AET", "AFG", "AFI", "AFN",
+             "AFO", "AFR", "AFS", "AFT", "AFV", "AFX", "AFY", "AHT", "ANA",
+             "APC", "APD", "AST", "ASV", "ATN", "ATO", "ATS", "ATT", "ATV",
+             "AVL", "AWO", "AWW", "BCT", "BEA", "BEC", "BIK", "BOF", "BOG",
+             "BOZ", "BPH", "BRE", "BSV", "CAN", "CAS", "CDO", "CFI", "CGF",
+             "CGS", "CHA", "CHI", "CLO", "CON", "CSV", "CZP", "DAC", "DDR",
+             "DFO", "DFT", "DOH", "DON", "EAB", "EDI", "EEI", "EMT", "EON",
+             "EPI", "ERI", "ESV", "ETR", "EUO", "EWT", "EZT", "FAR", "FAU",
+             "FER", "FRA", "GIS", "GIU", "GME", "GON", "GOO", "HEU", "IFO",
+             "IFR", "IFW", "IFY", "IHW", "IMF", "IRN", "IRR", "IRY", "ISV",
+             "ITE", "ITG", "ITH", "ITN", "ITR", "ITT", "ITV", "ITW", "IWR",
+             "IWS", "IWV", "IWW", "JBW", "JNT", "JOZ", "JRY", "JSN", "JSR",
+             "JST", "JSW", "KFI", "LAU", "LEV", "LIO", "LIT", "LOS", "LOV",
+             "LTA", "LTF", "LTJ", "LTL", "LTN", "MAR", "MAZ", "MEI", "MEL",
+             "MEP", "MER", "MFI", "MFS", "MON", "MOR", "MOZ", "MRE", "MSE",
+             "MSO", "MTF", "MTN", "MTT", "MTW", "MVY", "MWW", "NAB", "NAT",
+             "NES", "NON", "NPO", "NPT", "NSI", "OBW", "OFF", "OKO", "OSI",
+             "OSO", "OWE", "PAR", "PAU", "PCR", "PHI", "PON", "POS", "PSI",
+             "PUN", "RHO", "RON", "RRO", "RSN", "RTE", "RTH", "RUT", "RWR",
+             "RWY", "SAF", "SAO", "SAS", "SAT", "SAV", "SBE", "SBN", "SBS",
+             "SBT", "SEW", "SFE", "SFF", "SFG", "SFH", "SFN", "SFO", "SFS",
+             "SFV", "SFW", "SGT", "SIV", "SOD", "SOF", "SOS", "SSF", "SSO",
+             "SSY", "STF", "STI", "STO", "STT", "STW", "SVR", "SVV", "SZR",
+             "TER", "THO", "TOL", "TON", "TSC", "TUN", "UEI", "UFI", "UOS",
+             "UOV", "UOZ", "USI", "UTL", "UWY", "VET", "VFI", "VNI", "VSV",
+             "WEI", "WEN", "YUG", "ZON"]  # updated dec 2015
+
+
+def lineno():
+    """Returns the current line number in our program."""
+    import inspect
+    return inspect.currentframe().f_back.f_lineno
+
+
+def printer(data):
+    """Print things to stdout on one line dynamically"""
+    sys.stdout.write("\r\x1b[K"+data.__str__())
+    sys.stdout.flush()
+
+
+def gen_read_files(paths):
+    """opens file, returns file object for reading"""
+    for path in paths:
+        try:
+            f = open(path, 'r')
+        except IOError, e:
+            print e
+            # print 'Cannot open {} (IOError)'.format(path,e)
+            exit(0)
+        yield f
+
+
+def read_file(path):
+    """opens file, returns file object for reading"""
+    try:
+        f = open(path, 'r')
+    except IOError, e:
+        print e
+        # print 'Cannot open {} (IOError)'.format(path,e)
+        exit(0)
+    return f
+
+
+def read_data(fn, usecols=None, append_zeros=False, savenpy=False, suffix='', is_ticks=False, wl=1.0):
+    if fn == 'stepco.inp':
+        f = read_file(fn)
+        return parse_xrs(f, return_as='d')
+
+    root, ext = os.path.splitext(fn)
+
+    if ext == '' and root.upper() in iza_codes:
+        from library import get_library
+        lib = get_library()
+        if lib and root in lib:
+            return lib.pattern(root, wl=wl)
+        fn = parse_iza_code(code=root)
+        return read_data(fn, wl=wl)
+
+    if ext == '.cif':
+        fn = run_cif2xy(fn, wl=wl)
+        return read_data(fn)
+
+    if ext.lower() == '.xrdml':
+        scans = parse_xrdml(fn)
+        if len(scans) > 1:
+            print ' >> {} contains {} scans, using the first one.'.format(fn, len(scans))
+        return scans[0]
+
+    npy = root+'.npy'
+
+    if ext == '.npy':
+        inp = np.load(fn)
+    elif usecols is None and os.path.exists(npy) and not (os.path.exists(fn) and os.path.getmtime(npy) < os.path.getmtime(fn)):
+        # only use the --savenpy side file if it is newer than the source
+        inp = np.load(npy)
+        ext = '.npy'
+        fn = npy
+    else:
+        inp = cache.load(fn, usecols=usecols)
+        if inp is None:
+            inp = np.loadtxt(fn, usecols=usecols, ndmin=2)
+            cache.save(fn, inp, usecols=usecols)
+
+    if append_zeros:
+        (i, j) = inp.shape
+        inp = np.hstack((inp, np.zeros((i, 1))))
+
+    if inp.shape[1] > 3:
+        print 'More than 3 columns read from {}, assuming x,y,esd, ignoring the rest.'.format(fn)
+
+    d = Data(inp, name=fn+suffix, is_ticks=is_ticks)
+
+    if savenpy and ext != '.npy':
+        np.save(root, inp)
+
+    return d
+
+
+def read_patterns(fn, **kwargs):
+    """Like read_data, but returns a list of Data with all scans in fn (xrdml files can
+    contain more than one)"""
+    root, ext = os.path.splitext(fn)
+    if ext.lower() == '.xrdml':
+        return parse_xrdml(fn)
+    return [read_data(fn, **kwargs)]
+
+
+def load_tick_marks(path, col=3):
+    """Checks if file exists and loads tick mark data as data class. Use column=3 default for xrs"""
+    try:
+        f = open(path, 'r')
+        f.close()
+    except IOError:
+        print '-- {} not found. (IOError)'.format(path)
+        return None
+
+    ticks = read_data(path, usecols=(col,), append_zeros=True, is_ticks=True)
+    return ticks
+
+
+def get_correlation_matrix(f, topas=False):
+    names = []
+    lst_not_iprm = []
+
+    def yield_corrmat(f):
+        for i, line in enumerate(f):
+            # calculate shift to correct for topas formatting
+            shift = max(0, int(math.log10(i+1))-1)
+            if line.startswith('}'):
+                raise StopIteration
+            else:
+                if not line.startswith('iprm'):
+                    lst_not_iprm.append(i)
+                    names.append(line[0:21].strip())
+                yield line[26+shift:]
+
+    for line in f:
+        if line.startswith('C_matrix_normalized'):
+            f.next()
+            f.next()
+
+            print 'Ignoring reflection intensities (iprm***), because they are always correlated.'
+            corr = np.genfromtxt(yield_corrmat(f), delimiter=4)
+            corr = corr[lst_not_iprm, :][:, lst_not_iprm]
+
+            return corr, names
+
+    f.seek(0)
+    return np.loadtxt(f), names
+
+
+def parse_xrdml(fn):
+    """Reads panalytical XPERT PRO files (XML), returns a list of Data, one for every scan.
+
+    The file is read with iterparse, every scan is dropped from the tree as soon as it
+    has been converted, so memory use does not grow with the number of scans. If a scan
+    has both counts and intensities, counts are used. Intensities are multiplied by the
+    beam attenuation factors, if present."""
+
+    try:
+        from xml.etree import cElementTree as ElementTree
+    except ImportError:
+        from xml.etree import ElementTree
+
+    def tagname(elem):
+        return elem.tag.rsplit('}', 1)[-1]  # strip namespace
+
+    def to_array(elem):
+        return np.fromstring(elem.text or '', sep=' ')
+
+    scans = []
+
+    for event, elem in ElementTree.iterparse(fn, events=('start', 'end')):
+        tag = tagname(elem)
+
+        if event == 'start':
+            if tag == 'scan':
+                scan = {}
+            continue
+
+        if tag == 'positions' and elem.get('axis') == '2Theta':
+            for child in elem:
+                scan[tagname(child)] = child.text
+        elif tag in ('counts', 'intensities', 'beamAttenuationFactors'):
+            scan[tag] = to_array(elem)
+        elif tag == 'scan':
+            scans.append(scan)
+            elem.clear()
+
+    if not scans:
+        raise IOError("Cannot find scan data in xrdml file: {}".format(fn))
+
+    root, ext = os.path.splitext(fn)
+
+    ret = []
+    for i, scan in enumerate(scans):
+        counts = scan.get('counts', scan.get('intensities'))
+        if counts is None:
+            raise IOError("Cannot find intensities in scan {} of xrdml file.".format(i+1))
+
+        if 'beamAttenuationFactors' in scan:
+            counts = counts * scan['beamAttenuationFactors']
+
+        if 'listPositions' in scan:
+            th2 = np.fromstring(scan['listPositions'], sep=' ')
+        elif 'startPosition' in scan:
+            th2 = np.linspace(float(scan['startPosition']), float(scan['endPosition']), len(counts))
+        else:
+            raise IOError("Cannot find range node in xrdml file.")
+
+        xy = np.vstack([th2, counts]).T
+
+        if len(scans) == 1:
+            name = fn
+            new = root+'.xy'
+        else:
+            name = '{}_{}{}'.format(root, i+1, ext)
+            new = '{}_{}.xy'.format(root, i+1)
+
+        d = Data(xy, name=name)
+
+        if not os.path.isfile(new):
+            d.print_pattern(name=new)
+
+        ret.append(d)
+
+    return ret
+
+
+def parse_iza_code(code):
+    """Takes IZA code and returns path to cif"""
+
+    fn = code.upper()+'0.cif'
+    path = os.path.join(LINESDIR, 'zeolite_database', fn)
+
+    print 'Framework code {} -> {}'.format(code, path)
+    print
+
+    return path
+
+
+def run_cif2xy(cif, wl=1.0):
+    from cif2xy import cif2xy
+    return cif2xy(cif, wl=wl)
+
+
+def parse_xrs(f, return_as='d_xrs'):
+    # xy = np.array([], dtype=float).reshape(0, 2)
+    start = True
+    pre = []
+    post = []
+
+    x = []
+    y = []
+    esd = []
+
+    for line in f:
+        if 'finish' in line.lower() or 'end' in line.lower():
+            # Takes care of new xrs files with no bgvalu commands
+            start = False
+            post.append(line)
+        elif line.lower().startswith('bgvalu') and start:
+            inp = line.split()
+            x.append(float(inp[1]))
+            y.append(float(inp[2]))
+            try:
+                esd.append(float(inp[3]))
+            except IndexError:
+                esd.append(np.nan)
+        elif start:
+            pre.append(line)
+        elif not start:
+            post.append(line)
+
+    f.close()
+
+    if return_as == 'xye':
+        return np.vstack([x, y, esd]).T
+    elif return_as == 'xy':
+        return np.vstack([x, y]).T
+    elif return_as == 'd':
+        xye = np.vstack([x, y, esd]).T
+        d = Data(xye, name='stepco.inp')
+        return d
+    elif return_as == 'd_xrs':   # include xrs stepco input data
+        xye = np.vstack([x, y, esd]).T
+        d = Data(xye, name='stepco.inp')
+        xrs = [f.name, pre, post]
+        return d, xrs
+    else:
+        raise SyntaxError
+
+
+def parse_crplot_dat(f):
+    """Parses crplot.dat file"""
+
+    # skip first 2 lines
+    f.next()
+    f.next()
+
+    ret = []
+
+    for line in f:
+        inp = line.split()
+        if not f:
+            continue
+        ret.append([float(val) for val in inp])
+
+    return ret
+
+
+def parse_hkl_dat(f):
+    ret = []
+
+    for line in f:
+        inp = line.split()
+        if not f:
+            continue
+        if len(inp) < 4:
+            inp = (line[0:3], line[3:6], line[6:9], line[9:])
+        else:
+            ret.append([float(val) for val in inp])
+
+    return ret
+
+
+class TailReader(object):
+    """Incremental reader for column data in text files that grow by appending rows,
+    i.e. step scans that are written during data collection.
+
+    read() only parses the complete lines appended since the previous call, and adds
+    them to a growable array. If the file was truncated or replaced, if the bytes at the
+    start or before the last read position changed, or if it was modified without growing,
+    the file is read again from the start. Files that are rewritten in full (crplot.dat,
+    .prf) should not be read with this class: a rewrite that keeps the first and last
+    bytes and grows the file cannot be told apart from an append."""
+
+    def __init__(self, fn, skiprows=0, usecols=None, capacity=1024, check_size=64):
+        self.fn = fn
+        self.skiprows = skiprows
+        self.usecols = usecols
+        self.capacity = capacity
+        self.check_size = check_size
+        self.reset()
+
+    def reset(self):
+        self.offset = 0
+        self.ino = None
+        self.mtime = None
+        self.head = ''
+        self.tail = ''
+        self.skipped = 0
+        self.buf = None
+        self.n = 0
+
+    @property
+    def data(self):
+        """View on the rows read so far"""
+        if self.buf is None:
+            return np.empty((0, 0))
+        return self.buf[:self.n]
+
+    def _is_appended(self, f, st):
+        """Checks that the file is the same as before, with data appended"""
+        if st.st_ino != self.ino or st.st_size < self.offset:
+            return False
+        # rewritten in place, without new rows
+        if st.st_size == self.offset and st.st_mtime != self.mtime:
+            return False
+        f.seek(0)
+        if f.read(len(self.head)) != self.head:
+            return False
+        f.seek(self.offset - len(self.tail))
+        return f.read(len(self.tail)) == self.tail
+
+    def _append(self, rows):
+        if self.buf is None:
+            self.buf = np.empty((max(self.capacity, len(rows)), rows.shape[1]))
+        elif rows.shape[1] != self.buf.shape[1]:
+            raise ValueError('Number of columns changed in {}'.format(self.fn))
+        elif self.n + len(rows) > len(self.buf):
+            buf = np.empty((max(2*len(self.buf), self.n + len(rows)), self.buf.shape[1]))
+            buf[:self.n] = self.buf[:self.n]
+            self.buf = buf
+
+        self.buf[self.n:self.n+len(rows)] = rows
+        self.n += len(rows)
+
+    def read(self):
+        """Returns (data, reloaded), where reloaded is True if the file was read from
+        the start, and False if only the new rows were added"""
+        with open(self.fn, 'rb') as f:
+            st = os.fstat(f.fileno())
+            reloaded = not (self.offset and self._is_appended(f, st))
+            if reloaded:
+                self.reset()
+                self.ino = st.st_ino
+            self.mtime = st.st_mtime
+            f.seek(self.offset)
+            chunk = f.read()
+
+        # an incomplete last line is picked up by the next call
+        chunk = chunk[:chunk.rfind('\n')+1]
+        if not chunk:
+            return self.data, reloaded
+
+        lines = chunk.splitlines()
+        skip = min(self.skiprows - self.skipped, len(lines))
+        lines = [line for line in lines[skip:] if line.strip()]
+        if lines:
+            self._append(np.loadtxt(lines, usecols=self.usecols, ndmin=2))
+
+        self.offset += len(chunk)
+        if len(self.head) < self.check_size:
+            self.head = (self.head + chunk)[:self.check_size]
+        self.tail = (self.tail + chunk)[-self.check_size:]
+        self.skipped += skip
+
+        return self.data, reloaded
+
+
+def f_bg_correct_out(d, bg_xy, kind='linear', offset='ask', suffix_bg='_bg', suffix_corr='_corr'):
+    """Function that removes the background from a data set and prints it to a new file"""
+
+    root, ext = os.path.splitext(d.filename)
+    fn_bg = root+suffix_bg+ext
+    fn_corr = root+suffix_corr+ext
+
+    # fn_bg   = d.filename.replace('.','_bg.')
+    # fn_corr = d.filename.replace('.','_corr.')
+
+    xvals = d.x
+    yvals = d.y
+
+    bg_yvals = interpolate(bg_xy, xvals, kind=kind)
+
+    if offset == 'ask':
+        offset = raw_input(
+            "What y offset should I add to the data? (x=exit)\n >> [0] ") or 0
+        offset = int(offset)
+
+    if offset == 'x':
+        return
+
+    print '\nOffset = {}'.format(offset)
+
+    if len(bg_xy) >= 4:
+        print 'Writing background pattern to %s' % fn_bg
+        # only points without a y value are left out, a missing esd is written as nan
+        keep = ~np.isnan(bg_yvals)
+        write_columns(fn_bg, (xvals[keep], bg_yvals[keep]), ('%15.6f', '%15.2f'), nan=None)
+
+        print 'Writing corrected pattern to %s' % fn_corr
+        ycorr = yvals-bg_yvals+offset
+        keep = ~np.isnan(ycorr)
+        if d.has_esd:
+            write_columns(fn_corr, (xvals[keep], ycorr[keep], d.err[keep]), ('%15.6f', '%15.2f', '%15.6f'), nan=None)
+        else:
+            write_columns(fn_corr, (xvals[keep], ycorr[keep]), ('%15.6f', '%15.2f'), nan=None)
+    else:
+        raise IndexError(
+            'Not enough values in background array, need at least 4 points.')
+
+
+def new_stepco_inp(xy, name, pre, post, esds=None):
+    """Function for writing stepco input files"""
+
+    print 'Writing xy data to file {}'.format(name)
+
+    if np.any(esds):
+        # missing esds are left empty
+        write_columns(name, (xy[0], xy[1], esds.ravel()), ('%15f', '%15.2f', '%15.2f'),
+                      prefix='BGVALU    ', pre=pre, post=post, nan='blank')
+    else:
+        write_columns(name, (xy[0], xy[1]), ('%15f', '%15.2f'),
+                      prefix='BGVALU    ', pre=pre, post=post)
+
+
+def interpolate(arr, xvals, kind='cubic'):
+    """
+    arr is the data set to interpolate, can be ndim=2 array, or tuple/list of x/y values
+
+    xvals are the values it has to be interpolated to
+
+    kind is the type of correction, Valid options: 'linear','nearest','zero',
+    'slinear', 'quadratic, 'cubic') or as an integer specifying the order
+    of the spline interpolator to use.
+    """
+
+    from scipy.interpolate import interp1d
+
+    try:
+        arr.ndim
+    except AttributeError:
+        x, y = arr
+    else:
+        assert arr.ndim == 2, 'Expected 2 dimensional array'
+        x = arr[:, 0]  # create views
+        y = arr[:, 1]  #
+
+    try:
+        kind = int(kind)
+    except ValueError:
+        if x.shape[0] < 4:
+            kind = 'linear'
+    else:
+        if x.shape[0] < kind+1:
+            kind = 'linear'
+
+    res = interp1d(x, y, kind=kind, bounds_error=False)
+
+    # if the background seems to take shortcuts in linear mode, this is because fixed steps
+    # were set in the Backgrounder class
+
+    return res(xvals)
+
+
+class KnotList(object):
+    """Background points, kept sorted by x in a preallocated 2xN buffer that grows by
+    doubling. xy is a view on the buffer, shape (2, n), so it can be passed to
+    plotting functions without copying.
+
+    The insertion point is found with a binary search (np.searchsorted); inserting or
+    removing a point shifts the points after it in place instead of reallocating and
+    sorting the whole array. All changes are recorded for undo() and redo()."""
+
+    def __init__(self, xy=None, capacity=64):
+        if xy is None:
+            xy = np.array([], dtype=float).reshape(2, 0)
+        xy = np.asarray(xy, dtype=float)
+        xy = xy[:, xy[0].argsort()]
+
+        self.n = xy.shape[1]
+        self.buf = np.empty((2, max(capacity, 2*self.n)))
+        self.buf[:, :self.n] = xy
+
+        self.undo_stack = []
+        self.redo_stack = []
+
+    def __len__(self):
+        return self.n
+
+    @property
+    def xy(self):
+        return self.buf[:, :self.n]
+
+    def _insert(self, x, y):
+        n = self.n
+        if n == self.buf.shape[1]:
+            buf = np.empty((2, 2*n))
+            buf[:, :n] = self.buf
+            self.buf = buf
+        i = np.searchsorted(self.buf[0, :n], x, side='right')
+        self.buf[:, i+1:n+1] = self.buf[:, i:n]
+        self.buf[:, i] = x, y
+        self.n += 1
+        return i
+
+    def _delete(self, i):
+        self.buf[:, i:self.n-1] = self.buf[:, i+1:self.n]
+        self.n -= 1
+
+    def _find(self, x, y):
+        """Returns index of point x,y"""
+        i = np.searchsorted(self.buf[0, :self.n], x, side='left')
+        while self.buf[1, i] != y:
+            i += 1
+        return i
+
+    def insert(self, x, y):
+        """Adds point x,y and returns its index"""
+        self.undo_stack.append(('insert', np.array([[x], [y]], dtype=float)))
+        del self.redo_stack[:]
+        return self._insert(x, y)
+
+    def remove(self, ind):
+        """Removes the points at the indices in ind, returns the removed points, shape (2, k)"""
+        ind = np.unique(ind)
+        removed = self.xy[:, ind].copy()
+        for i in ind[::-1]:
+            self._delete(i)
+        self.undo_stack.append(('remove', removed))
+        del self.redo_stack[:]
+        return removed
+
+    def _apply(self, action, points, reverse=False):
+        if (action == 'insert') != reverse:
+            for x, y in points.T:
+                self._insert(x, y)
+        else:
+            for x, y in points.T:
+                self._delete(self._find(x, y))
+
+    def undo(self):
+        """Reverts the last insert/remove, returns it as (action, points) or None"""
+        if not self.undo_stack:
+            return None
+        action, points = self.undo_stack.pop()
+        self._apply(action, points, reverse=True)
+        self.redo_stack.append((action, points))
+        return action, points
+
+    def redo(self):
+        """Repeats the last undone insert/remove, returns it as (action, points) or None"""
+        if not self.redo_stack:
+            return None
+        action, points = self.redo_stack.pop()
+        self._apply(action, points)
+        self.undo_stack.append((action, points))
+        return action, points
+
+
+class RingBuffer(object):
+    """Preallocated buffer that holds the last `capacity` rows appended to it"""
+
+    def __init__(self, capacity, ncols=2):
+        self.capacity = capacity
+        self.buf = np.empty((capacity, ncols))
+        self.n = 0  # total number of rows appended
+
+    def __len__(self):
+        return min(self.n, self.capacity)
+
+    def append(self, rows):
+        rows = np.asarray(rows, dtype=float)
+        skipped = max(len(rows) - self.capacity, 0)
+        rows = rows[skipped:]
+        self.n += skipped
+
+        start = self.n % self.capacity
+        end = start + len(rows)
+        if end <= self.capacity:
+            self.buf[start:end] = rows
+        else:
+            split = self.capacity - start
+            self.buf[start:] = rows[:split]
+            self.buf[:end-self.capacity] = rows[split:]
+        self.n += len(rows)
+
+    @property
+    def data(self):
+        """Rows in the order they were appended (copy if the buffer has wrapped around)"""
+        if self.n <= self.capacity:
+            return self.buf[:self.n]
+        i = self.n % self.capacity
+        return np.concatenate((self.buf[i:], self.buf[:i]))
+
+    def oldest(self, k):
+        """Returns the k-th oldest row in the buffer"""
+        return self.buf[(max(self.n - self.capacity, 0) + k) % self.capacity]
+
+    def grow(self, capacity):
+        """Increases the capacity, keeping the rows in the buffer"""
+        data = self.data
+        self.buf = np.empty((capacity, self.buf.shape[1]))
+        self.buf[:len(data)] = data
+        self.capacity = capacity
+        self.n = len(data)
+
+
+class MinMaxHistory(object):
+    """Overview of an unbounded stream of x,y points in bounded memory. Consecutive
+    points are collected in buckets of k points, of which only the minimum and the
+    maximum are kept. When all buckets are in use, neighbouring buckets are merged and
+    k doubles, so that spikes remain visible however long the stream runs."""
+
+    def __init__(self, capacity=5000):
+        self.capacity = capacity + capacity % 2
+        self.k = 1
+        self.buckets = np.empty((self.capacity+1, 4))  # x_min, y_min, x_max, y_max
+        self.nb = 0
+        self.count = 0  # number of points in bucket nb, which is not full yet
+
+    def __len__(self):
+        return self.nb*self.k + self.count
+
+    def _reduce(self, pts):
+        """Returns min/max rows of pts, shape (m, k, 2)"""
+        r = np.arange(len(pts))
+        lo = pts[r, pts[:, :, 1].argmin(axis=1)]
+        hi = pts[r, pts[:, :, 1].argmax(axis=1)]
+        return np.hstack((lo, hi))
+
+    def _add_partial(self, pts):
+        new = self._reduce(pts[np.newaxis])[0]
+        if self.count:
+            old = self.buckets[self.nb]
+            if old[1] <= new[1]:
+                new[0:2] = old[0:2]
+            if old[3] >= new[3]:
+                new[2:4] = old[2:4]
+        self.buckets[self.nb] = new
+        self.count += len(pts)
+
+    def _merge(self):
+        a = self.buckets[0:self.nb:2]
+        b = self.buckets[1:self.nb:2]
+        new = a.copy()
+        lower = b[:, 1] < a[:, 1]
+        higher = b[:, 3] > a[:, 3]
+        new[lower, 0:2] = b[lower, 0:2]
+        new[higher, 2:4] = b[higher, 2:4]
+        partial = self.buckets[self.nb].copy()
+        self.nb = len(new)
+        self.buckets[:self.nb] = new
+        self.buckets[self.nb] = partial
+        self.k *= 2
+
+    def append(self, rows):
+        pts = np.asarray(rows, dtype=float)
+        while len(pts):
+            if self.count == 0 and len(pts) >= self.k and self.nb < self.capacity:
+                # whole buckets at once
+                m = min(len(pts) // self.k, self.capacity - self.nb)
+                self.buckets[self.nb:self.nb+m] = self._reduce(pts[:m*self.k].reshape(m, self.k, 2))
+                self.nb += m
+                pts = pts[m*self.k:]
+            else:
+                n = self.k - self.count
+                self._add_partial(pts[:n])
+                pts = pts[n:]
+
+            if self.count >= self.k:
+                self.nb += 1
+                self.count = 0
+            if self.nb == self.capacity:
+                self._merge()
+
+    @property
+    def data(self):
+        """Points to plot, ordered by position in the stream"""
+        b = self.buckets[:self.nb+bool(self.count)]
+        first = b[:, 0] <= b[:, 2]
+        pts = np.empty((len(b), 2, 2))
+        pts[:, 0] = np.where(first[:, np.newaxis], b[:, 0:2], b[:, 2:4])
+        pts[:, 1] = np.where(first[:, np.newaxis], b[:, 2:4], b[:, 0:2])
+        if self.k == 1 and not self.count:
+            return pts[:, 0]
+        return pts.reshape(-1, 2)
+
+
+class BackgroundModel(object):
+    """Background interpolated through a set of knots and evaluated on a fixed, sorted
+    grid (xgrid). The result is kept in self.out, which is updated in place.
+
+    The piecewise polynomial coefficients of the previous fit are kept, so that after
+    adding, removing or moving a knot only the grid points in the segments whose
+    polynomial actually changed are evaluated again. For 'linear' these are the two
+    segments next to the knot; for 'cubic' the spline is solved again (cheap, O(knots)),
+    but the change in coefficients dies out within a few segments of the modified knot.
+    Other kinds fall back to interpolate() over the whole grid.
+
+    Like interpolate(), grid points outside of the knots are NaN and 'cubic' falls back
+    to 'linear' for less than 4 knots."""
+
+    # relative change of a segment below which it is not evaluated again
+    tolerance = 1e-9
+
+    def __init__(self, xgrid, kind='linear'):
+        self.xgrid = np.asarray(xgrid, dtype=float)
+        self.out = np.empty_like(self.xgrid)
+        self.out.fill(np.nan)
+
+        try:
+            kind = int(kind)
+        except (TypeError, ValueError):
+            pass
+        if kind in ('linear', 'slinear', 1):
+            kind = 'linear'
+        elif kind in ('cubic', 3):
+            kind = 'cubic'
+        self.kind = kind
+
+        self.x = np.array([], dtype=float)
+        self.y = np.array([], dtype=float)
+        self.coeffs = None
+        self.covered = (0, 0)  # grid indices between first and last knot
+
+    def _fit(self, x, y):
+        """Returns piecewise polynomial coefficients, shape (order+1, len(x)-1),
+        highest power first (same layout as scipy.interpolate.PPoly)"""
+        if self.kind == 'cubic' and len(x) >= 4:
+            from scipy.interpolate import CubicSpline
+            return CubicSpline(x, y).c
+        else:
+            return np.vstack((np.diff(y) / np.diff(x), y[:-1]))
+
+    def _changed(self, x, y, c):
+        """Boolean array, True for every segment of the new fit that differs from the old one"""
+        if self.coeffs is None or self.coeffs.shape[0] != c.shape[0]:
+            return np.ones(len(x) - 1, dtype=bool)
+
+        ox = self.x
+        idx = np.clip(np.searchsorted(ox, x[:-1]), 0, len(ox) - 2)
+        same = (ox[idx] == x[:-1]) & (ox[idx+1] == x[1:])
+
+        # maximum deviation over the segment: sum(|dc_k| * h**k)
+        order = c.shape[0] - 1
+        powers = np.diff(x) ** np.arange(order, -1, -1)[:, np.newaxis]
+        dev = np.sum(np.abs(c - self.coeffs[:, idx]) * powers, axis=0)
+
+        return ~same | (dev > self.tolerance * (np.abs(y).max() + 1))
+
+    @staticmethod
+    def _evaluate(x, c, xvals):
+        seg = np.clip(np.searchsorted(x, xvals, side='right') - 1, 0, len(x) - 2)
+        dx = xvals - x[seg]
+        ret = c[0, seg]
+        for ck in c[1:]:
+            ret = ret * dx + ck[seg]
+        return ret
+
+    def update(self, x, y):
+        """Sets the knots (x sorted) and updates self.out where the background changed.
+
+        returns (lo, hi): self.out[lo:hi] contains all modified grid points"""
+        # copies, x/y may be views on a buffer that is modified later (KnotList)
+        x = np.array(x, dtype=float)
+        y = np.array(y, dtype=float)
+        g = self.xgrid
+        out = self.out
+
+        old_lo, old_hi = self.covered
+
+        if len(x) < 2:
+            out[old_lo:old_hi] = np.nan
+            self.x, self.y, self.coeffs = x, y, None
+            self.covered = (0, 0)
+            return old_lo, old_hi
+
+        lo = np.searchsorted(g, x[0], side='left')
+        hi = np.searchsorted(g, x[-1], side='right')
+
+        if self.kind not in ('linear', 'cubic'):
+            out[:] = interpolate((x, y), g, kind=self.kind)
+            self.x, self.y = x, y
+            self.covered = (lo, hi)
+            return 0, len(g)
+
+        c = self._fit(x, y)
+        segs = np.flatnonzero(self._changed(x, y, c))
+
+        # grid points that are no longer between the first and last knot
+        modified = [(old_lo, min(lo, old_hi)), (max(hi, old_lo), old_hi)]
+        for a, b in modified:
+            out[a:b] = np.nan
+
+        if len(segs):
+            a = np.searchsorted(g, x[segs[0]], side='left')
+            b = np.searchsorted(g, x[segs[-1]+1], side='right')
+            out[a:b] = self._evaluate(x, c, g[a:b])
+            modified.append((a, b))
+
+        self.x, self.y, self.coeffs = x, y, c
+        self.covered = (lo, hi)
+
+        modified = [(a, b) for a, b in modified if b > a]
+        if modified:
+            return min(a for a, b in modified), max(b for a, b in modified)
+        else:
+            return lo, lo
+
+
+def bin_pattern(x, y, err=None, binsize=0.01, mode='mean'):
+    """Bins x,y(,err) data on a regular grid of size binsize starting at min(x).
+
+    All bins are reduced at once with np.bincount, so the cost is one pass over the data
+    plus the np.digitize lookup. Empty bins are dropped. The x value of each bin is the
+    mean of the x values in it.
+
+    mode:
+        'mean':     average intensity, esd = sqrt(sum(e**2))/n
+        'sum':      summed intensity, esd = sqrt(sum(e**2))
+        'weighted': 1/e**2 weighted average, esd = 1/sqrt(sum(1/e**2)).
+                    Without esds, and for points with an esd of 0,
+                    e**2 = |y|+0.1 is used instead (counting statistics)
+
+    returns xbinned, ybinned, ebinned (ebinned is None if err is None and mode != 'weighted')
+    """
+    if mode not in ('mean', 'sum', 'weighted'):
+        raise ValueError("mode must be one of 'mean', 'sum', 'weighted'")
+
+    bins = np.arange(x.min(), x.max(), binsize)
+    nbins = len(bins)
+
+    # index 0 is unused, index nbins holds the incomplete bin at the end; both are discarded
+    digi = np.digitize(x, bins)
+
+    def binsum(weights=None):
+        return np.bincount(digi, weights=weights, minlength=nbins+1)[1:nbins]
+
+    n = binsum()
+    sel = n > 0
+    n = n[sel]
+
+    xbinned = binsum(x)[sel] / n
+
+    if mode == 'weighted':
+        var = np.abs(y) + 0.1
+        if err is not None:
+            # zero esds (e.g. steps without counts) would make the whole bin nan
+            var = np.where(err > 0, err**2, var)
+        sw = binsum(1/var)[sel]
+        ybinned = binsum(y/var)[sel] / sw
+        ebinned = 1/np.sqrt(sw)
+        return xbinned, ybinned, ebinned
+
+    ybinned = binsum(y)[sel]
+
+    if err is None:
+        ebinned = None
+    else:
+        ebinned = np.sqrt(binsum(err**2)[sel])
+
+    if mode == 'mean':
+        ybinned /= n
+        if ebinned is not None:
+            ebinned /= n
+
+    return xbinned, ybinned, ebinned
+
+
+def wavelength_info(wl):
+    """Little summary for given wavelength"""
+
+    energy = wavelength2energy(wl)
+
+    print "wavelength: {:.5f} angstrom".format(wl)
+    print "energy:     {:.5f} kev".format(energy)
+
+    dvals = 10/np.linspace(1, 10, 10)
+
+    theta2 = d2twotheta(dvals, wl)
+    qvals = 4*(np.pi/wl) * np.sin(np.radians(theta2/2))
+
+    print "\n         d        th2          q"
+    for d, th2, q in zip(dvals, theta2, qvals):
+        print "{:10.3f} {:10.3f} {:10.3f}".format(d, th2, q)
+    print
+
+
+def calc_agreement(o, c, bg=0, kind='linear'):
+    """Calculates agreement values for given data data."""
+    if np.any(bg):
+        bg = interpolate(bg.T, c.x, kind=kind)  # need linear or better here
+
+    # nearest is fast and accurate, anything else is very slow
+    oy = interpolate(o.xy, c.x, kind='nearest') - bg
+    # oe = interpolate(o.xye[:,0:3:2],c.x,kind='nearest')
+
+    rp = np.sum(np.abs(oy - c.y)) / np.sum(oy)  # profile R-value
+
+    # w = (1/oe)**2
+    # rwp = ( np.sum(w*(oy - c.y)**2) / np.sum(w*(oy)**2) )**0.5 # weighted
+    # profile R-value
+
+    return rp
+
+
+class AgreementTracker(object):
+    """Keeps the profile R-value of calc_agreement up to date while the background is
+    being edited (lines --topasbg).
+
+    The observed pattern is resampled onto the x values of the calculated pattern once.
+    After a change of the background knots (update), the background is only evaluated
+    again where it changed (see BackgroundModel), and the residual sums are corrected
+    for that range only, instead of summing over the whole pattern."""
+
+    # recalculate the sums from scratch every so often to avoid accumulating round-off
+    resum_every = 1000
+
+    def __init__(self, o, c, kind='linear'):
+        # nearest is fast and accurate, anything else is very slow
+        self.oy = interpolate(o.xy, c.x, kind='nearest')
+        self.cy = np.array(c.y, dtype=float)
+        self.model = BackgroundModel(c.x, kind=kind)
+
+        # per point contributions to sum(|oy - c.y|) and sum(oy), with oy = obs - bg
+        # zeros, so that the first _recalc subtracts nothing from the sums
+        self.num = np.zeros_like(self.cy)
+        self.den = np.zeros_like(self.cy)
+        self.sum_num = 0.0
+        self.sum_den = 0.0
+        self.nnan = 0
+
+        # background is taken as 0 with less than 2 knots, as in calc_agreement
+        self.active = False
+        self.nupdates = 0
+        self._recalc(0, len(self.cy))
+
+    def _recalc(self, lo, hi):
+        num = self.num[lo:hi]
+        den = self.den[lo:hi]
+
+        self.sum_num -= np.nansum(num)
+        self.sum_den -= np.nansum(den)
+        self.nnan -= np.count_nonzero(np.isnan(num))
+
+        if self.active:
+            den[:] = self.oy[lo:hi] - self.model.out[lo:hi]
+        else:
+            den[:] = self.oy[lo:hi]
+        num[:] = np.abs(den - self.cy[lo:hi])
+
+        self.sum_num += np.nansum(num)
+        self.sum_den += np.nansum(den)
+        self.nnan += np.count_nonzero(np.isnan(num))
+
+    def _resum(self):
+        self.sum_num = np.nansum(self.num)
+        self.sum_den = np.nansum(self.den)
+        self.nnan = np.count_nonzero(np.isnan(self.num))
+
+    @property
+    def rp(self):
+        """Profile R-value, NaN if the background does not cover the calculated pattern"""
+        if self.nnan:
+            return np.nan
+        return self.sum_num / self.sum_den
+
+    def update(self, x, y):
+        """Sets the background knots (x sorted) and returns the new Rp"""
+        lo, hi = self.model.update(x, y)
+
+        active = len(x) >= 2
+        if active != self.active:
+            self.active = active
+            lo, hi = 0, len(self.cy)
+
+        if hi > lo:
+            self._recalc(lo, hi)
+
+        self.nupdates += 1
+        if self.nupdates % self.resum_every == 0:
+            self._resum()
+
+        return self.rp
+
+
+class Data(object):
+    total = 0
+    plot_range = None
+
+    """container class for x,y, err data"""
+
+    def __init__(self, arr, name=None, quiet=False, is_ticks=False):
+        if not quiet:
+            print 'Loading data: {}\n       shape: {}'.format(name, arr.shape)
+
+        self.is_ticks = is_ticks
+
+        if self.plot_range:
+            r0, r1 = self.plot_range
+            self.arr = arr[np.logical_and(arr[:, 0] >= r0, arr[:, 0] <= r1)]
+        else:
+            self.arr = arr
+
+        try:
+            self.x = self.arr[:, 0]
+            self.y = self.arr[:, 1]
+            self.xy = self.arr[:, 0:2]
+            self.xye = self.arr[:, 0:3]
+        except IndexError:
+            raise IOError("Could not load file/data: {}".format(name))
+
+        try:
+            self.err = self.arr[:, 2]
+        except IndexError:
+            self.err = None
+            self.has_esd = False
+        else:
+            if np.all(self.err == np.nan):
+                self.has_esd = False
+                self.err = None
+            else:
+                self.has_esd = True
+
+        self.index = self.total
+        self.filename = name
+        Data.total += 1
+
+        if not quiet and not is_ticks:
+            n = len(self.x)         # observations
+            if self.has_esd:
+                w = 1/self.err**2   # weights
+            else:
+                w = 1/(np.abs(self.y)+0.1)      # weights = y^-1 if no esds
+            print '       R_exp: {:.3%}'.format(((n) / np.sum(w*self.y**2))**0.5)
+
+    def __getstate__(self):
+        """Only arr is pickled (i.e. when returned from a worker process), the x/y/err
+        views on it are recreated by __setstate__"""
+        state = self.__dict__.copy()
+        for key in ('x', 'y', 'xy', 'xye', 'err'):
+            state.pop(key, None)
+        state['arr'] = np.asarray(self.arr)  # no memmap
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+
+        self.x = self.arr[:, 0]
+        self.y = self.arr[:, 1]
+        self.xy = self.arr[:, 0:2]
+        self.xye = self.arr[:, 0:3]
+        self.err = self.arr[:, 2] if self.has_esd else None
+
+        # index is used for the plot order
+        self.index = Data.total
+        Data.total += 1
+
+    def bin(self, binsize=0.01, mode='mean'):
+        x = self.x
+        y = self.y
+        fn = self.filename
+
+        print 'Binning {} from 2th = {} - {} with a bin size of {} ({})'.format(fn, min(x), max(x), binsize, mode)
+        print
+        print 'N(x) = ', x.shape
+        print 'N(y) = ', y.shape
+
+        xbinned, ybinned, ebinned = bin_pattern(
+            x, y, err=self.err, binsize=binsize, mode=mode)
+
+        print 'N(bins) =', xbinned.shape
+        print
+
+        root, ext = os.path.splitext(self.filename)
+        name = root+'_bin_'+str(binsize)+ext
+
+        if ebinned is not None:
+            return Data(np.vstack((xbinned, ybinned, ebinned)).T, name=name)
+        else:
+            return Data(np.vstack((xbinned, ybinned)).T, name=name)
+
+    def smooth(self, window='savitzky_golay', window_len=7, order=3, suffix='_smooth'):
+        assert window in ['flat', 'hanning', 'hamming',
+                          'bartlett', 'blackman', 'savitzky_golay', 'moving_avg']
+
+        print ' >> Applying filter: {}, window: {}, order {} (SG only) to {}'.format(window, window_len, order, self.filename)
+
+        if window == 'savitzky_golay':
+            y = savitzky_golay(self.y, window_size=window_len, order=order)
+        else:
+            y = smooth(self.y, window_len=window_len, window=window)
+
+        root, ext = os.path.splitext(self.filename)
+        name = root+suffix+ext
+
+        x = np.copy(self.x)
+
+        y.shape = (-1, 1)
+        x.shape = (-1, 1)
+
+        return Data(np.hstack((x, y)), name=name)
+
+    def convert_wavelength(self, wavelength_in, wavelength_out):
+        """Converts 2theta values to a different wavelength"""
+        print
+        print " ** Convert {} from {:.4f} ANG ({:.2f} keV) to {:.4f} ANG ({:.2f} keV)".format(self.filename, wavelength_in, wavelength2energy(wavelength_in), wavelength_out, wavelength2energy(wavelength_out))
+        print
+        d = twotheta2d(self.x, wavelength_in)
+        theta2 = d2twotheta(d, wavelength_out)
+        arr = self.arr
+        arr[:, 0] = theta2
+        return Data(arr, name=self.filename)
+
+    def print_pattern(self, name=None, tag=""):
+        """print self (x,y,e) to 3 column file. If no name is given, original file is overwritten.
+        A tag can be added to modify the original filename instead (ie. data.xye -> data_binned.xye)"""
+
+        if tag:
+            tag = "_" + tag
+
+        if not name:
+            root, ext = os.path.splitext(self.filename)
+            name = root + tag + ext
+        ncols = self.xye.shape[1]
+        write_columns(name, self.xye.T, ('%15.5f',) + (' %15.5f',)*(ncols-1), nan=None)
+
+        print 'Pattern written to {}'.format(name)
+
+    def plot(self, ax):
+        ax.plot(self.x, self.y)
+
+
+def uvw_fwhm(th2, uvw):
+    """Returns peak width (fwhm) at 2theta th2, fwhm^2 = U tan^2(th) + V tan(th) + W"""
+    u, v, w = uvw
+    th_rad = np.radians(th2 / 2)
+    return (u*np.tan(th_rad)**2 + v*np.tan(th_rad) + w)**0.5
+
+
+def lorentz_polarization(twotheta):
+    """Lorentz-polarization factor for unpolarized radiation"""
+    tt = np.radians(twotheta)
+    th = tt / 2
+    return (1 + np.cos(tt)**2) / (np.sin(th)**2 * np.cos(th))
+
+
+def calc_fwhm(uvw):
+    th2 = np.linspace(0, 70, 70*50)
+
+    fwhm = uvw_fwhm(th2, uvw)
+
+    xy = np.vstack([th2, fwhm]).T
+
+    return Data(xy, 'UVW')
+
+
+def find_nearest(array, value):
+    """Find index of nearest value"""
+    idx = (np.abs(array-value)).argmin()
+    return idx
+
+
+def twotheta2d(twotheta, wavelength):
+    theta = np.radians(twotheta / 2)
+    d = wavelength / (2*np.sin(theta))
+    return d
+
+
+def d2twotheta(d, wavelength):
+    theta = np.degrees(np.arcsin((wavelength) / (2*d)))
+    return 2*theta
+
+
+def wavelength2energy(wl):
+    """Takes wavelength in Angstrom, returns energy in keV"""
+    # 1E3 from ev to kev, divide by 1E10 from angstrom to meter
+    return 1E10*planck_constant*speed_of_light/(wl*1E3*elementary_charge)
+
+
+def energy2wavelength(E):
+    """Takes wavelength in keV, returns energy in Angstrom"""
+    # 1E3 from ev to kev, divide by 1E10 from angstrom to meter
+    return 1E10*planck_constant*speed_of_light/(E*1E3*elementary_charge)
+
+
+def parse_wl(string):
+    """Parses wavelength given as a number (Angstrom), energy ('12.4kev') or anode ('cu', 'moa1')"""
+    if string.lower().endswith('kev'):
+        return energy2wavelength(float(string.lower().replace('kev', "")))
+    elif string.lower() in wavelengths:
+        return wavelengths[string.lower()]
+    else:
+        return float(string)
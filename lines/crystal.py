@@ -0,0 +1,396 @@
+#!/usr/bin/env python
+
+#    Lines - a python plotting program
+#    Copyright (C) 2015 Stef Smeets
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License along
+#    with this program; if not, write to the Free Software Foundation, Inc.,
+#    51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""Crystal structures from CIF files and their powder diffraction lines.
+
+Only what is needed for the cif files in zeolite_database (and similar ones) is
+read: the unit cell, the symmetry operators (_symmetry_equiv_pos_as_xyz) and
+the atom sites with occupancy and U_iso. Structure factors are calculated for
+all unique reflections at once, as a matrix product of the reflections with the
+atom coordinates.
+
+The result of Crystal.sticks() does not depend on the wavelength: the lines are
+given as d-spacings, with intensity mult*|F|^2 (no Lorentz-polarization)."""
+
+import os
+import re
+
+import numpy as np
+
+from core import d2twotheta, uvw_fwhm, lorentz_polarization
+
+# Cromer-Mann coefficients a1, b1, a2, b2, a3, b3, a4, b4, c
+# International Tables for Crystallography Vol. C, Table 6.1.1.4
+scattering_factors = {
+    'H':  (0.489918, 20.6593, 0.262003, 7.74039, 0.196767, 49.5519, 0.049879, 2.20159, 0.001305),
+    'Li': (1.1282, 3.9546, 0.7508, 1.0524, 0.6175, 85.3905, 0.4653, 168.261, 0.0377),
+    'Be': (1.5919, 43.6427, 1.1278, 1.8623, 0.5391, 103.483, 0.7029, 0.5420, 0.0385),
+    'B':  (2.0545, 23.2185, 1.3326, 1.0210, 1.0979, 60.3498, 0.7068, 0.1403, -0.1932),
+    'C':  (2.3100, 20.8439, 1.0200, 10.2075, 1.5886, 0.5687, 0.8650, 51.6512, 0.2156),
+    'N':  (12.2126, 0.0057, 3.1322, 9.8933, 2.0125, 28.9975, 1.1663, 0.5826, -11.529),
+    'O':  (3.0485, 13.2771, 2.2868, 5.7011, 1.5463, 0.3239, 0.8670, 32.9089, 0.2508),
+    'F':  (3.5392, 10.2825, 2.6412, 4.2944, 1.5170, 0.2615, 1.0243, 26.1476, 0.2776),
+    'Na': (4.7626, 3.2850, 3.1736, 8.8422, 1.2674, 0.3136, 1.1128, 129.424, 0.6760),
+    'Mg': (5.4204, 2.8275, 2.1735, 79.2611, 1.2269, 0.3808, 2.3073, 7.1937, 0.8584),
+    'Al': (6.4202, 3.0387, 1.9002, 0.7426, 1.5936, 31.5472, 1.9646, 85.0886, 1.1151),
+    'Si': (6.2915, 2.4386, 3.0353, 32.3337, 1.9891, 0.6785, 1.5410, 81.6937, 1.1407),
+    'P':  (6.4345, 1.9067, 4.1791, 27.1570, 1.7800, 0.5260, 1.4908, 68.1645, 1.1149),
+    'S':  (6.9053, 1.4679, 5.2034, 22.2151, 1.4379, 0.2536, 1.5863, 56.1720, 0.8669),
+    'Cl': (11.4604, 0.0104, 7.1964, 1.1662, 6.2556, 18.5194, 1.6455, 47.7784, -9.5574),
+    'K':  (8.2186, 12.7949, 7.4398, 0.7748, 1.0519, 213.187, 0.8659, 41.6841, 1.4228),
+    'Ca': (8.6266, 10.4421, 7.3873, 0.6599, 1.5899, 85.7484, 1.0211, 178.437, 1.3751),
+    'Mn': (11.2819, 5.3409, 7.3573, 0.3432, 3.0193, 17.8674, 2.2441, 83.7543, 1.0896),
+    'Co': (12.2841, 4.2791, 7.3409, 0.2784, 4.0034, 13.5359, 2.3488, 71.1692, 1.0118),
+    'Ni': (12.8376, 3.8785, 7.2920, 0.2565, 4.4438, 12.1763, 2.3800, 66.3421, 1.0341),
+    'Cu': (13.3380, 3.5828, 7.1676, 0.2470, 5.6158, 11.3966, 1.6735, 64.8126, 1.1910),
+    'Zn': (14.0743, 3.2655, 7.0318, 0.2333, 5.1652, 10.3163, 2.4100, 58.7097, 1.3041),
+    'Ga': (15.2354, 3.0669, 6.7006, 0.2412, 4.3591, 10.7805, 2.9623, 61.4135, 1.7189),
+    'Ge': (16.0816, 2.8509, 6.3747, 0.2516, 3.7068, 11.4468, 3.6830, 54.7625, 2.1313),
+    'As': (16.6723, 2.6345, 6.0701, 0.2647, 3.4313, 12.9479, 4.2779, 47.7972, 2.5310),
+    'Rb': (17.1784, 1.7888, 9.6435, 17.3151, 5.1399, 0.2748, 1.5292, 164.934, 3.4873),
+    'Sr': (17.5663, 1.5564, 9.8184, 14.0988, 5.4220, 0.1664, 2.6694, 132.376, 2.5064),
+    'Cs': (20.3892, 3.5690, 19.1062, 0.3107, 10.6620, 24.3879, 1.4953, 213.904, 3.3352),
+    'Ba': (20.3361, 3.2160, 19.2970, 0.2756, 10.8880, 20.2073, 2.6959, 167.202, 2.7731),
+    'Tl': (27.5446, 0.65515, 19.1584, 8.70751, 15.5380, 1.96347, 5.52593, 45.8149, 13.1746),
+    'Pb': (31.0617, 0.6902, 13.0637, 2.3576, 18.4420, 8.6180, 5.9696, 47.2579, 13.4118),
+}
+
+# a few cif files only give the space group symbol
+spacegroup_ops = {
+    'P1': ('x,y,z',),
+    'P-1': ('x,y,z', '-x,-y,-z'),
+    'P21/m': ('x,y,z', '-x,y+1/2,-z', '-x,-y,-z', 'x,-y+1/2,z'),
+    'C121': ('x,y,z', '-x,y,-z', 'x+1/2,y+1/2,z', '-x+1/2,y+1/2,-z'),
+}
+spacegroup_ops['C2'] = spacegroup_ops['C121']
+
+# reflections per block in the structure factor calculation
+blocksize = 4096
+
+# profile points per block in pseudo_voigt
+profile_blocksize = 2**22
+
+
+def strip_esd(value):
+    """'0.1234(5)' -> 0.1234"""
+    return float(value.split('(')[0])
+
+
+def element_symbol(type_symbol):
+    """Returns element from cif type symbol, i.e. 'O2-(H2O)' -> 'O', 'Si4+' -> 'Si'.
+    'T' (tetrahedral atom) is taken as Si."""
+    m = re.match(r'[A-Z][a-z]?', type_symbol.strip().capitalize())
+    if not m:
+        raise ValueError('Cannot interpret atom type {}'.format(type_symbol))
+    element = m.group()
+    if element == 'T':
+        element = 'Si'
+    if element == 'D':
+        element = 'H'
+    return element
+
+
+def parse_symop(string):
+    """Parses symmetry operator like '-x+1/2,y,z-1/2' and returns rotation (3x3) and translation"""
+    r = np.zeros((3, 3))
+    t = np.zeros(3)
+
+    parts = string.replace(' ', '').lower().split(',')
+    if len(parts) != 3:
+        raise ValueError('Cannot interpret symmetry operator {}'.format(string))
+
+    for i, part in enumerate(parts):
+        for sign, term in re.findall(r'([+-]?)([^+-]+)', part):
+            sign = -1.0 if sign == '-' else 1.0
+            if term[-1] in 'xyz':
+                coeff = term[:-1].rstrip('*')
+                r[i, 'xyz'.index(term[-1])] += sign * (float(coeff) if coeff else 1.0)
+            elif '/' in term:
+                num, den = term.split('/')
+                t[i] += sign * float(num) / float(den)
+            else:
+                t[i] += sign * float(term)
+    return r, t
+
+
+def parse_cif(fn):
+    """Minimal cif reader, returns dict with single items and dict with loops (tag -> list of values)"""
+    items = {}
+    loops = {}
+
+    tags = None
+    values = None
+
+    def close_loop():
+        if tags:
+            n = len(tags)
+            for j, tag in enumerate(tags):
+                loops[tag] = values[j::n]
+
+    for line in open(fn):
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+
+        if line == 'loop_':
+            close_loop()
+            tags, values = [], None
+            continue
+
+        if line.startswith('_'):
+            if tags is not None and values is None:
+                tags.append(line.split()[0])
+                continue
+            close_loop()
+            tags = values = None
+            split = line.split(None, 1)
+            if len(split) == 2:
+                items[split[0]] = split[1].strip().strip('\'"')
+            continue
+
+        if line.startswith('data_'):
+            items['data_'] = line[5:]
+            continue
+
+        if tags is not None:
+            if values is None:
+                values = []
+            if len(tags) == 1:
+                values.append(line.strip('\'"'))
+            else:
+                values.extend(v.strip('\'"') for v in re.findall(r"'[^']*'|\"[^\"]*\"|\S+", line))
+
+    close_loop()
+    return items, loops
+
+
+class Crystal(object):
+    """Unit cell, symmetry and atoms (elements, fractional coordinates, occupancy, U_iso)"""
+
+    def __init__(self, cell, symops, elements, xyz, occ, uiso, name=''):
+        self.cell = np.array(cell, dtype=float)
+        self.symops = symops
+        self.elements = list(elements)
+        self.xyz = np.array(xyz, dtype=float).reshape(-1, 3)
+        self.occ = np.array(occ, dtype=float)
+        self.uiso = np.array(uiso, dtype=float)
+        self.name = name
+
+    @classmethod
+    def from_cif(cls, fn):
+        items, loops = parse_cif(fn)
+
+        cell = [strip_esd(items[key]) for key in ('_cell_length_a', '_cell_length_b', '_cell_length_c',
+                                                  '_cell_angle_alpha', '_cell_angle_beta', '_cell_angle_gamma')]
+
+        ops = loops.get('_symmetry_equiv_pos_as_xyz') or loops.get('_space_group_symop_operation_xyz')
+        if not ops:
+            spgr = items.get('_symmetry_space_group_name_H-M', '').replace(' ', '')
+            if spgr not in spacegroup_ops:
+                raise ValueError('{}: no symmetry operators and unknown space group {}'.format(fn, spgr))
+            ops = spacegroup_ops[spgr]
+        symops = [parse_symop(op) for op in ops]
+
+        labels = loops['_atom_site_label']
+        types = loops.get('_atom_site_type_symbol', labels)
+        elements = [element_symbol(typ) for typ in types]
+        xyz = np.array([[strip_esd(v) for v in loops[key]]
+                        for key in ('_atom_site_fract_x', '_atom_site_fract_y', '_atom_site_fract_z')]).T
+        occ = [strip_esd(v) for v in loops.get('_atom_site_occupancy', ['1.0']*len(labels))]
+        if '_atom_site_U_iso_or_equiv' in loops:
+            uiso = [strip_esd(v) for v in loops['_atom_site_U_iso_or_equiv']]
+        elif '_atom_site_B_iso_or_equiv' in loops:
+            uiso = [strip_esd(v) / (8*np.pi**2) for v in loops['_atom_site_B_iso_or_equiv']]
+        else:
+            uiso = [0.0]*len(labels)
+
+        name = os.path.splitext(os.path.basename(fn))[0]
+        return cls(cell, symops, elements, xyz, occ, uiso, name=name)
+
+    def metric_tensor(self):
+        a, b, c, al, be, ga = self.cell
+        cal, cbe, cga = np.cos(np.radians([al, be, ga]))
+        return np.array([[a*a,     a*b*cga, a*c*cbe],
+                         [a*b*cga, b*b,     b*c*cal],
+                         [a*c*cbe, b*c*cal, c*c]])
+
+    def expand(self):
+        """Applies the symmetry operators to the atoms. Atoms on special positions are
+        only kept once. Returns element index, positions, occupancy and U_iso of all atoms"""
+        rot = np.array([r for r, t in self.symops])
+        trans = np.array([t for r, t in self.symops])
+
+        # (atoms, ops, 3)
+        pos = np.einsum('oij,aj->aoi', rot, self.xyz) + trans
+        pos %= 1.0
+
+        idx, allpos = [], []
+        for i, p in enumerate(pos):
+            keys = np.round(p * 1000).astype(int) % 1000
+            _, first = np.unique(keys, axis=0, return_index=True)
+            idx.append(np.full(len(first), i, dtype=int))
+            allpos.append(p[first])
+        idx = np.concatenate(idx)
+        return idx, np.vstack(allpos)
+
+    def reflections(self, dmin):
+        """Returns unique reflections (Laue class of the symmetry operators) up to dmin,
+        and their multiplicities and d-spacings"""
+        g = self.metric_tensor()
+        gstar = np.linalg.inv(g)
+
+        hmax = np.floor(np.sqrt(np.diag(g)) / dmin).astype(int)
+        h, k, l = np.mgrid[-hmax[0]:hmax[0]+1, -hmax[1]:hmax[1]+1, -hmax[2]:hmax[2]+1]
+        hkl = np.column_stack((h.ravel(), k.ravel(), l.ravel()))
+
+        inv_d2 = np.einsum('ij,jk,ik->i', hkl, gstar, hkl)
+        sel = (inv_d2 > 0) & (inv_d2 <= 1.0 / dmin**2)
+        hkl = hkl[sel]
+
+        # reflections are equivalent under h' = h.R for all rotations R and -R (Friedel),
+        # the representative is the one with the largest key. key(h.R) = h.(R.w) + const
+        base = 2*hmax + 1
+        w = np.array([base[1]*base[2], base[2], 1])
+        offset = hmax.dot(w)
+
+        rots = set()
+        for r, t in self.symops:
+            r = np.rint(r).astype(int)
+            rots.add(tuple(r.dot(w)))
+            rots.add(tuple(-r.dot(w)))
+
+        rep = hkl.dot(w)
+        for rw in rots:
+            np.maximum(rep, hkl.dot(rw), out=rep)
+
+        unique, first, mult = np.unique(rep, return_index=True, return_counts=True)
+        hkl = np.column_stack(((unique + offset) // w[0] - hmax[0],
+                               (unique + offset) % w[0] // w[1] - hmax[1],
+                               (unique + offset) % w[1] - hmax[2]))
+        d = 1.0 / np.sqrt(inv_d2[sel][first])
+        return hkl, mult, d
+
+    def structure_factors(self, hkl, d):
+        """Returns |F|^2 for reflections hkl with d-spacings d"""
+        idx, pos = self.expand()
+        occ = self.occ[idx]
+        biso = 8*np.pi**2 * self.uiso[idx]
+
+        elements = sorted(set(self.elements))
+        for e in elements:
+            if e not in scattering_factors:
+                raise ValueError('{}: no scattering factor for element {}'.format(self.name, e))
+        elem = np.array([elements.index(e) for e in self.elements])[idx]
+
+        # with an inversion centre at the origin, the sine terms cancel
+        centric = any(np.allclose(r, -np.eye(3)) and np.allclose(t - np.rint(t), 0) for r, t in self.symops)
+
+        s2 = 1.0 / (2*d)**2
+        f2 = np.empty(len(hkl))
+        for i in range(0, len(hkl), blocksize):
+            s2_block = s2[i:i+blocksize]
+
+            form = np.empty((len(s2_block), len(elements)))
+            for j, e in enumerate(elements):
+                coeffs = scattering_factors[e]
+                a, b, c = np.array(coeffs[0:8:2]), np.array(coeffs[1:8:2]), coeffs[8]
+                form[:, j] = (a * np.exp(-np.outer(s2_block, b))).sum(axis=1) + c
+
+            weight = form[:, elem] * occ * np.exp(-np.outer(s2_block, biso))
+            phase = 2*np.pi * hkl[i:i+blocksize].dot(pos.T)
+            fr = (weight * np.cos(phase)).sum(axis=1)
+            if centric:
+                f2[i:i+blocksize] = fr*fr
+            else:
+                fi = (weight * np.sin(phase)).sum(axis=1)
+                f2[i:i+blocksize] = fr*fr + fi*fi
+        return f2
+
+    def sticks(self, dmin=1.0, merge=1e-5):
+        """Returns d-spacings (descending) and intensities mult*|F|^2 of the diffraction lines
+        down to dmin. Lines within a relative distance merge are added, absent lines are removed"""
+        hkl, mult, d = self.reflections(dmin)
+        intensity = mult * self.structure_factors(hkl, d)
+
+        keys = np.round(np.log(d) / merge).astype(int)
+        keys, inverse = np.unique(keys, return_inverse=True)
+        intensity = np.bincount(inverse, weights=intensity)
+        d = np.bincount(inverse, weights=d) / np.bincount(inverse)
+
+        sel = intensity > 1e-6 * intensity.max()
+        order = np.argsort(d[sel])[::-1]
+        return d[sel][order], intensity[sel][order]
+
+    def pattern(self, wl=1.0, start=2.0, stop=50.0, step=0.01, uvw=(0.0, 0.0, 0.0025), eta=0.5, peak_range=25):
+        """Returns powder pattern (2theta, intensity) at wavelength wl. The peak width
+        follows fwhm^2 = U tan^2(th) + V tan(th) + W"""
+        dmin = wl / (2*np.sin(np.radians(min(stop + step, 179.0) / 2)))
+        d, intensity = self.sticks(dmin=dmin)
+        return stick_pattern(d, intensity, wl=wl, start=start, stop=stop, step=step,
+                             uvw=uvw, eta=eta, peak_range=peak_range)
+
+
+def stick_pattern(d, intensity, wl=1.0, start=2.0, stop=50.0, step=0.01, uvw=(0.0, 0.0, 0.0025), eta=0.5, peak_range=25):
+    """Returns powder pattern (2theta, intensity) at wavelength wl of lines with d-spacings d
+    and intensities (without Lorentz-polarization), see Crystal.pattern"""
+    x = np.arange(start, stop + step/2, step)
+
+    d = np.asarray(d, dtype=float)
+    sel = d > wl / 2
+    twotheta = d2twotheta(d[sel], wl)
+    intensity = np.asarray(intensity, dtype=float)[sel] * lorentz_polarization(twotheta)
+
+    # peaks narrower than a step would fall between the points
+    fwhm = np.maximum(uvw_fwhm(twotheta, uvw), step)
+
+    return x, pseudo_voigt(x, twotheta, intensity, fwhm, eta=eta, peak_range=peak_range)
+
+
+def pseudo_voigt(x, centers, intensities, fwhm, eta=0.5, peak_range=25):
+    """Returns the sum of pseudo-Voigt peaks (area = intensity, fraction eta Lorentzian) on
+    grid x (sorted). Every peak is only evaluated within peak_range*fwhm of its centre"""
+    centers = np.asarray(centers, dtype=float)
+    intensities = np.asarray(intensities, dtype=float)
+    fwhm = np.broadcast_to(np.asarray(fwhm, dtype=float), centers.shape)
+
+    y = np.zeros(len(x))
+
+    lo = np.searchsorted(x, centers - peak_range*fwhm, side='left')
+    hi = np.searchsorted(x, centers + peak_range*fwhm, side='right')
+    counts = hi - lo
+
+    # blocks of peaks with a limited number of points in total
+    bounds = np.searchsorted(np.cumsum(counts), np.arange(profile_blocksize, counts.sum(), profile_blocksize))
+    for peaks in np.split(np.arange(len(centers)), np.unique(bounds)):
+        n = counts[peaks]
+        total = n.sum()
+        if not total:
+            continue
+        peak = np.repeat(peaks, n)
+        idx = np.arange(total) - np.repeat(np.cumsum(n) - n, n) + np.repeat(lo[peaks], n)
+
+        hw = fwhm[peak]
+        z = (x[idx] - centers[peak]) / hw
+        gauss = np.sqrt(4*np.log(2) / np.pi) / hw * np.exp(-4*np.log(2) * z*z)
+        lorentz = 2 / (np.pi * hw) / (1 + 4*z*z)
+        profile = intensities[peak] * (eta*lorentz + (1-eta)*gauss)
+
+        y += np.bincount(idx, weights=profile, minlength=len(x))
+
+    return y
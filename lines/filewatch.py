@@ -0,0 +1,168 @@
+#!/usr/bin/env python
+
+#    Lines - a python plotting program
+#    Copyright (C) 2015 Stef Smeets
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License along
+#    with this program; if not, write to the Free Software Foundation, Inc.,
+#    51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""File change notification for lines --monitor.
+
+On Linux, inotify is used (through ctypes, no extra dependencies), so that
+checking for changes is a non-blocking read on a file descriptor. Elsewhere, or
+if inotify is not available, the file is polled with os.stat.
+
+Refinement programs often write their output in several bursts, or truncate the
+file first. A change is therefore only reported once the file has not been
+touched for settle_time seconds and its size is the same on two consecutive
+checks."""
+
+import os
+import sys
+import time
+import errno
+import struct
+
+# inotify constants from <sys/inotify.h>
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+EVENT_HEADER = struct.Struct('iIII')
+
+
+class PollingWatcher(object):
+    """Watches path by comparing mtime and size on every call to changed()"""
+
+    def __init__(self, path, settle_time=0.2):
+        self.path = path
+        self.settle_time = settle_time
+
+        self.pending = False
+        self.last_event = 0
+        self.last_size = None
+
+        self.stat = self._stat()
+
+    def _stat(self):
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            return None
+        return st.st_mtime, st.st_size
+
+    def _size(self):
+        try:
+            return os.path.getsize(self.path)
+        except OSError:
+            return None
+
+    def poll(self):
+        """Returns True if the file was touched since the last call"""
+        stat = self._stat()
+        if stat != self.stat:
+            self.stat = stat
+            return True
+        return False
+
+    def changed(self):
+        """Non-blocking. Returns True once after the file has changed and the write has finished"""
+        now = time.time()
+
+        if self.poll():
+            self.pending = True
+            self.last_event = now
+            self.last_size = self._size()
+            return False
+
+        if not self.pending or now - self.last_event < self.settle_time:
+            return False
+
+        size = self._size()
+        if not size or size != self.last_size:
+            # still being written (or truncated), wait another settle_time
+            self.last_event = now
+            self.last_size = size
+            return False
+
+        self.pending = False
+        return True
+
+    def close(self):
+        pass
+
+
+class InotifyWatcher(PollingWatcher):
+    """Watches path with inotify. The directory is watched rather than the file, so
+    that files that are replaced (written to a temporary file and renamed) are followed"""
+
+    def __init__(self, path, settle_time=0.2):
+        import ctypes
+        import ctypes.util
+
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+
+        drc = os.path.dirname(os.path.abspath(path))
+        mask = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+        if libc.inotify_add_watch(self.fd, drc, mask) < 0:
+            os.close(self.fd)
+            raise OSError(ctypes.get_errno(), 'inotify_add_watch failed')
+
+        self.name = os.path.basename(path)
+
+        super(InotifyWatcher, self).__init__(path, settle_time=settle_time)
+
+    def _stat(self):
+        return None
+
+    def poll(self):
+        """Reads all queued events, returns True if any of them concern the watched file"""
+        touched = False
+        while True:
+            try:
+                buf = os.read(self.fd, 65536)
+            except OSError, e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return touched
+                raise
+
+            offset = 0
+            while offset < len(buf):
+                wd, mask, cookie, length = EVENT_HEADER.unpack_from(buf, offset)
+                offset += EVENT_HEADER.size
+                name = buf[offset:offset+length].rstrip('\0')
+                offset += length
+                if name == self.name:
+                    touched = True
+
+    def close(self):
+        os.close(self.fd)
+
+
+def watch_file(path, settle_time=0.2):
+    """Returns a watcher for path, using inotify if available"""
+    if sys.platform.startswith('linux'):
+        try:
+            return InotifyWatcher(path, settle_time=settle_time)
+        except (OSError, AttributeError):
+            # AttributeError: libc without inotify_init1
+            pass
+    return PollingWatcher(path, settle_time=settle_time)
@@ -0,0 +1,236 @@
+#!/usr/bin/env python
+
+#    Lines - a python plotting program
+#    Copyright (C) 2015 Stef Smeets
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License along
+#    with this program; if not, write to the Free Software Foundation, Inc.,
+#    51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""Smoothing filters for patterns.
+
+The filter coefficients only depend on the filter settings, not on the data, so
+they are calculated once and kept in a small LRU cache. All filters work along
+one axis of an array, so that a stack of patterns (one per row) is filtered in
+a single call."""
+
+from collections import OrderedDict
+
+import numpy as np
+
+# number of coefficient sets / kernels kept in memory
+cache_size = 32
+
+# kernels longer than this are convolved using FFT
+fft_threshold = 150
+
+# window functions for smooth(), called with the window length
+windows = {'flat': np.ones,
+           'moving_avg': np.ones,
+           'hanning': np.hanning,
+           'hamming': np.hamming,
+           'bartlett': np.bartlett,
+           'blackman': np.blackman}
+
+_savgol_cache = OrderedDict()
+_kernel_cache = OrderedDict()
+
+
+def _cached(lru, key, calc):
+    """Returns lru[key], calculated with calc() if it is not in the cache"""
+    try:
+        value = lru.pop(key)
+    except KeyError:
+        value = calc()
+        value.flags.writeable = False
+        if len(lru) >= cache_size:
+            lru.popitem(last=False)
+    lru[key] = value
+    return value
+
+
+def savgol_coeffs(window_size, order, deriv=0):
+    """Returns the (read-only) Savitzky-Golay convolution coefficients for the
+    given window size, polynomial order and derivative. Results are cached."""
+    def calc():
+        half_window = (window_size - 1) // 2
+        # Vandermonde matrix of the window, row k is [k**0, k**1, .. k**order]
+        b = np.vander(np.arange(-half_window, half_window+1, dtype=float), order+1, increasing=True)
+        return np.linalg.pinv(b)[deriv]
+
+    return _cached(_savgol_cache, (window_size, order, deriv), calc)
+
+
+def window_kernel(window, window_len):
+    """Returns the (read-only) normalized kernel of window (see windows) with
+    length window_len. Results are cached."""
+    if window not in windows:
+        raise ValueError("Window is one of {}".format(", ".join(repr(w) for w in sorted(windows))))
+
+    def calc():
+        w = np.asarray(windows[window](window_len), dtype=float)
+        return w / w.sum()
+
+    return _cached(_kernel_cache, (window, window_len), calc)
+
+
+def convolve(y, kernel, axis=-1):
+    """Convolution of y with kernel along axis, truncated to the length of y
+    (as scipy.signal.lfilter). Short kernels are applied directly, long ones
+    using FFT (see fft_threshold)"""
+    y = np.asarray(y, dtype=float)
+    if len(kernel) <= fft_threshold:
+        from scipy.signal import lfilter
+        return lfilter(kernel, 1.0, y, axis=axis)
+
+    from scipy.fftpack import next_fast_len
+    n = y.shape[axis]
+    # long enough that the circular convolution does not wrap around
+    nfft = next_fast_len(n + len(kernel) - 1)
+    fy = np.fft.rfft(y, nfft, axis=axis)
+    shape = [1] * y.ndim
+    shape[axis] = -1
+    fy *= np.fft.rfft(kernel, nfft).reshape(shape)
+    y = np.fft.irfft(fy, nfft, axis=axis)
+    return np.take(y, np.arange(n), axis=axis)
+
+
+def smooth(x, window_len=11, window='hanning', axis=-1):
+    """smooth the data using a window with requested size.
+
+    This method is based on the convolution of a scaled window with the signal.
+    The signal is prepared by introducing reflected copies of the signal 
+    (with the window size) in both ends so that transient parts are minimized
+    in the begining and end part of the output signal.
+
+    input:
+        x: the input signal, or a stack of signals
+        window_len: the dimension of the smoothing window; should be an odd integer
+        window: the type of window from 'flat', 'hanning', 'hamming', 'bartlett', 'blackman'
+            flat (or moving_avg) window will produce a moving average smoothing.
+        axis: the axis of x along which to smooth
+
+    output:
+        the smoothed signal
+
+    example:
+
+    t=linspace(-2,2,0.1)
+    x=sin(t)+randn(len(t))*0.1
+    y=smooth(x)
+
+    see also:
+
+    numpy.hanning, numpy.hamming, numpy.bartlett, numpy.blackman, numpy.convolve
+    scipy.signal.lfilter
+
+    FROM: http://www.scipy.org/Cookbook/SignalSmooth
+    """
+    x = np.moveaxis(np.asarray(x, dtype=float), axis, -1)
+
+    if x.shape[-1] < window_len:
+        raise ValueError("Input vector needs to be bigger than window size.")
+
+    if window_len < 3:
+        return np.moveaxis(x, -1, axis)
+
+    kernel = window_kernel(window, window_len)
+
+    first = x[..., :1]
+    last = x[..., -1:]
+    s = np.concatenate((2*first - x[..., window_len-1::-1], x, 2*last - x[..., -1:-window_len:-1]), axis=-1)
+
+    # the centered part of the convolution, without the padding
+    start = (window_len - 1) // 2 + window_len
+    y = convolve(s, kernel)[..., start:start + x.shape[-1]]
+
+    return np.moveaxis(y, -1, axis)
+
+
+def savitzky_golay(y, window_size=11, order=2, deriv=0, axis=-1):
+    r"""Smooth (and optionally differentiate) data with a Savitzky-Golay filter.
+    The Savitzky-Golay filter removes high frequency noise from data.
+    It has the advantage of preserving the original shape and
+    features of the signal better than other types of filtering
+    approaches, such as moving averages techhniques.
+    Parameters
+    ----------
+    y : array_like, shape (N,) or (..., N, ...)
+        the values of the time history of the signal, or a stack of them
+    window_size : int
+        the length of the window. Must be an odd integer number.
+    order : int
+        the order of the polynomial used in the filtering.
+        Must be less then `window_size` - 1.
+    deriv: int
+        the order of the derivative to compute (default = 0 means only smoothing)
+    axis: int
+        the axis of y along which the filter is applied (default = -1)
+    Returns
+    -------
+    ys : ndarray, same shape as y
+        the smoothed signal (or it's n-th derivative).
+    Notes
+    -----
+    The Savitzky-Golay is a type of low-pass filter, particularly
+    suited for smoothing noisy data. The main idea behind this
+    approach is to make for each point a least-square fit with a
+    polynomial of high order over a odd-sized window centered at
+    the point.
+    Examples
+    --------
+    t = np.linspace(-4, 4, 500)
+    y = np.exp( -t**2 ) + np.random.normal(0, 0.05, t.shape)
+    ysg = savitzky_golay(y, window_size=31, order=4)
+    import matplotlib.pyplot as plt
+    plt.plot(t, y, label='Noisy signal')
+    plt.plot(t, np.exp(-t**2), 'k', lw=1.5, label='Original signal')
+    plt.plot(t, ysg, 'r', label='Filtered signal')
+    plt.legend()
+    plt.show()
+    References
+    ----------
+    .. [1] A. Savitzky, M. J. E. Golay, Smoothing and Differentiation of
+       Data by Simplified Least Squares Procedures. Analytical
+       Chemistry, 1964, 36 (8), pp 1627-1639.
+    .. [2] Numerical Recipes 3rd Edition: The Art of Scientific Computing
+       W.H. Press, S.A. Teukolsky, W.T. Vetterling, B.P. Flannery
+       Cambridge University Press ISBN-13: 9780521880688
+
+    FROM: http://www.scipy.org/Cookbook/SavitzkyGolay
+    """
+    try:
+        window_size = np.abs(np.int(window_size))
+        order = np.abs(np.int(order))
+    except ValueError:
+        raise ValueError("window_size and order have to be of type int")
+    if window_size % 2 != 1 or window_size < 1:
+        raise TypeError("window_size size must be a positive odd number")
+    if window_size < order + 2:
+        raise TypeError("window_size is too small for the polynomials order")
+
+    half_window = (window_size - 1) // 2
+    m = savgol_coeffs(window_size, order, deriv)
+
+    # pad the signal at the extremes with
+    # values taken from the signal itself
+    y = np.moveaxis(np.asarray(y, dtype=float), axis, -1)
+    first = y[..., :1]
+    last = y[..., -1:]
+    firstvals = first - np.abs(y[..., half_window:0:-1] - first)
+    lastvals = last + np.abs(y[..., -2:-half_window-2:-1] - last)
+    y = np.concatenate((firstvals, y, lastvals), axis=-1)
+
+    # the first window_size-1 points of the convolution are incomplete
+    ys = convolve(y, m)[..., window_size-1:]
+    return np.moveaxis(ys, -1, axis)
@@ -0,0 +1,219 @@
+#!/usr/bin/env python
+
+#    Lines - a python plotting program
+#    Copyright (C) 2015 Stef Smeets
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License along
+#    with this program; if not, write to the Free Software Foundation, Inc.,
+#    51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""Precomputed diffraction lines and powder patterns of the zeolite_database.
+
+All structures are stored in one file (zeolite_database/library.bin), which is
+built once with `lines_library` (or library.build()). Layout:
+
+    'LINESLIB' + header length (uint64, little endian)
+    json header: wavelength/profile settings, and for every framework code the
+                 rows [start, stop) of its lines and of its profile
+    float32 rows (d, intensity)
+
+Both the lines (intensity mult*|F|^2) and the profiles are stored against d.
+The profiles are calculated at the wavelength in the settings, and are returned
+as they are for that wavelength. For any other wavelength, the pattern is
+calculated from the stored lines, so that the Lorentz-polarization and the peak
+widths are those of the requested wavelength. As the lines are only stored down
+to dmin, such a pattern stops at the 2theta of dmin if that is below the stop
+of the settings. The data are memory mapped, so reading a pattern only touches
+its own rows."""
+
+import os
+import glob
+import json
+import struct
+import argparse
+
+import numpy as np
+
+from core import LINESDIR, Data, d2twotheta, twotheta2d
+
+LIBRARY = os.path.join(LINESDIR, 'zeolite_database', 'library.bin')
+
+MAGIC = 'LINESLIB'
+HEADER = struct.Struct('<8sQ')
+
+# settings for the profiles, FOCUS-like, but with a peak width usable at 0.01 step
+profile_settings = {'wl': 1.0, 'start': 2.0, 'stop': 50.0, 'step': 0.01,
+                    'uvw': (0.0, 0.0, 0.0025), 'eta': 0.5}
+
+# lines are calculated down to this d-spacing
+dmin = 1.0
+
+_library = None
+
+
+def framework_code(fn):
+    """MFI0.cif -> MFI, FAU1.cif -> FAU1"""
+    name = os.path.splitext(os.path.basename(fn))[0]
+    if name.endswith('0'):
+        name = name[:-1]
+    return name
+
+
+class Library(object):
+    """Memory mapped library file, see module docstring"""
+
+    def __init__(self, fn=LIBRARY):
+        with open(fn, 'rb') as f:
+            magic, length = HEADER.unpack(f.read(HEADER.size))
+            if magic != MAGIC:
+                raise IOError('{} is not a library file'.format(fn))
+            self.header = json.loads(f.read(length))
+
+        self.fn = fn
+        self.entries = self.header['entries']
+        self.rows = np.memmap(fn, dtype='<f4', mode='r', offset=HEADER.size + length,
+                              shape=(self.header['rows'], 2))
+
+    def __contains__(self, code):
+        return code.upper() in self.entries
+
+    def codes(self):
+        return sorted(self.entries)
+
+    def lines(self, code):
+        """Returns d-spacings (descending) and intensities (mult*|F|^2)"""
+        start, stop = self.entries[code.upper()][0:2]
+        rows = self.rows[start:stop]
+        return rows[:, 0], rows[:, 1]
+
+    def pattern(self, code, wl=None):
+        """Returns Data with the powder pattern of code at wavelength wl
+        (default: the wavelength the profiles were calculated for)"""
+        s = self.header['settings']
+        if wl is not None and abs(wl - s['wl']) > 1e-6:
+            from crystal import stick_pattern
+            d, intensity = self.lines(code)
+            stop = min(s['stop'], d2twotheta(self.header['dmin'], wl))
+            x, y = stick_pattern(d, intensity, wl=wl, start=s['start'], stop=stop, step=s['step'],
+                                 uvw=s['uvw'], eta=s['eta'])
+            return Data(np.column_stack((x, y)), name=code.upper())
+
+        start, stop = self.entries[code.upper()][2:4]
+        rows = self.rows[start:stop]
+        wl = s['wl']
+
+        sel = rows[:, 0] > wl / 2
+        xy = np.empty((sel.sum(), 2))
+        xy[:, 0] = d2twotheta(rows[sel, 0], wl)
+        xy[:, 1] = rows[sel, 1]
+        return Data(xy, name=code.upper())
+
+
+def get_library():
+    """Returns the Library, or None if it has not been built"""
+    global _library
+    if _library is None and os.path.exists(LIBRARY):
+        try:
+            _library = Library(LIBRARY)
+        except (IOError, ValueError, KeyError), e:
+            print ' >> Could not read {}: {}'.format(LIBRARY, e)
+    return _library
+
+
+def cif_lines(fn, dmin=dmin):
+    """Returns d-spacings (descending) and intensities (mult*|F|^2, without
+    Lorentz-polarization) of the lines of cif fn down to dmin"""
+    from crystal import Crystal
+    return Crystal.from_cif(fn).sticks(dmin=dmin)
+
+
+def calc_entry(fn, dmin=dmin, settings=profile_settings):
+    """Returns lines and profile (against d) of cif fn"""
+    from crystal import Crystal
+    crystal = Crystal.from_cif(fn)
+    d, intensity = crystal.sticks(dmin=dmin)
+
+    s = settings
+    x, y = crystal.pattern(wl=s['wl'], start=s['start'], stop=s['stop'], step=s['step'],
+                           uvw=s['uvw'], eta=s['eta'])
+    return np.column_stack((d, intensity)), np.column_stack((twotheta2d(x, s['wl']), y))
+
+
+def build(fn=LIBRARY, jobs=1):
+    """Calculates lines and profiles for all cif files in zeolite_database, and writes them to fn"""
+    from batch import imap_files
+
+    fns = sorted(glob.glob(os.path.join(LINESDIR, 'zeolite_database', '*.cif')))
+
+    entries = {}
+    blocks = []
+    nrows = 0
+    for cif, result, error in imap_files(calc_entry, fns, jobs=jobs):
+        if error:
+            print ' >> Skipping {}: {}'.format(cif, error)
+            continue
+        code = framework_code(cif)
+        lines, profile = result
+        entries[code] = [nrows, nrows + len(lines), nrows + len(lines), nrows + len(lines) + len(profile)]
+        nrows += len(lines) + len(profile)
+        blocks.extend((lines, profile))
+        print '{:8s} {:6d} lines'.format(code, len(lines))
+
+    header = json.dumps({'version': 1,
+                         'settings': profile_settings,
+                         'dmin': dmin,
+                         'rows': nrows,
+                         'entries': entries})
+    # keep the data aligned
+    header += ' ' * (-(HEADER.size + len(header)) % 16)
+
+    tmp = '{}.{}.tmp'.format(fn, os.getpid())
+    with open(tmp, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, len(header)))
+        f.write(header)
+        for block in blocks:
+            f.write(np.ascontiguousarray(block, dtype='<f4').tostring())
+    if os.path.exists(fn):
+        os.remove(fn)
+    os.rename(tmp, fn)
+
+    global _library
+    _library = None
+
+    print
+    print 'Wrote {} structures ({} rows) to {}'.format(len(entries), nrows, fn)
+
+
+def main():
+    description = """Builds the library of precomputed powder patterns for the structures in zeolite_database."""
+
+    parser = argparse.ArgumentParser(description=description)
+
+    parser.add_argument("-o", "--out", metavar='FILE',
+                        action="store", type=str, dest="out",
+                        help="Output file (default: {})".format(LIBRARY))
+
+    parser.add_argument("-j", "--jobs", metavar='N',
+                        action="store", type=int, dest="jobs",
+                        help="Number of processes to use (0 = number of cpus)")
+
+    parser.set_defaults(out=LIBRARY,
+                        jobs=0)
+
+    options = parser.parse_args()
+
+    build(options.out, jobs=options.jobs)
+
+
+if __name__ == '__main__':
+    main()
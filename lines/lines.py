@@ -29,9 +29,21 @@ import matplotlib
 import matplotlib.pyplot as plt
 import matplotlib.transforms as transforms
 
-from scipy.interpolate import interp1d
-
-import math
+import cache
+
+from batch import imap_files
+from filewatch import watch_file
+from writer import write_columns
+from similarity import common_grid, resample, similarity
+from phaseid import build_index
+from core import (LINESDIR, planck_constant, elementary_charge, speed_of_light, iza_codes, lineno,
+                  printer, gen_read_files, read_file, read_data, read_patterns, load_tick_marks,
+                  get_correlation_matrix, parse_xrdml, parse_iza_code, run_cif2xy, parse_xrs,
+                  parse_crplot_dat, parse_hkl_dat, TailReader, f_bg_correct_out, new_stepco_inp,
+                  interpolate, KnotList, RingBuffer, MinMaxHistory, BackgroundModel, bin_pattern,
+                  smooth, savitzky_golay, wavelength_info, calc_agreement, AgreementTracker, Data,
+                  calc_fwhm, find_nearest, twotheta2d, d2twotheta, wavelength2energy,
+                  energy2wavelength, parse_wl)
 
 __version__ = '2018-10-03'
 
@@ -39,387 +51,155 @@ params = {'legend.fontsize': 10,
           'legend.labelspacing': 0.1}
 plt.rcParams.update(params)
 
-LINESDIR = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
-
-planck_constant = 6.62606957E-34
-elementary_charge = 1.60217656E-19
-speed_of_light = 2.99792458E8
-
 # print plt.get_backend()
 
-iza_codes = ["ABW", "ACO", "AEI", "AEL", "AEN", "AET", "AFG", "AFI", "AFN",
-             "AFO", "AFR", "AFS", "AFT", "AFV", "AFX", "AFY", "AHT", "ANA",
-             "APC", "APD", "AST", "ASV", "ATN", "ATO", "ATS", "ATT", "ATV",
-             "AVL", "AWO", "AWW", "BCT", "BEA", "BEC", "BIK", "BOF", "BOG",
-             "BOZ", "BPH", "BRE", "BSV", "CAN", "CAS", "CDO", "CFI", "CGF",
-             "CGS", "CHA", "CHI", "CLO", "CON", "CSV", "CZP", "DAC", "DDR",
-             "DFO", "DFT", "DOH", "DON", "EAB", "EDI", "EEI", "EMT", "EON",
-             "EPI", "ERI", "ESV", "ETR", "EUO", "EWT", "EZT", "FAR", "FAU",
-             "FER", "FRA", "GIS", "GIU", "GME", "GON", "GOO", "HEU", "IFO",
-             "IFR", "IFW", "IFY", "IHW", "IMF", "IRN", "IRR", "IRY", "ISV",
-             "ITE", "ITG", "ITH", "ITN", "ITR", "ITT", "ITV", "ITW", "IWR",
-             "IWS", "IWV", "IWW", "JBW", "JNT", "JOZ", "JRY", "JSN", "JSR",
-             "JST", "JSW", "KFI", "LAU", "LEV", "LIO", "LIT", "LOS", "LOV",
-             "LTA", "LTF", "LTJ", "LTL", "LTN", "MAR", "MAZ", "MEI", "MEL",
-             "MEP", "MER", "MFI", "MFS", "MON", "MOR", "MOZ", "MRE", "MSE",
-             "MSO", "MTF", "MTN", "MTT", "MTW", "MVY", "MWW", "NAB", "NAT",
-             "NES", "NON", "NPO", "NPT", "NSI", "OBW", "OFF", "OKO", "OSI",
-             "OSO", "OWE", "PAR", "PAU", "PCR", "PHI", "PON", "POS", "PSI",
-             "PUN", "RHO", "RON", "RRO", "RSN", "RTE", "RTH", "RUT", "RWR",
-             "RWY", "SAF", "SAO", "SAS", "SAT", "SAV", "SBE", "SBN", "SBS",
-             "SBT", "SEW", "SFE", "SFF", "SFG", "SFH", "SFN", "SFO", "SFS",
-             "SFV", "SFW", "SGT", "SIV", "SOD", "SOF", "SOS", "SSF", "SSO",
-             "SSY", "STF", "STI", "STO", "STT", "STW", "SVR", "SVV", "SZR",
-             "TER", "THO", "TOL", "TON", "TSC", "TUN", "UEI", "UFI", "UOS",
-             "UOV", "UOZ", "USI", "UTL", "UWY", "VET", "VFI", "VNI", "VSV",
-             "WEI", "WEN", "YUG", "ZON"]  # updated dec 2015
-
-
-def lineno():
-    """Returns the current line number in our program."""
-    import inspect
-    return inspect.currentframe().f_back.f_lineno
-
-
-def printer(data):
-    """Print things to stdout on one line dynamically"""
-    sys.stdout.write("\r\x1b[K"+data.__str__())
-    sys.stdout.flush()
-
-
-def gen_read_files(paths):
-    """opens file, returns file object for reading"""
-    for path in paths:
-        try:
-            f = open(path, 'r')
-        except IOError, e:
-            print e
-            # print 'Cannot open {} (IOError)'.format(path,e)
-            exit(0)
-        yield f
-
-
-def read_file(path):
-    """opens file, returns file object for reading"""
-    try:
-        f = open(path, 'r')
-    except IOError, e:
-        print e
-        # print 'Cannot open {} (IOError)'.format(path,e)
-        exit(0)
-    return f
 
+def parse_stdin_lines(lines, counter=0):
+    """Parses lines with 'x y' or only 'y' (x is then taken from counter)
 
-def read_data(fn, usecols=None, append_zeros=False, savenpy=False, suffix='', is_ticks=False, wl=1.0):
-    if fn == 'stepco.inp':
-        f = read_file(fn)
-        return parse_xrs(f, return_as='d')
-
-    root, ext = os.path.splitext(fn)
-
-    if ext == '' and root.upper() in iza_codes:
-        fn = parse_iza_code(code=root)
-        return read_data(fn, wl=wl)
-
-    if ext == '.cif':
-        fn = run_cif2xy(fn, wl=wl)  # requires CCTBX and FOCUS
-        return read_data(fn)
-
-    if ext.lower() == '.xrdml':
-        return parse_xrdml(fn)
+    returns array of shape (n, 2), new value of counter"""
+    lines = [line for line in lines if line.strip()]
+    if not lines:
+        return np.empty((0, 2)), counter
 
     try:
-        inp = np.load(root+'.npy')
-    except (IOError, AssertionError):
-        inp = np.loadtxt(fn, usecols=usecols, ndmin=2)
-    else:
-        ext = '.npy'
-        fn = root+'.npy'
-
-    if append_zeros:
-        (i, j) = inp.shape
-        inp = np.hstack((inp, np.zeros((i, 1))))
-
-    if inp.shape[1] > 3:
-        print 'More than 3 columns read from {}, assuming x,y,esd, ignoring the rest.'.format(f.name)
-
-    d = Data(inp, name=fn+suffix, is_ticks=is_ticks)
-
-    if savenpy and ext != '.npy':
-        np.save(root, inp)
-
-    return d
-
-
-def load_tick_marks(path, col=3):
-    """Checks if file exists and loads tick mark data as data class. Use column=3 default for xrs"""
-    try:
-        f = open(path, 'r')
-        f.close()
-    except IOError:
-        print '-- {} not found. (IOError)'.format(path)
-        return None
-
-    ticks = read_data(path, usecols=(col,), append_zeros=True, is_ticks=True)
-    return ticks
-
-
-def get_correlation_matrix(f, topas=False):
-    names = []
-    lst_not_iprm = []
-
-    def yield_corrmat(f):
-        for i, line in enumerate(f):
-            # calculate shift to correct for topas formatting
-            shift = max(0, int(math.log10(i+1))-1)
-            if line.startswith('}'):
-                raise StopIteration
-            else:
-                if not line.startswith('iprm'):
-                    lst_not_iprm.append(i)
-                    names.append(line[0:21].strip())
-                yield line[26+shift:]
-
-    for line in f:
-        if line.startswith('C_matrix_normalized'):
-            f.next()
-            f.next()
-
-            print 'Ignoring reflection intensities (iprm***), because they are always correlated.'
-            corr = np.genfromtxt(yield_corrmat(f), delimiter=4)
-            corr = corr[lst_not_iprm, :][:, lst_not_iprm]
-
-            return corr, names
-
-    f.seek(0)
-    return np.loadtxt(f), names
-
-
-def parse_xrdml(fn):
-    """Very basic function to read panalytical XPERT PRO files (XML)
-    Only parses file to get intensities and data range"""
-
-    from xml.dom import minidom
-    xmldoc = minidom.parse(fn)
-
-    counts = xmldoc.getElementsByTagName('intensities')[0]  # grab element
-    # get first node + convert to float
-    counts = map(float, counts.firstChild.wholeText.split())
-
-    for rangenode in xmldoc.getElementsByTagName('positions'):
-        if rangenode.getAttribute('axis') == '2Theta':
-            break
-        else:
-            rangenode = None
-    if not rangenode:
-        raise IOError("Cannot find range node in xrdml file.")
-
-    r_min = float(rangenode.getElementsByTagName(
-        'startPosition')[0].firstChild.wholeText)
-    r_max = float(rangenode.getElementsByTagName(
-        'endPosition')[0].firstChild.wholeText)
-    steps = len(counts)
-
-    th2 = np.linspace(r_min, r_max, steps)
-
-    xy = np.vstack([th2, counts]).T
-
-    d = Data(xy, name=fn)
-
-    root, ext = os.path.splitext(fn)
-    new = root+'.xy'
-    if not os.path.isfile(new):
-        d.print_pattern(name=new)
-
-    return d
-
-
-def parse_iza_code(code):
-    """Takes IZA code and returns path to cif"""
-
-    fn = code.upper()+'0.cif'
-    path = os.path.join(LINESDIR, 'zeolite_database', fn)
-
-    print 'Framework code {} -> {}'.format(code, path)
-    print
-
-    return path
-
-
-def run_cif2xy(cif, wl=1.0):
-    import subprocess as sp
-
-    sp.call([sys.executable, os.path.join(os.path.dirname(
-        os.path.abspath(__file__)), "cif2xy.py"), "--wavelength={}".format(wl), cif])
-    root, ext = os.path.splitext(cif)
-    basename = os.path.basename(root)
-    return basename+".xy"
-
-
-def parse_xrs(f, return_as='d_xrs'):
-    # xy = np.array([], dtype=float).reshape(0, 2)
-    start = True
-    pre = []
-    post = []
-
-    x = []
-    y = []
-    esd = []
-
-    for line in f:
-        if 'finish' in line.lower() or 'end' in line.lower():
-            # Takes care of new xrs files with no bgvalu commands
-            start = False
-            post.append(line)
-        elif line.lower().startswith('bgvalu') and start:
-            inp = line.split()
-            x.append(float(inp[1]))
-            y.append(float(inp[2]))
-            try:
-                esd.append(float(inp[3]))
-            except IndexError:
-                esd.append(np.nan)
-        elif start:
-            pre.append(line)
-        elif not start:
-            post.append(line)
-
-    f.close()
-
-    if return_as == 'xye':
-        return np.vstack([x, y, esd]).T
-    elif return_as == 'xy':
-        return np.vstack([x, y]).T
-    elif return_as == 'd':
-        xye = np.vstack([x, y, esd]).T
-        d = Data(xye, name='stepco.inp')
-        return d
-    elif return_as == 'd_xrs':   # include xrs stepco input data
-        xye = np.vstack([x, y, esd]).T
-        d = Data(xye, name='stepco.inp')
-        xrs = [f.name, pre, post]
-        return d, xrs
+        arr = np.loadtxt(lines, ndmin=2)
+    except ValueError:
+        # mixed number of columns
+        arr = None
     else:
-        raise SyntaxError
-
-
-def parse_crplot_dat(f):
-    """Parses crplot.dat file"""
-
-    # skip first 2 lines
-    f.next()
-    f.next()
+        if arr.shape[1] >= 2:
+            return arr[:, 0:2], counter
+        if arr.shape[1] == 1:
+            x = np.arange(counter, counter+len(arr))
+            return np.column_stack((x, arr[:, 0])), counter+len(arr)
 
     ret = []
-
-    for line in f:
+    for line in lines:
         inp = line.split()
-        if not f:
-            continue
-        ret.append([float(val) for val in inp])
-
-    return ret
-
-
-def parse_hkl_dat(f):
-    ret = []
-
-    for line in f:
-        inp = line.split()
-        if not f:
-            continue
-        if len(inp) < 4:
-            inp = (line[0:3], line[3:6], line[6:9], line[9:])
-        else:
-            ret.append([float(val) for val in inp])
+        try:
+            if len(inp) > 1:
+                ret.append((float(inp[0]), float(inp[1])))
+            elif inp:
+                ret.append((counter, float(inp[0])))
+                counter += 1
+        except ValueError:
+            print '-- Could not parse line: {}'.format(line.strip())
+    return np.array(ret, dtype=float).reshape(-1, 2), counter
 
-    return ret
 
+def plot_stdin(fig, update_time=0.2, window=None, window_range=None, history=5000):
+    """Plots data read from stdin while it comes in.
 
-def plot_stdin(fig, update_time=0.2):
-    import time
-    TclError = matplotlib.backends.backend_tkagg.tkagg.Tk._tkinter.TclError
+    stdin is read in a separate thread, and everything that arrived is parsed and
+    drawn at once every update_time seconds. If window (number of points) and/or
+    window_range (in units of x) is given, only the most recent data are kept in a
+    ring buffer. With window_range only, the buffer grows as needed to hold all points
+    within the range. Otherwise the full history is shown, reduced to at most 2*history
+    points by min/max decimation, so that memory and drawing time stay bounded."""
+    import threading
+    import Queue
 
     print 'Reading stdin.\n'
 
-    def nrange(n=0):
-        while True:
-            yield n
-            n = n+1
-
-    iterator = (n for n in nrange())
-
-    # fig = plt.figure()
     ax = fig.add_subplot(111)
 
-    x = []
-    y = []
-
-    l1, = ax.plot(x, y, label='stdin')
+    l1, = ax.plot([], [], label='stdin')
 
     plt.legend()
-    fig.show()
 
-    t0 = time.time()
+    if window or window_range:
+        buf = RingBuffer(window or 100000)
+    else:
+        buf = MinMaxHistory(history)
 
-    while True:
-        try:
-            line = sys.stdin.readline()
-        except KeyboardInterrupt as e:
-            print e
-            break
+    chunks = Queue.Queue()
 
-        if line == '':
-            try:
-                # update figure to prevent slow responsiveness
-                fig.canvas.flush_events()
-            except TclError:
-                print '-- Window closed (TclError on readline).'
+    def read_stdin():
+        fd = sys.stdin.fileno()
+        while True:
+            chunk = os.read(fd, 65536)
+            chunks.put(chunk)
+            if not chunk:
                 break
 
+    reader = threading.Thread(target=read_stdin)
+    reader.daemon = True
+    reader.start()
+
+    state = {'rest': '', 'counter': 0}
+
+    def update():
+        received = []
+        eof = False
+        while True:
             try:
-                time.sleep(0.05)  # prevent high cpu usage
-            except KeyboardInterrupt as e:
-                print e
+                chunk = chunks.get_nowait()
+            except Queue.Empty:
                 break
-            else:
-                continue
+            if not chunk:
+                eof = True
+                break
+            received.append(chunk)
 
-        inp = line.split()
+        if eof:
+            timer.stop()
+            print '-- End of input.'
+        elif not received:
+            return
 
-        try:
-            y.append(float(inp[1]))
-            x.append(float(inp[0]))
-        except IndexError:
-            x.append(iterator.next())
-            y.append(float(inp[0]))
+        lines = (state['rest'] + ''.join(received)).split('\n')
+        # incomplete last line
+        state['rest'] = '' if eof else lines.pop()
 
-        if time.time() - t0 > update_time:
-            # drawing is slow, better to refresh ever x seconds
+        xy, state['counter'] = parse_stdin_lines(lines, state['counter'])
+        if not len(xy):
+            return
 
-            t0 = time.time()
+        if window_range and not window:
+            # grow instead of dropping points that are still within the range
+            dropped = len(buf) + len(xy) - buf.capacity
+            if dropped > 0:
+                if dropped <= len(buf):
+                    x_dropped = buf.oldest(dropped-1)[0]
+                else:
+                    x_dropped = xy[dropped-len(buf)-1, 0]
+                if x_dropped >= xy[-1, 0] - window_range:
+                    buf.grow(max(2*buf.capacity, len(buf) + len(xy)))
 
-            l1.set_xdata(x)
-            l1.set_ydata(y)
+        buf.append(xy)
+        data = buf.data
 
-            ax.relim()
-            ax.autoscale()
+        if window_range:
+            data = data[data[:, 0] >= data[-1, 0] - window_range]
 
-            plt.draw()
+        l1.set_data(data[:, 0], data[:, 1])
 
-            try:
-                # update figure to prevent slow responsiveness
-                fig.canvas.flush_events()
-            except TclError:
-                print '-- Window closed (TclError on update).'
-                break
+        ax.relim()
+        ax.autoscale()
 
+        fig.canvas.draw_idle()
 
-def f_monitor(fin, f_init, f_update, fig=None, poll_time=0.05):
-    """experimental function for live monitoring of plots"""
-    import time
+    timer = fig.canvas.new_timer(interval=int(update_time*1000))
+    timer.add_callback(update)
+    timer.start()
 
-    TclError = matplotlib.backends.backend_tkagg.tkagg.Tk._tkinter.TclError
+    try:
+        plt.show()
+    except KeyboardInterrupt, e:
+        print e
+    finally:
+        timer.stop()
+
+
+def f_monitor(fin, f_init, f_update, fig=None, poll_time=0.1, settle_time=0.2):
+    """experimental function for live monitoring of plots
+
+    Changes to fin are picked up by a watcher (inotify on Linux, see filewatch.py)
+    that is checked from a timer on the gui event loop, so that the window stays
+    responsive and nothing runs while the file is not touched. f_update is called
+    once the file has not changed for settle_time seconds."""
+    import time
 
     if not fig:
         fig = plt.figure()
@@ -435,53 +215,70 @@ def f_monitor(fin, f_init, f_update, fig=None, poll_time=0.05):
             break
 
     plt.legend()
-    fig.show()
 
-    current_lastmod = os.stat(fin).st_mtime
+    watcher = watch_file(fin, settle_time=settle_time)
+    state = {'args': args}
+
+    def check():
+        if not watcher.changed():
+            return
 
-    while True:
         try:
-            mtime = os.stat(fin).st_mtime
-        except OSError:
-            time.sleep(1)
-            continue
+            print 'Updated: {} -'.format(fin), time.ctime(os.stat(fin).st_mtime)
+            state['args'] = f_update(fin, *state['args'])
+        except (IOError, OSError, ValueError, IndexError), e:
+            print '-- Could not update {} ({})'.format(fin, e)
+            return
 
-        if mtime == current_lastmod:
-            # flushing here as well, to prevent locking up of mpl window
+        # ax.relim()
+        # ax.autoscale() # resets the boundaries -> annoying for a plot
+        # that doesn't need rescaling
+        fig.canvas.draw_idle()
 
-            try:
-                fig.canvas.flush_events()
-            except TclError:
-                print '-- Window closed (TclError).'
-                break
+    timer = fig.canvas.new_timer(interval=int(poll_time*1000))
+    timer.add_callback(check)
+    timer.start()
+
+    try:
+        plt.show()
+    except KeyboardInterrupt, e:
+        print e
+    finally:
+        timer.stop()
+        watcher.close()
 
-            # low poll time is needed to keep responsiveness
 
-            try:
-                time.sleep(poll_time)
-            except KeyboardInterrupt as e:
-                print e
-                break
+def monitor_reader(fn, skiprows=0, usecols=None):
+    """Returns a TailReader for fn, or None if fn is not a plain column file and must
+    be read with read_data"""
+    root, ext = os.path.splitext(fn)
+    if fn == 'stepco.inp' or ext.lower() in ('', '.npy', '.cif', '.xrdml'):
+        return None
+    return TailReader(fn, skiprows=skiprows, usecols=usecols)
 
-        else:
-            print 'Updated: {} -'.format(fin), time.ctime(os.stat(fin).st_mtime)
-            current_lastmod = os.stat(fin).st_mtime
-            time.sleep(0.2)
-            args = f_update(fin, *args)
 
-            # ax.relim()
-            # ax.autoscale() # resets the boundaries -> annoying for a plot
-            # that doesn't need rescaling
-            plt.draw()
+def read_monitored(fn, reader):
+    """Returns x, y of the monitored file fn. If the file was only appended to, only the
+    new rows are parsed"""
+    if reader is None:
+        d = read_data(fn)
+        return d.x, d.y
+
+    arr, reloaded = reader.read()
+    if arr.shape[1] < 2:
+        raise IOError("Could not load file/data: {}".format(fn))
 
-            # And this allows you to at least close the window (and crash the
-            # program by that ;))
-            fig.canvas.flush_events()
+    if Data.plot_range:
+        r0, r1 = Data.plot_range
+        arr = arr[np.logical_and(arr[:, 0] >= r0, arr[:, 0] <= r1)]
+
+    return arr[:, 0], arr[:, 1]
 
 
 def plot_init(fn, fig, ax):
     # f = read_file(fn)
-    d = read_data(fn)
+    reader = monitor_reader(fn)
+    x, y = read_monitored(fn, reader)
 
     if fn in ('fcalc_fou.xy', 'fobs_fou.xy', 'fcfo.out'):
         try:
@@ -495,39 +292,47 @@ def plot_init(fn, fig, ax):
         ax.set_ylabel(yl)
         ax.set_title(fn)
         line,  = ax.plot(
-            d.x, d.y, 'o', label='{} vs {}'.format(xl, yl), color='r', linestyle='')
+            x, y, 'o', label='{} vs {}'.format(xl, yl), color='r', linestyle='')
         diag, =  ax.plot(
             [0, 25], [0, 25], color='b', linestyle='-', linewidth=2)
-        return [line, diag]
+        return [line, diag, reader]
     else:
-        line, = ax.plot(d.x, d.y, label=fn)
-        return [line]
+        line, = ax.plot(x, y, label=fn)
+        return [line, reader]
 
 
 def plot_update(fn, *args):
     # f = read_file(fn)
-    d = read_data(fn)
+    reader = args[-1]
+    x, y = read_monitored(fn, reader)
 
     if fn in ('fcalc_fou.xy', 'fobs_fou.xy', 'fcfo.out'):
-        [line, diag] = args
-        line.set_data(d.x, d.y)
+        [line, diag, reader] = args
+        line.set_data(x, y)
         diag.set_data([0, 25], [0, 25])
-        return [line, diag]
+        return [line, diag, reader]
     else:
-        [line] = args
-        line.set_data(d.x, d.y)
-        return [line]
+        [line, reader] = args
+        line.set_data(x, y)
+        return [line, reader]
+
+
+def read_crplot_dat():
+    """Reads crplot.dat in full, it is rewritten every refinement cycle"""
+    # skip first 2 lines, see parse_crplot_dat
+    return np.loadtxt('crplot.dat', skiprows=2, ndmin=2)
+
+
+def read_prf(fin):
+    """Reads columns 2theta, fobs, fcal, diff of prf file fin in full, it is rewritten every refinement cycle"""
+    return np.loadtxt(fin, skiprows=6, usecols=(0, 1, 2, 3), ndmin=2)
 
 
 def crplot_init(fin, fig, ax):
+    crdata = read_crplot_dat()
 
-    fcr = open('crplot.dat', 'r')
     fhkl = open('hkl.dat', 'r')
-
-    crdata = np.array(parse_crplot_dat(fcr))
     hkldata = np.array(parse_hkl_dat(fhkl))
-
-    fcr.close()
     fhkl.close()
 
     tt = crdata[:, 0]
@@ -557,13 +362,10 @@ def crplot_init(fin, fig, ax):
 def crplot_update(fin, *args):
     pobs, pclc, pdif, pobs_zero, pdif_zero, ptcks = args
 
-    fcr = open('crplot.dat', 'r')
-    fhkl = open('hkl.dat', 'r')
+    crdata = read_crplot_dat()
 
-    crdata = np.array(parse_crplot_dat(fcr))
+    fhkl = open('hkl.dat', 'r')
     hkldata = np.array(parse_hkl_dat(fhkl))
-
-    fcr.close()
     fhkl.close()
 
     tt = crdata[:, 0]
@@ -641,13 +443,7 @@ def f_prf(fin):
 
 
 def f_prf_init(fin, fig, ax):
-    fin = open(fin, 'r')
-
-    for i in range(6):
-        fin.next()
-
-    tt, fobs, fcal, diff = np.genfromtxt(
-        fin, usecols=(0, 1, 2, 3), unpack=True)
+    tt, fobs, fcal, diff = read_prf(fin).T
 
     mx_diff = max(diff)
 
@@ -666,13 +462,7 @@ def f_prf_init(fin, fig, ax):
 def f_prf_update(fin, *args):
     pfobs, pfcal, pdiff, pzero_fobs, pzero_diff = args
 
-    fin = open(fin, 'r')
-
-    for i in range(6):
-        fin.next()
-
-    tt, fobs, fcal, diff = np.genfromtxt(
-        fin, usecols=(0, 1, 2, 3), unpack=True)
+    tt, fobs, fcal, diff = read_prf(fin).T
 
     mx_diff = max(diff)
 
@@ -744,432 +534,10 @@ def f_plot_weighted_difference(xyobs, xycalc, xyerr, lw=1.0):
     plt.plot(xyobs.x, xyerr.y+offset*3, label="error")
 
 
-def f_bg_correct_out(d, bg_xy, kind='linear', offset='ask', suffix_bg='_bg', suffix_corr='_corr'):
-    """Function that removes the background from a data set and prints it to a new file"""
-
-    root, ext = os.path.splitext(d.filename)
-    fn_bg = root+suffix_bg+ext
-    fn_corr = root+suffix_corr+ext
-
-    # fn_bg   = d.filename.replace('.','_bg.')
-    # fn_corr = d.filename.replace('.','_corr.')
-
-    out_bg = open(fn_bg, 'w')
-    out_corr = open(fn_corr, 'w')
-
-    xvals = d.x
-    yvals = d.y
-
-    bg_yvals = interpolate(bg_xy, xvals, kind=kind)
-
-    if offset == 'ask':
-        offset = raw_input(
-            "What y offset should I add to the data? (x=exit)\n >> [0] ") or 0
-        offset = int(offset)
-
-    if offset == 'x':
-        return
-
-    print '\nOffset = {}'.format(offset)
-
-    if len(bg_xy) >= 4:
-        print 'Writing background pattern to %s' % fn_bg
-        for x, y in zip(xvals, bg_yvals):
-            if np.isnan(y):
-                continue
-            print >> out_bg, '%15.6f%15.2f' % (x, y)
-        print 'Writing corrected pattern to %s' % fn_corr
-
-        if d.has_esd:
-            err = d.err
-
-            for x, y, e in zip(xvals, yvals-bg_yvals+offset, err):
-                if np.isnan(y):
-                    continue
-                print >> out_corr, '%15.6f%15.2f%15.6f' % (x, y, e)
-        else:
-            for x, y in zip(xvals, yvals-bg_yvals+offset):
-                if np.isnan(y):
-                    continue
-                print >> out_corr, '%15.6f%15.2f' % (x, y)
-    else:
-        raise IndexError(
-            'Not enough values in background array, need at least 4 points.')
-
-
-def new_stepco_inp(xy, name, pre, post, esds=None):
-    """Function for writing stepco input files"""
-
-    print 'Writing xy data to file {}'.format(name)
-
-    f = open(name, 'w')
-
-    for line in pre:
-        print >> f, line,
-
-    if np.any(esds):
-        esds = esds.reshape(1, -1)
-
-        for (x, y, esd) in np.vstack((xy, esds)).T:
-            if np.isnan(esd):
-                esd = ''
-            else:
-                esd = '{:15.2f}'.format(esd)
-            print >> f, 'BGVALU    {:15f}{:15.2f}{}'.format(x, y, esd)
-    else:
-        for x, y in xy.T:
-            print >> f, 'BGVALU    {:15f}{:15.2f}'.format(x, y)
-
-    for line in post:
-        print >> f, line,
-
-    f.close()
-
-
-def interpolate(arr, xvals, kind='cubic'):
-    """
-    arr is the data set to interpolate, can be ndim=2 array, or tuple/list of x/y values
-
-    xvals are the values it has to be interpolated to
-
-    kind is the type of correction, Valid options: 'linear','nearest','zero',
-    'slinear', 'quadratic, 'cubic') or as an integer specifying the order
-    of the spline interpolator to use.
-    """
-
-    try:
-        arr.ndim
-    except AttributeError:
-        x, y = arr
-    else:
-        assert arr.ndim == 2, 'Expected 2 dimensional array'
-        x = arr[:, 0]  # create views
-        y = arr[:, 1]  #
-
-    try:
-        kind = int(kind)
-    except ValueError:
-        if x.shape[0] < 4:
-            kind = 'linear'
-    else:
-        if x.shape[0] < kind+1:
-            kind = 'linear'
-
-    res = interp1d(x, y, kind=kind, bounds_error=False)
-
-    # if the background seems to take shortcuts in linear mode, this is because fixed steps
-    # were set in the Backgrounder class
-
-    return res(xvals)
-
-
-def smooth(x, window_len=11, window='hanning'):
-    """smooth the data using a window with requested size.
-
-    This method is based on the convolution of a scaled window with the signal.
-    The signal is prepared by introducing reflected copies of the signal 
-    (with the window size) in both ends so that transient parts are minimized
-    in the begining and end part of the output signal.
-
-    input:
-        x: the input signal
-        window_len: the dimension of the smoothing window; should be an odd integer
-        window: the type of window from 'flat', 'hanning', 'hamming', 'bartlett', 'blackman'
-            flat window will produce a moving average smoothing.
-
-    output:
-        the smoothed signal
-
-    example:
-
-    t=linspace(-2,2,0.1)
-    x=sin(t)+randn(len(t))*0.1
-    y=smooth(x)
-
-    see also:
-
-    numpy.hanning, numpy.hamming, numpy.bartlett, numpy.blackman, numpy.convolve
-    scipy.signal.lfilter
-
-    TODO: the window parameter could be the window itself if an array instead of a string
-
-    FROM: http://www.scipy.org/Cookbook/SignalSmooth
-    """
-
-    if x.ndim != 1:
-        raise ValueError("smooth only accepts 1 dimension arrays.")
-
-    if x.size < window_len:
-        raise ValueError("Input vector needs to be bigger than window size.")
-
-    if window_len < 3:
-        return x
-
-    if window not in ['flat', 'hanning', 'hamming', 'bartlett', 'blackman']:
-        raise ValueError(
-            "Window is on of 'flat', 'hanning', 'hamming', 'bartlett', 'blackman'")
-
-    s = np.r_[2*x[0]-x[window_len-1::-1], x, 2*x[-1]-x[-1:-window_len:-1]]
-
-    if window == 'flat':  # moving average
-        w = np.ones(window_len, 'd')
-    else:
-        w = eval('np.'+window+'(window_len)')
-
-    y = np.convolve(w/w.sum(), s, mode='same')
-
-    return y[window_len:-window_len+1]
-
-
-def savitzky_golay(y, window_size=11, order=2, deriv=0):
-    r"""Smooth (and optionally differentiate) data with a Savitzky-Golay filter.
-    The Savitzky-Golay filter removes high frequency noise from data.
-    It has the advantage of preserving the original shape and
-    features of the signal better than other types of filtering
-    approaches, such as moving averages techhniques.
-    Parameters
-    ----------
-    y : array_like, shape (N,)
-        the values of the time history of the signal.
-    window_size : int
-        the length of the window. Must be an odd integer number.
-    order : int
-        the order of the polynomial used in the filtering.
-        Must be less then `window_size` - 1.
-    deriv: int
-        the order of the derivative to compute (default = 0 means only smoothing)
-    Returns
-    -------
-    ys : ndarray, shape (N)
-        the smoothed signal (or it's n-th derivative).
-    Notes
-    -----
-    The Savitzky-Golay is a type of low-pass filter, particularly
-    suited for smoothing noisy data. The main idea behind this
-    approach is to make for each point a least-square fit with a
-    polynomial of high order over a odd-sized window centered at
-    the point.
-    Examples
-    --------
-    t = np.linspace(-4, 4, 500)
-    y = np.exp( -t**2 ) + np.random.normal(0, 0.05, t.shape)
-    ysg = savitzky_golay(y, window_size=31, order=4)
-    import matplotlib.pyplot as plt
-    plt.plot(t, y, label='Noisy signal')
-    plt.plot(t, np.exp(-t**2), 'k', lw=1.5, label='Original signal')
-    plt.plot(t, ysg, 'r', label='Filtered signal')
-    plt.legend()
-    plt.show()
-    References
-    ----------
-    .. [1] A. Savitzky, M. J. E. Golay, Smoothing and Differentiation of
-       Data by Simplified Least Squares Procedures. Analytical
-       Chemistry, 1964, 36 (8), pp 1627-1639.
-    .. [2] Numerical Recipes 3rd Edition: The Art of Scientific Computing
-       W.H. Press, S.A. Teukolsky, W.T. Vetterling, B.P. Flannery
-       Cambridge University Press ISBN-13: 9780521880688
-
-    FROM: http://www.scipy.org/Cookbook/SavitzkyGolay
-    """
-    try:
-        window_size = np.abs(np.int(window_size))
-        order = np.abs(np.int(order))
-    except ValueError:
-        raise ValueError("window_size and order have to be of type int")
-    if window_size % 2 != 1 or window_size < 1:
-        raise TypeError("window_size size must be a positive odd number")
-    if window_size < order + 2:
-        raise TypeError("window_size is too small for the polynomials order")
-    order_range = range(order+1)
-
-    half_window = (window_size - 1) // 2
-    # precompute coefficients
-    b = np.mat([[k**i for i in order_range]
-                for k in range(-half_window, half_window+1)])
-    m = np.linalg.pinv(b).A[deriv]  # coefficients
-
-    # pad the signal at the extremes with
-    # values taken from the signal itself
-    firstvals = y[0] - np.abs(y[1:half_window+1][::-1] - y[0])
-    lastvals = y[-1] + np.abs(y[-half_window-1:-1][::-1] - y[-1])
-    y = np.concatenate((firstvals, y, lastvals))
-    return np.convolve(m, y, mode='valid')
-
-
-def wavelength_info(wl):
-    """Little summary for given wavelength"""
-
-    energy = wavelength2energy(wl)
-
-    print "wavelength: {:.5f} angstrom".format(wl)
-    print "energy:     {:.5f} kev".format(energy)
-
-    dvals = 10/np.linspace(1, 10, 10)
-
-    theta2 = d2twotheta(dvals, wl)
-    qvals = 4*(np.pi/wl) * np.sin(np.radians(theta2/2))
-
-    print "\n         d        th2          q"
-    for d, th2, q in zip(dvals, theta2, qvals):
-        print "{:10.3f} {:10.3f} {:10.3f}".format(d, th2, q)
-    print
-
-
-def calc_agreement(o, c, bg=0, kind='linear'):
-    """Calculates agreement values for given data data."""
-    if np.any(bg):
-        bg = interpolate(bg.T, c.x, kind=kind)  # need linear or better here
-
-    # nearest is fast and accurate, anything else is very slow
-    oy = interpolate(o.xy, c.x, kind='nearest') - bg
-    # oe = interpolate(o.xye[:,0:3:2],c.x,kind='nearest')
-
-    rp = np.sum(np.abs(oy - c.y)) / np.sum(oy)  # profile R-value
-
-    # w = (1/oe)**2
-    # rwp = ( np.sum(w*(oy - c.y)**2) / np.sum(w*(oy)**2) )**0.5 # weighted
-    # profile R-value
-
-    return rp
-
-
-class Data(object):
-    total = 0
-    plot_range = None
-
-    """container class for x,y, err data"""
-
-    def __init__(self, arr, name=None, quiet=False, is_ticks=False):
-        if not quiet:
-            print 'Loading data: {}\n       shape: {}'.format(name, arr.shape)
-
-        self.is_ticks = is_ticks
-
-        if self.plot_range:
-            r0, r1 = self.plot_range
-            self.arr = arr[np.logical_and(arr[:, 0] >= r0, arr[:, 0] <= r1)]
-        else:
-            self.arr = arr
-
-        try:
-            self.x = self.arr[:, 0]
-            self.y = self.arr[:, 1]
-            self.xy = self.arr[:, 0:2]
-            self.xye = self.arr[:, 0:3]
-        except IndexError:
-            raise IOError("Could not load file/data: {}".format(name))
-
-        try:
-            self.err = self.arr[:, 2]
-        except IndexError:
-            self.err = None
-            self.has_esd = False
-        else:
-            if np.all(self.err == np.nan):
-                self.has_esd = False
-                self.err = None
-            else:
-                self.has_esd = True
-
-        self.index = self.total
-        self.filename = name
-        Data.total += 1
-
-        if not quiet and not is_ticks:
-            n = len(self.x)         # observations
-            if self.has_esd:
-                w = 1/self.err**2   # weights
-            else:
-                w = 1/(np.abs(self.y)+0.1)      # weights = y^-1 if no esds
-            print '       R_exp: {:.3%}'.format(((n) / np.sum(w*self.y**2))**0.5)
-
-    def bin(self, binsize=0.01):
-        x = self.x
-        y = self.y
-        fn = self.filename
-
-        print 'Binning {} from 2th = {} - {} with a bin size of {}'.format(fn, min(x), max(x), binsize)
-        print
-        print 'N(x) = ', x.shape
-        print 'N(y) = ', y.shape
-
-        bins = np.arange(min(x), max(x), binsize)
-
-        print 'N(bins) =', bins.shape
-        print
-
-        digi = np.digitize(x, bins)
-
-        xbinned = np.array([x[digi == i].mean() for i in range(1, len(bins))])
-        ybinned = np.array([y[digi == i].mean() for i in range(1, len(bins))])
-
-        xbinned.shape = (-1, 1)
-        ybinned.shape = (-1, 1)
-
-        root, ext = os.path.splitext(self.filename)
-        name = root+'_bin_'+str(binsize)+ext
-
-        if self.has_esd:
-            interpolated_errors = interpolate(
-                (self.x, self.err), xbinned, kind='linear')
-            return Data(np.hstack((xbinned, ybinned, interpolated_errors)), name=name)
-        else:
-            return Data(np.hstack((xbinned, ybinned)), name=name)
-
-    def smooth(self, window='savitzky_golay', window_len=7, order=3, suffix='_smooth'):
-        assert window in ['flat', 'hanning', 'hamming',
-                          'bartlett', 'blackman', 'savitzky_golay', 'moving_avg']
-
-        print ' >> Applying filter: {}, window: {}, order {} (SG only) to {}'.format(window, window_len, order, self.filename)
-
-        if window == 'savitzky_golay':
-            y = savitzky_golay(self.y, window_size=window_len, order=order)
-        else:
-            y = smooth(self.y, window_len=window_len, window=window)
-
-        root, ext = os.path.splitext(self.filename)
-        name = root+suffix+ext
-
-        x = np.copy(self.x)
-
-        y.shape = (-1, 1)
-        x.shape = (-1, 1)
-
-        return Data(np.hstack((x, y)), name=name)
-
-    def convert_wavelength(self, wavelength_in, wavelength_out):
-        """Converts 2theta values to a different wavelength"""
-        print
-        print " ** Convert {} from {:.4f} ANG ({:.2f} keV) to {:.4f} ANG ({:.2f} keV)".format(self.filename, wavelength_in, wavelength2energy(wavelength_in), wavelength_out, wavelength2energy(wavelength_out))
-        print
-        d = twotheta2d(self.x, wavelength_in)
-        theta2 = d2twotheta(d, wavelength_out)
-        arr = self.arr
-        arr[:, 0] = theta2
-        return Data(arr, name=self.filename)
-
-    def print_pattern(self, name=None, tag=""):
-        """print self (x,y,e) to 3 column file. If no name is given, original file is overwritten.
-        A tag can be added to modify the original filename instead (ie. data.xye -> data_binned.xye)"""
-
-        if tag:
-            tag = "_" + tag
-
-        if not name:
-            root, ext = os.path.splitext(self.filename)
-            name = root + tag + ext
-        np.savetxt(name, self.xye, fmt='%15.5f')
-
-        print 'Pattern written to {}'.format(name)
-
-    def plot(self, ax):
-        ax.plot(self.x, self.y)
-
-
-class Background():
+class Background(object):
     sensitivity = 8
 
-    def __init__(self, fig, d=None, outfunc=None, bg_correct=False, quiet=False, out=None, npick=-1, topas_bg=False, xrs=None):
+    def __init__(self, fig, d=None, outfunc=None, bg_correct=False, quiet=False, out=None, npick=-1, topas_bg=False, xrs=None, blit=True):
         """Class that captures mouse events when a graph has been drawn, stores the coordinates
         of these points and draws them as a line on the screen. Can also remove points and print all
         the stored points to stdout
@@ -1181,7 +549,10 @@ class Background():
         a figure object
         optional numpy array with background coordinates, shape = (2,0)
 
-        xy: 2d ndarray, shape(2,0) with x,y data"""
+        xy: 2d ndarray, shape(2,0) with x,y data
+
+        If blit is True (and the backend supports it), the interactive lines are animated
+        artists, and only they are redrawn on top of a stored copy of the figure after a click"""
 
         self.npick = npick
 
@@ -1198,16 +569,10 @@ class Background():
 
         if d:
             self.d = d
-            self.xy = np.array(self.d.xy, copy=True).T
+            self.knots = KnotList(self.d.xy.T)
         else:
             self.d = None
-            self.xy = None
-
-        try:
-            idx = self.xy[0, :].argsort()
-            self.xy = self.xy[:, idx]
-        except (IndexError, ValueError, TypeError):
-            self.xy = np.array([], dtype=float).reshape(2, 0)
+            self.knots = KnotList()
 
         self.line, = self.ax.plot(*self.xy, lw=0.5, marker='s', mec='red', mew=2,
                                   mfc='None', markersize=5, picker=self.sensitivity, label='interactive background')
@@ -1220,17 +585,29 @@ class Background():
         self.keyevent = self.line.figure.canvas.mpl_connect(
             'key_press_event', self.onkeypress)
 
+        self.canvas = self.line.figure.canvas
+        self.blit = blit and self.canvas.supports_blit
+        self.blit_background = None
+        self.animated = [self.line]
+
+        if self.blit:
+            self.line.set_animated(True)
+            self.drawevent = self.canvas.mpl_connect(
+                'draw_event', self.ondraw)
+
         self.n = 0
 
         self.tb = plt.get_current_fig_manager().toolbar
 
         if self.topas_bg:
             self.last_agreement = 0
+            self.agreement = None
 
         print
         print 'Left mouse button: add point'
         print 'Right mouse button: remove point'
         print 'Middle mouse button or press "a": print points to file/stdout'
+        print 'ctrl+z / ctrl+y: undo / redo'
         print
         print 'Note: Adding/Removing points disabled while using drag/zoom functions.'
         print
@@ -1239,7 +616,9 @@ class Background():
         if self.bg_correct:
             # Set limited range to speed up calculations
             self.bg_range = np.arange(self.xy[0][0], self.xy[0][-1], 0.01)
-            self.bg, = self.ax.plot(self.d.x, self.d.y, label='background')
+            self.bg_model = BackgroundModel(self.bg_range, kind=self.bg_correct)
+            self.bg, = self.ax.plot(self.d.x, self.d.y, label='background', animated=self.blit)
+            self.animated.append(self.bg)
             # print self.bg_range
 
     def __call__(self, event):
@@ -1265,11 +644,8 @@ class Background():
         if button == 3:  # rmb
             pass
 
-        if self.bg_correct and button:
-            self.background_update()
-
-        self.line.set_data(self.xy)
-        self.line.figure.canvas.draw()
+        if button:
+            self.refresh()
 
         if len(self.xy.T) == self.npick:
             print '\nClosing window...'
@@ -1277,27 +653,48 @@ class Background():
             time.sleep(1)
             plt.close()
 
+    @property
+    def xy(self):
+        """Background points, sorted 2xN view"""
+        return self.knots.xy
+
+    def refresh(self):
+        """Updates the interactive lines after the points have changed"""
+        if self.bg_correct:
+            self.background_update()
+        self.line.set_data(self.xy)
+        self.redraw()
+
+    def ondraw(self, event):
+        """Called after every full redraw (also zoom/pan/resize). Stores the figure without
+        the animated lines, and draws them on top"""
+        self.blit_background = self.canvas.copy_from_bbox(self.canvas.figure.bbox)
+        for artist in self.animated:
+            self.ax.draw_artist(artist)
+
+    def redraw(self):
+        """Redraws the interactive lines. With blitting, only these lines are drawn on top of
+        the stored figure instead of redrawing all patterns"""
+        if not self.blit or self.blit_background is None:
+            self.canvas.draw()
+            return
+
+        self.canvas.restore_region(self.blit_background)
+        for artist in self.animated:
+            self.ax.draw_artist(artist)
+        self.canvas.blit(self.canvas.figure.bbox)
+
     def onpick(self, event):
         """General data point picker, should work for all kinds of plots?"""
         if not event.mouseevent.button == 3:  # button 3 = right click
             return
 
-        ind = event.ind
+        removed = self.knots.remove(event.ind)
 
-        removed = self.xy[:, ind]
-        self.xy = np.delete(self.xy, ind, 1)
-
-        if self.topas_bg:
-            agreement = calc_agreement(
-                self.xyobs, self.xycalc, self.xy, kind=self.bg_correct)
-            difference = agreement - self.last_agreement
-            self.last_agreement = agreement
-            string = '{:.4f} ({:+.4f})'.format(agreement, difference)
-        else:
-            string = ""
+        string = self.agreement_string()
 
-        for n in range(len(ind)):
-            print '   --- {:.4f} {:.4f}          {}'.format(removed[:, n][0], removed[:, n][1], string)
+        for x, y in removed.T:
+            print '   --- {:.4f} {:.4f}          {}'.format(x, y, string)
 
     def onkeypress(self, event):
         if event.key == 'x':
@@ -1309,34 +706,53 @@ class Background():
         if event.key == 'a':
             print '\na pressed'
             self.printdata()
+        if event.key in ('ctrl+z', 'ctrl+y'):
+            if event.key == 'ctrl+z':
+                ret = self.knots.undo()
+                tag = 'undo'
+            else:
+                ret = self.knots.redo()
+                tag = 'redo'
+            if not ret:
+                print 'Nothing to {}'.format(tag)
+                return
+            action, points = ret
+            string = self.agreement_string()
+            sign = '+++' if (action == 'insert') == (tag == 'redo') else '---'
+            for x, y in points.T:
+                print '{} {:.4f} {:.4f}   ({})   {}'.format(sign, x, y, tag, string)
+            self.refresh()
 
     def add_point(self, x, y, xdata, ydata):
         """Store both data points as relative x,y points. The latter are needed to remove points"""
 
-        self.xy = np.append(self.xy, [[xdata], [ydata]], axis=1)
-        idx = self.xy[0, :].argsort()
-        self.xy = self.xy[:, idx]
+        self.knots.insert(xdata, ydata)
 
-        if self.topas_bg:
-            agreement = calc_agreement(
-                self.xyobs, self.xycalc, self.xy, kind=self.bg_correct)
-            difference = agreement - self.last_agreement
-            self.last_agreement = agreement
-            string = '{:.4f} ({:+.4f})'.format(agreement, difference)
-        else:
-            string = ""
+        string = self.agreement_string()
 
         print '+++    {:.4f} {:.4f}          {}'.format(xdata, ydata, string)
 
-    def background_update(self):
-        xy = self.xy.T
-
-        if xy.shape[0] < 2:
-            self.bg.set_data([], [])
-            return
+    def agreement_string(self):
+        """Returns new Rp and change since the last call for printing (topas_bg only)"""
+        if not self.topas_bg:
+            return ""
+        agreement = self.update_agreement()
+        difference = agreement - self.last_agreement
+        self.last_agreement = agreement
+        return '{:.4f} ({:+.4f})'.format(agreement, difference)
+
+    def update_agreement(self):
+        """Returns Rp for the current background. Requires self.xyobs and self.xycalc"""
+        if self.agreement is None:
+            # need linear or better here
+            self.agreement = AgreementTracker(
+                self.xyobs, self.xycalc, kind=self.bg_correct or 'linear')
+        return self.agreement.update(*self.xy)
 
-        bg_vals = interpolate(xy, self.bg_range, kind=self.bg_correct)
-        self.bg.set_data(self.bg_range, bg_vals)
+    def background_update(self):
+        # only re-evaluates the part of the background that changed, NaN if < 2 points
+        self.bg_model.update(*self.xy)
+        self.bg.set_data(self.bg_range, self.bg_model.out)
 
     def get_esds(self):
         """Returns None if no esds are present on the background, otherwise, it tries to interpolate the esds already present
@@ -1372,9 +788,7 @@ class Background():
         if self.xrs:
             new_stepco_inp(self.xy, *self.xrs, esds=esds)
         else:
-            fout = open(fout, 'w')
-            for x, y in self.xy.transpose():
-                print >> fout, '%15.6f%15.2f' % (x, y)
+            write_columns(fout, self.xy, ('%15.6f', '%15.2f'), nan=None)
 
 
 class Lines(object):
@@ -1611,155 +1025,118 @@ def f_peakdetect(d, lookahead=10, noise=5000):
     return xm, ym
 
 
-def f_identify(d, refs, criterium=0.05, lookahead=10, noise=5000):
-    import operator
-
+def f_identify(d, index, tolerance=0.05, lookahead=10, noise=5000, wl=1.0, top=10):
+    """Identifies the phases in data set d by matching its peaks against all references
+    in index (phaseid.PeakIndex). tolerance is the maximum difference in degrees 2theta.
+    Peaks are found with pd.peakdetect if lookahead and noise are given, otherwise they
+    are picked interactively with f_peakdetect"""
     print d.filename
 
-    print lookahead, noise
+    import peakdetect as pd
 
     if lookahead and noise:
-        import peakdetect as pd
         _max, _min = pd.peakdetect(d.y, d.x, lookahead=lookahead, delta=noise)
         xm = [p[0] for p in _max]
         ym = [p[1] for p in _max]
-        print 'rawr'
     else:
         xm, ym = f_peakdetect(d)
 
-    xm = np.array(xm)
-    ym = np.array(ym)
-
-    lst = []
-
-    for fn in refs:
-        # ref = read_data(fn,usecols=4,append_zeros=True,savenpy=False)
-        ref = load_tick_marks(fn, col=4)
+    if not len(xm):
+        print ' >> No peaks found'
+        return []
 
-        diff_array = np.abs(xm-ref.x[:, np.newaxis])
+    # sub-step positions
+    xm, ym, _ = pd.refine_peaks(d.x, d.y, np.searchsorted(d.x, xm))
 
-        # print diff_array
-        # print diff_array.shape
-
-        min_diff = np.amin(diff_array, 0)
-
-        # print min_diff
-
-        da = min_diff < criterium
-
-        # do manually
-        exit()
+    result = index.match(xm, ym, wl=wl, tolerance=tolerance, top=top)
 
-        r = sum(min_diff[da]*min_diff[da]) / sum(xm[da]*xm[da])
-        wr = sum(ym[da] * min_diff[da]*min_diff[da]) / \
-            sum(ym[da]*xm[da]*xm[da])
-        missing = len(xm) - sum(da)
-
-        lst.append((r, wr, missing, ref.filename))
-
-    lst = sorted(lst, key=operator.itemgetter(2), reverse=True)
-
-    print lst
-    for (r, rw, missing, fn) in lst:
-        print '{:6.3f} {:6.3f} using: {} refs --> {}'.format(r, wr, missing, fn)
-
-
-def f_compare(data, kind=0, reference=None):
-    import itertools
-    import scipy.stats
-    import operator
+    print
+    print '{} peaks, {} references, tolerance = {} degrees 2theta'.format(len(xm), len(index), tolerance)
+    print
+    print '  #      fom  matched  explained  observed  reference'
+    for i, (fom, name, nmatched, explained, observed) in enumerate(result):
+        print '{:3d} {:8.3f} {:8d} {:10.3f} {:9.3f}  {}'.format(i+1, fom, nmatched, explained, observed, name)
+    print
 
-    def calc_combined_value(spearmanr, kendallr, pearsonr):
-        spearmanr = spearmanr if not np.isnan(spearmanr) else 1.0
-        kendallr = kendallr if not np.isnan(kendallr) else 1.0
-        pearsonr = pearsonr if not np.isnan(pearsonr) else 1.0
+    return result
 
-        return pearsonr**(1/3.0)*kendallr**(1/3.0)*spearmanr**(1/3.0)
 
-    # parameters used for calculated pattern
-    start, stop, step = 2, 25.00, 0.01
+def f_compare(data, kind=0, reference=None, fout='compare.out', chunksize=None, nshow=100,
+              start=None, stop=None, step=None, maxshift=0):
+    """Calculates the similarity between all data sets, or between reference and every
+    data set, see similarity.py. Pairs are sorted by kind (0 = combined, 1 = spearman,
+    2 = kendall, 3 = pearson), the full ranking is written to fout.
 
-    min_tt = 0      # boundary for check
-    max_tt = 2300   # should not excede number of parameters
+    The patterns are compared between start and stop on a grid with the given step,
+    by default the range where all patterns overlap. If maxshift (in degrees) is given,
+    every pair is compared at the shift that gives the best cross-correlation. The shift
+    column gives the position of the second pattern relative to the first."""
 
-    # shuffle = (-100,-80,-60,-40,-20,0,20,40,60,80,100)
-    shuffle = (0,)
-    max_shift = max(shuffle)
-    min_shift = min(shuffle)
+    patterns = data + [reference] if reference else data
+    xvals = common_grid(patterns, start=start, stop=stop, step=step)
+    step = xvals[1] - xvals[0]
+    nshift = int(round(maxshift / step))
 
-    xvals = np.arange(start, stop, step)
-    # resample at same step rate as calculated pattern
-    data = [Data(np.vstack((xvals, interpolate(
-        d.xy, xvals, kind='linear'))).T, name=d.filename, quiet=True) for d in data]
+    Y = resample(data, xvals)
 
-    # for d in data:
-    #   print d.xy.shape
+    names = [d.filename.split('/')[-1] for d in data]
 
     if reference:
-        reference = Data(np.vstack(
-            (xvals, interpolate(reference.xy, xvals, kind='linear'))).T, name=reference.filename)
-        pairs = ((reference, d) for d in data)
-        l = float(len(data))
+        ref_y = resample([reference], xvals)[0]
+        l = len(data)
         lfill = len(reference.filename.split('/')[-1])
-        rfill = max(len(d.filename.split('/')[-1]) for d in data)
+        rfill = max(len(name) for name in names)
     else:
-        lfill = rfill = max(len(d.filename.split('/')[-1]) for d in data)
-        pairs = itertools.combinations(data, 2)
-        l = float(len(data)*(len(data)-1)/2)
-    # pairs = itertools.combinations_with_replacement(data,2)
-
-    lst = []
+        ref_y = None
+        lfill = rfill = max(len(name) for name in names)
+        l = len(data)*(len(data)-1)/2
 
     print "Calculate agreement for {} combinations of {} patterns.".format(int(l), len(data))
 
-    for i, (d1, d2) in enumerate(pairs):
-        printer("{:2.0%}".format(i/l))
-
-        names = "{:<{lfill}} - {:<{rfill}}".format(
-            d1.filename.split('/')[-1], d2.filename.split('/')[-1], lfill=lfill, rfill=rfill)
-
-        for shift in shuffle:
-            pearsonr, pearsonp = scipy.stats.pearsonr(
-                d1.y[min_tt-min_shift+shift:max_tt-max_shift+shift],   d2.y[min_tt-min_shift+shift:max_tt-max_shift+shift])
-            kendallr, kendallp = scipy.stats.kendalltau(
-                d1.y[min_tt-min_shift+shift:max_tt-max_shift+shift:5], d2.y[min_tt-min_shift+shift:max_tt-max_shift+shift:5])
-            spearmanr, spearmanp = scipy.stats.spearmanr(
-                d1.y[min_tt-min_shift+shift:max_tt-max_shift+shift],   d2.y[min_tt-min_shift+shift:max_tt-max_shift+shift])
+    (combined, spearmanr, kendallr, pearsonr), (spearmanp, kendallp, pearsonp), shifts = similarity(
+        Y, reference=ref_y, chunksize=chunksize, maxshift=nshift)
 
-            if pearsonr <= 0 or kendallr <= 0 or spearmanr <= 0:
-                continue
-
-            # if pearsonp > 0.01 or kendallp > 0.01 or spearmanp > 0.01:
-                # continue
-
-            combined = calc_combined_value(pearsonr, kendallr, spearmanr)
-
-            lst.append((combined, spearmanr, kendallr, pearsonr,
-                        spearmanp, kendallp, pearsonp, shift*step, names))
-
-    printer("")
-    print
+    if reference:
+        i = np.zeros(len(data), dtype=int)
+        j = np.arange(len(data))
+        left = [reference.filename.split('/')[-1]]
+    else:
+        i, j = np.triu_indices(len(data), k=1)
+        left = names
 
-    lst = sorted(lst, key=operator.itemgetter(kind))
+    values = np.vstack([m[i, j] for m in (combined, spearmanr, kendallr, pearsonr,
+                                          spearmanp, kendallp, pearsonp, -shifts*step)]).T
 
-    print '2theta range = {:8.3f} {:8.3f}'.format(start+min_tt*step, start+max_tt*step)
-    print 'Shuffle values by {}'.format([shift*step for shift in shuffle])
+    # only pairs that are positively correlated by all measures
+    with np.errstate(invalid='ignore'):
+        sel = np.all(values[:, 1:4] > 0, axis=1)
+    values, i, j = values[sel], i[sel], j[sel]
 
-    print'combined spearman     pval  kendall     pval  pearson     pval    shift -> sorted by {}'.format(['combined', 'spearman', 'kendall', 'pearson'][kind])
-    for (combined, spearmanr, kendallr, pearsonr, spearmanp, kendallp, pearsonp, shift, names) in lst:
-        print "{:8.3f} {:8.3f} {:8.3f} {:8.3f} {:8.3f} {:8.3f} {:8.3f} {:8.3f}   ".format(combined, spearmanr, spearmanp, kendallr, kendallp, pearsonr, pearsonp, shift) + names
+    order = np.argsort(values[:, kind], kind='mergesort')
+    values, i, j = values[order], i[order], j[order]
 
+    rows = ["{:8.3f} {:8.3f} {:8.3f} {:8.3f} {:8.3f} {:8.3f} {:8.3f} {:8.3f}   ".format(
+        c, sr, sp, kr, kp, pr, pp, shift) + "{:<{lfill}} - {:<{rfill}}".format(left[a], names[b], lfill=lfill, rfill=rfill)
+        for (c, sr, kr, pr, sp, kp, pp, shift), a, b in zip(values, i, j)]
 
-def calc_fwhm(uvw):
-    u, v, w = uvw
-    th2 = np.linspace(0, 70, 70*50)
-    th_rad = np.radians(th2 / 2)
+    header = 'combined spearman     pval  kendall     pval  pearson     pval    shift -> sorted by {}'.format(['combined', 'spearman', 'kendall', 'pearson'][kind])
 
-    fwhm = (u*np.tan(th_rad)**2 + v*np.tan(th_rad) + w)**0.5
+    print '2theta range = {:8.3f} {:8.3f}, step = {:.4f}'.format(xvals[0], xvals[-1], step)
+    if nshift:
+        print 'Shift search up to +-{:.3f} degrees ({} steps)'.format(nshift*step, nshift)
 
-    xy = np.vstack([th2, fwhm]).T
+    print header
+    if len(rows) > nshow:
+        print '... {} pairs not shown, see {}'.format(len(rows) - nshow, fout)
+    for row in rows[-nshow:]:
+        print row
 
-    return Data(xy, 'UVW')
+    # ranked, most similar first
+    with open(fout, 'w') as f:
+        print >> f, 'rank ' + header
+        for rank, row in enumerate(reversed(rows)):
+            print >> f, '{:4d} '.format(rank+1) + row
+    print 'Ranking written to {}'.format(fout)
 
 
 def fix_sls_data(data, quiet=False):
@@ -1836,35 +1213,6 @@ def fix_sls_data(data, quiet=False):
         data.append(d2)
 
 
-def find_nearest(array, value):
-    """Find index of nearest value"""
-    idx = (np.abs(array-value)).argmin()
-    return idx
-
-
-def twotheta2d(twotheta, wavelength):
-    theta = np.radians(twotheta / 2)
-    d = wavelength / (2*np.sin(theta))
-    return d
-
-
-def d2twotheta(d, wavelength):
-    theta = np.degrees(np.arcsin((wavelength) / (2*d)))
-    return 2*theta
-
-
-def wavelength2energy(wl):
-    """Takes wavelength in Angstrom, returns energy in keV"""
-    # 1E3 from ev to kev, divide by 1E10 from angstrom to meter
-    return 1E10*planck_constant*speed_of_light/(wl*1E3*elementary_charge)
-
-
-def energy2wavelength(E):
-    """Takes wavelength in keV, returns energy in Angstrom"""
-    # 1E3 from ev to kev, divide by 1E10 from angstrom to meter
-    return 1E10*planck_constant*speed_of_light/(E*1E3*elementary_charge)
-
-
 def plot_reciprocal_space(fnobs, fncalc=None, orthogonal_view=True):
     from mpl_toolkits.mplot3d import Axes3D
 
@@ -1967,19 +1315,6 @@ def run_script(gui_options=None):
                                      formatter_class=argparse.RawDescriptionHelpFormatter,
                                      version=__version__)
 
-    def parse_wl(string):
-        wavelengths = {"cra1": 2.28970, "cra2": 2.29361, "cr": 2.2909,
-                       "fea1": 1.93604, "fea2": 1.93998, "fe": 1.9373,
-                       "cua1": 1.54056, "cua2": 1.54439, "cu": 1.5418,
-                       "moa1": 0.70930, "moa2": 0.71359, "mo": 0.7107,
-                       "aga1": 0.55941, "aga2": 0.56380, "ag": 0.5608, "sls": 1.0000}
-        if string.lower().endswith('kev'):
-            return energy2wavelength(float(string.lower().replace('kev', "")))
-        elif string.lower() in wavelengths:
-            return wavelengths[string.lower()]
-        else:
-            return float(string)
-
     parser = argparse.ArgumentParser()
 
     parser.add_argument("args",
@@ -2010,9 +1345,25 @@ def run_script(gui_options=None):
                         action="store", type=float, dest="bin",
                         help="Bins the patterns supplied with the supplied bins and prints binned data sets.")
 
+    parser.add_argument("--binmode", metavar='mode',
+                        action="store", type=str, dest="bin_mode", choices=('mean', 'sum', 'weighted'),
+                        help="How intensities are combined with --bin: 'mean' (default), 'sum' or 'weighted' (1/esd^2). Esds are propagated as sqrt(sum(esd^2))/n for 'mean'.")
+
     parser.add_argument("--compare", metavar='x',
                         action="store", type=int, nargs='?', dest="compare", const=1,
-                        help="Calculates similarity between data sets. For now, background needs to be removed manually beforehand. Sort by VAL: 1 = combined, 2 = spearman, 3 = kendall's tau, 4 = pearson.")
+                        help="Calculates similarity between data sets. For now, background needs to be removed manually beforehand. Sort by VAL: 1 = combined, 2 = spearman, 3 = kendall's tau, 4 = pearson. The full ranking is written to compare.out.")
+
+    parser.add_argument("--compare_range", metavar=('START', 'STOP'),
+                        action="store", type=float, nargs=2, dest="compare_range",
+                        help="2theta range used by --compare. Default: the range where all data sets overlap.")
+
+    parser.add_argument("--compare_step", metavar='STEP',
+                        action="store", type=float, dest="compare_step",
+                        help="Step size of the grid the data sets are resampled on for --compare. Default: the largest step size of the data sets.")
+
+    parser.add_argument("--compare_shift", metavar='X',
+                        action="store", type=float, dest="compare_shift",
+                        help="Let --compare find the best shift (up to X degrees) between every pair of data sets, to correct for zero-shift errors. Default = 0.")
 
     parser.add_argument("-m", "--monitor", metavar='FILE',
                         action="store", type=str, dest="monitor",
@@ -2071,7 +1422,19 @@ def run_script(gui_options=None):
 
     group_adv.add_argument("--savenpy",
                            action="store_true", dest="savenpy",
-                           help="Convert input data sets to numpy binary format for faster loading on next run (extension = .npy). Default = False.")
+                           help="Convert input data sets to numpy binary format for faster loading on next run (extension = .npy). The .npy file is ignored once the original file is newer. Default = False.")
+
+    group_adv.add_argument("-j", "--jobs", metavar='N',
+                           action="store", type=int, dest="jobs",
+                           help="Number of processes used to read the input files (and to index the references for --identify). 0 = number of cpus. Default = 1. Binning, smoothing and background correction are not parallelized here; use lines_batch to process many files in parallel.")
+
+    group_adv.add_argument("--nocache",
+                           action="store_false", dest="use_cache",
+                           help="Do not read or write parsed patterns from/to the binary cache (location can be set with environment variable LINES_CACHE_DIR).")
+
+    group_adv.add_argument("--clearcache",
+                           action="store_true", dest="clear_cache",
+                           help="Remove all entries from the binary pattern cache.")
 
     group_adv.add_argument("--smooth",
                            action="store", type=str, dest="smooth",
@@ -2081,6 +1444,14 @@ def run_script(gui_options=None):
                            action="store", type=int, nargs=2, dest="peakdetect",
                            help="Use peak detection algorithm")
 
+    group_adv.add_argument("--window", metavar='N',
+                           action="store", type=int, dest="stdin_window",
+                           help="When plotting data from stdin, only keep and show the last N points. By default, the full history is shown, reduced by min/max decimation.")
+
+    group_adv.add_argument("--windowrange", metavar='X',
+                           action="store", type=float, dest="stdin_range",
+                           help="When plotting data from stdin, only show the last X degrees (units of the first column). Without --window, all points within this range are kept.")
+
     group_adv.add_argument("--lw", "--linewidth",
                            action="store", type=float, dest="linewidth",
                            help="Set linewidth of the plot")
@@ -2089,9 +1460,17 @@ def run_script(gui_options=None):
                            action="store", type=str, dest="corrmat",
                            help="Plot given file as correlation matrix (expects ascii file with a n*m matrix). Can also take a Topas output file if a matrix has been generated with keyword C_matrix_normalized.")
 
-    group_adv.add_argument("--identify",
-                           action="store", type=float, dest="identify",
-                           help="Identify given data sets against sets of d-spacings given by --reference")
+    group_adv.add_argument("--identify", metavar='TOL',
+                           action="store", type=float, nargs='?', const=0.05, dest="identify",
+                           help="Identify the phases in the given data sets by matching their peaks (see --peakdetect) against the structures in zeolite_database and the files given by --idref. TOL is the tolerance in degrees 2theta (default = 0.05). Uses --wavelength.")
+
+    group_adv.add_argument("--idref", metavar='FILE',
+                           action="store", type=str, nargs='+', dest="identify_refs",
+                           help="Additional references for --identify: cif files, or tick mark files with 2theta (at --wavelength) and optionally intensity.")
+
+    group_adv.add_argument("--top", metavar='N',
+                           action="store", type=int, dest="identify_top",
+                           help="Number of candidates to list for --identify (default = 10).")
 
     group_adv.add_argument("--nobg",
                            action="store_false", dest="backgrounder",
@@ -2142,18 +1521,30 @@ def run_script(gui_options=None):
                         stepco=False,
                         topas_bg=False,
                         compare=False,
+                        compare_range=None,
+                        compare_step=None,
+                        compare_shift=0,
                         compare_reference=None,
+                        identify=None,
+                        identify_refs=[],
+                        identify_top=10,
                         quiet=False,
                         bg_input=None,
                         bg_output=None,
                         bg_offset=0,
                         boxes=None,
                         bin=None,
+                        bin_mode='mean',
                         # advanced options
                         show=True,
                         convert_2theta=None,
                         linewidth=1.0,
+                        stdin_window=None,
+                        stdin_range=None,
                         savenpy=False,
+                        use_cache=True,
+                        jobs=1,
+                        clear_cache=False,
                         smooth=False,
                         peakdetect=False,
                         corrmat=None,
@@ -2187,6 +1578,10 @@ def run_script(gui_options=None):
 
     Data.plot_range = options.plot_range
 
+    cache.enabled = options.use_cache
+    if options.clear_cache:
+        cache.clear()
+
     if options.guess_filetype:
         prf = [arg for arg in args if arg.endswith('.prf')]
         for fn in prf:
@@ -2211,8 +1606,12 @@ def run_script(gui_options=None):
             raise ValueError
         exit()
 
-    data = [read_data(fn, savenpy=options.savenpy, wl=options.wavelength)
-            for fn in args]  # returns data objects
+    data = []  # data objects
+    for fn, patterns, error in imap_files(read_patterns, args, jobs=options.jobs, savenpy=options.savenpy, wl=options.wavelength):
+        if error:
+            print ' >> Could not read {}, skipping. ({})'.format(fn, error)
+        else:
+            data.extend(patterns)
 
     if options.capillary:
         capillary = read_data(options.capillary)
@@ -2257,9 +1656,11 @@ def run_script(gui_options=None):
         else:
             lookahead, noise = None, None
 
+        index = build_index(options.identify_refs, wl=options.wavelength, jobs=options.jobs)
+
         for d in data:
-            f_identify(
-                d, options.compare_reference, lookahead=lookahead, noise=noise)
+            f_identify(d, index, tolerance=options.identify, lookahead=lookahead, noise=noise,
+                       wl=options.wavelength, top=options.identify_top)
     elif options.peakdetect:
         # options.show = False
         lookahead, noise = options.peakdetect
@@ -2297,10 +1698,11 @@ def run_script(gui_options=None):
         if not bg_data:
             bg_data = setup_interpolate_background(data[0])
         bg = Background(fig, d=bg_data, bg_correct=options.bg_correct, quiet=options.quiet,
-                        out=options.bg_output, topas_bg=options.topas_bg, xrs=options.xrs)
+                        out=options.bg_output, topas_bg=options.topas_bg, xrs=options.xrs,
+                        blit=not options.savefig)
     elif options.backgrounder:
         bg = Background(fig, d=bg_data, quiet=options.quiet,
-                        topas_bg=options.topas_bg, xrs=options.xrs)
+                        topas_bg=options.topas_bg, xrs=options.xrs, blit=not options.savefig)
 
     if options.crplo:
         f_crplo()
@@ -2317,7 +1719,9 @@ def run_script(gui_options=None):
             ref = None
 
         kind = options.compare-1
-        f_compare(data, kind=kind, reference=ref)
+        start, stop = options.compare_range or (None, None)
+        f_compare(data, kind=kind, reference=ref, start=start, stop=stop,
+                  step=options.compare_step, maxshift=options.compare_shift)
 
     # plt.plot(range(10),range(10))
     # plt.show()
@@ -2394,7 +1798,7 @@ def run_script(gui_options=None):
 
     if options.bin:
         for d in reversed(data):
-            dbinned = d.bin(options.bin)
+            dbinned = d.bin(options.bin, mode=options.bin_mode)
             dbinned.print_pattern()
             lines.plot(dbinned)
 
@@ -2410,7 +1814,7 @@ def run_script(gui_options=None):
     if options.quiet or not options.show:
         pass
     elif not sys.stdin.isatty():
-        plot_stdin(fig)
+        plot_stdin(fig, window=options.stdin_window, window_range=options.stdin_range)
     elif options.monitor:
         if options.monitor in ('crplot.dat', 'crplot'):
             f_monitor('crplot.dat', crplot_init, crplot_update, fig=fig)
@@ -19,17 +19,15 @@
 
 import numpy as np
 from math import pi, log
-import pylab
-from scipy import fft, ifft
-from scipy.optimize import curve_fit
+
+from filters import windows
 
 # Adapted from peakdetect.py by sixtenbe
 # https://gist.github.com/sixtenbe/1178136
 
-i = 10000
-x = np.linspace(0, 3.5 * pi, i)
-y = (0.3*np.sin(x) + np.sin(1.3 * x) + 0.9 * np.sin(4.2 * x) + 0.06 *
-     np.random.randn(i))
+# Only numpy is needed at import time, so that the module is cheap to import
+# in worker processes. scipy is imported by peakdetect_sine when it is used,
+# the tests and plots are in peakdetect_demo.py
 
 
 def _datacheck_peakdetect(x_axis, y_axis):
@@ -46,6 +44,74 @@ def _datacheck_peakdetect(x_axis, y_axis):
     return x_axis, y_axis
 
 
+def refine_peaks(x_axis, y_axis, indices, points=9):
+    """
+    Refines the positions of many peaks at once by fitting the parabola
+    y = a + b * t + c * t ** 2 (t = x - x_axis[index]) to the points around
+    each peak. The windows are gathered in a 2-D array and all fits are solved
+    together as linear least squares (batched 3x3 normal equations), instead
+    of one curve_fit per peak.
+
+    keyword arguments:
+    x_axis -- A numpy list of all the x values
+    y_axis -- A numpy list of all the y values
+    indices -- Indices of the raw peaks in x_axis/y_axis
+    points -- How many points around the peak should be used during fitting,
+        must be odd (default: 9)
+
+    return -- three arrays: x and y of the top of each parabola, and the
+        coefficients (a, b, c) of each fit. Where the fit is not a proper
+        extremum within the window, the raw peak is returned.
+    """
+    x_axis = np.asarray(x_axis, dtype=float)
+    y_axis = np.asarray(y_axis, dtype=float)
+    indices = np.asarray(indices, dtype=int)
+    half = points // 2
+
+    window = indices[:, np.newaxis] + np.arange(-half, half + 1)
+    # points outside the signal get weight 0
+    valid = (window >= 0) & (window < len(y_axis))
+    window = np.clip(window, 0, len(y_axis) - 1)
+
+    t = (x_axis[window] - x_axis[indices][:, np.newaxis]) * valid
+    y = y_axis[window] * valid
+    w = valid.astype(float)
+
+    # normal equations, t^0..t^4 and t^0..t^2 * y summed over each window
+    tp = [w, t, t*t, t*t*t, t*t*t*t]
+    s = [p.sum(axis=1) for p in tp]
+    sy = [(p * y).sum(axis=1) for p in tp[:3]]
+
+    mat = np.empty((len(indices), 3, 3))
+    for i in range(3):
+        for j in range(3):
+            mat[:, i, j] = s[i + j]
+    rhs = np.column_stack(sy)
+
+    # singular systems (i.e. fewer than 3 distinct points) keep the raw peak
+    ok = np.abs(np.linalg.det(mat)) > 1e-300
+    coeffs = np.zeros((len(indices), 3))
+    if ok.any():
+        coeffs[ok] = np.linalg.solve(mat[ok], rhs[ok][..., np.newaxis])[..., 0]
+    a, b, c = coeffs.T
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t_top = -b / (2 * c)
+        y_top = a - b * b / (4 * c)
+    t_min = np.where(valid, t, np.inf).min(axis=1)
+    t_max = np.where(valid, t, -np.inf).max(axis=1)
+    # flat or singular windows give nan/inf, they are masked before comparing;
+    # a curvature at the level of round-off also counts as flat
+    flat = np.abs(c) * (t_max - t_min)**2 <= 1e-10 * np.abs(y).max(axis=1)
+    ok &= ~flat & np.isfinite(t_top)
+    t_top = np.where(ok, t_top, 0)
+    ok &= (t_top >= t_min) & (t_top <= t_max)
+
+    x_peak = np.where(ok, x_axis[indices] + t_top, x_axis[indices])
+    y_peak = np.where(ok, y_top, y_axis[indices])
+    return x_peak, y_peak, coeffs
+
+
 def _peakdetect_parabole_fitter(raw_peaks, x_axis, y_axis, points):
     """
     Performs the actual parabole fitting for the peakdetect_parabole function.
@@ -62,31 +128,20 @@ def _peakdetect_parabole_fitter(raw_peaks, x_axis, y_axis, points):
         [[x, y, [fitted_x, fitted_y]]]
 
     """
-    func = lambda x, k, tau, m: k * ((x - tau) ** 2) + m
-    fitted_peaks = []
-    for peak in raw_peaks:
-        index = peak[0]
-        x_data = x_axis[index - points // 2: index + points // 2 + 1]
-        y_data = y_axis[index - points // 2: index + points // 2 + 1]
-        # get a first approximation of tau (peak position in time)
-        tau = x_axis[index]
-        # get a first approximation of peak amplitude
-        m = peak[1]
-
-        # build list of approximations
-        # k = -m as first approximation?
-        p0 = (-m, tau, m)
-        popt, pcov = curve_fit(func, x_data, y_data, p0)
-        # retrieve tau and m i.e x and y value of peak
-        x, y = popt[1:3]
+    if not len(raw_peaks):
+        return []
 
-        # create a high resolution data set for the fitted waveform
-        x2 = np.linspace(x_data[0], x_data[-1], points * 10)
-        y2 = func(x2, *popt)
+    indices = np.array([peak[0] for peak in raw_peaks], dtype=int)
+    x_peak, y_peak, coeffs = refine_peaks(x_axis, y_axis, indices, points)
 
-        fitted_peaks.append([x, y, [x2, y2]])
+    # create a high resolution data set for the fitted waveform
+    lo = x_axis[np.clip(indices - points // 2, 0, len(x_axis) - 1)]
+    hi = x_axis[np.clip(indices + points // 2, 0, len(x_axis) - 1)]
+    x2 = lo[:, np.newaxis] + (hi - lo)[:, np.newaxis] * np.linspace(0, 1, points * 10)
+    t2 = x2 - x_axis[indices][:, np.newaxis]
+    y2 = coeffs[:, 0:1] + coeffs[:, 1:2] * t2 + coeffs[:, 2:3] * t2 * t2
 
-    return fitted_peaks
+    return [[x, y, [x2_, y2_]] for x, y, x2_, y2_ in zip(x_peak, y_peak, x2, y2)]
 
 
 def peakdetect(y_axis, x_axis=None, lookahead=300, delta=0):
@@ -111,8 +166,10 @@ def peakdetect(y_axis, x_axis=None, lookahead=300, delta=0):
         to hinder the function from picking up false peaks towards to end of
         the signal. To work well delta should be set to delta >= RMSnoise * 5.
         (default: 0)
-            delta function causes a 20% decrease in speed, when omitted
-            Correctly used it can double the speed of the function
+
+    The signal is not walked point by point: the look ahead maxima/minima are
+    calculated for all points at once (_sliding_max), and every peak is found
+    with a vectorized search from the previous one (_find_peak).
 
     return -- two lists [max_peaks, min_peaks] containing the positive and
         negative peaks respectively. Each cell of the lists contains a tupple
@@ -121,10 +178,6 @@ def peakdetect(y_axis, x_axis=None, lookahead=300, delta=0):
         results to unpack one of the lists into x, y coordinates do:
         x, y = zip(*tab)
     """
-    max_peaks = []
-    min_peaks = []
-    dump = []  # Used to pop the first hit which almost always is false
-
     # check input data
     x_axis, y_axis = _datacheck_peakdetect(x_axis, y_axis)
     # store data length for later use
@@ -136,69 +189,103 @@ def peakdetect(y_axis, x_axis=None, lookahead=300, delta=0):
     if not (np.isscalar(delta) and delta >= 0):
         raise ValueError("delta must be a positive number")
 
-    # maxima and minima candidates are temporarily stored in
-    # mx and mn respectively
-    mn, mx = np.Inf, -np.Inf
-
     # Only detect peak if there is 'lookahead' amount of points after it
-    for index, (x, y) in enumerate(zip(x_axis[:-lookahead],
-                                       y_axis[:-lookahead])):
-        if y > mx:
-            mx = y
-            mxpos = x
-        if y < mn:
-            mn = y
-            mnpos = x
-
-        # look for max
-        if y < mx-delta and mx != np.Inf:
-            # Maxima peak candidate found
-            # look ahead in signal to ensure that this is a peak and not jitter
-            if y_axis[index:index+lookahead].max() < mx:
-                max_peaks.append([mxpos, mx])
-                dump.append(True)
-                # set algorithm to only find minima now
-                mx = np.Inf
-                mn = np.Inf
-                if index+lookahead >= length:
-                    # end is within lookahead no more peaks can be found
-                    break
-                continue
-            # else:  #slows shit down this does
-            #    mx = ahead
-            #    mxpos = x_axis[np.where(y_axis[index:index+lookahead]==mx)]
-
-        # look for min
-        if y > mn+delta and mn != -np.Inf:
-            # Minima peak candidate found
-            # look ahead in signal to ensure that this is a peak and not jitter
-            if y_axis[index:index+lookahead].min() > mn:
-                min_peaks.append([mnpos, mn])
-                dump.append(False)
-                # set algorithm to only find maxima now
-                mn = -np.Inf
-                mx = -np.Inf
-                if index+lookahead >= length:
-                    # end is within lookahead no more peaks can be found
-                    break
-            # else:  #slows shit down this does
-            #    mn = ahead
-            #    mnpos = x_axis[np.where(y_axis[index:index+lookahead]==mn)]
+    stop = length - lookahead
+    if stop <= 0:
+        return [[], []]
+
+    # the maximum/minimum of y_axis[index:index+lookahead] for every index,
+    # minima are found as the maxima of the negated signal
+    y_pos = np.asarray(y_axis, dtype=float)
+    y_neg = -y_pos
+    ahead_max = _sliding_max(y_pos, lookahead)
+    ahead_min_neg = _sliding_max(y_neg, lookahead)
+
+    # at the start, maxima and minima are searched for at the same time
+    found_max = _find_peak(y_pos, ahead_max, 0, stop, delta)
+    found_min = _find_peak(y_neg, ahead_min_neg, 0, stop, delta)
+    if found_max is None and found_min is None:
+        return [[], []]
+    is_max = found_min is None or (found_max is not None and found_max[0] <= found_min[0])
+    index, pos = found_max if is_max else found_min
+
+    # afterwards, the search alternates between maxima and minima
+    peaks = []
+    while True:
+        peaks.append((is_max, pos))
+        is_max = not is_max
+        if is_max:
+            found = _find_peak(y_pos, ahead_max, index + 1, stop, delta)
+        else:
+            found = _find_peak(y_neg, ahead_min_neg, index + 1, stop, delta)
+        if found is None:
+            break
+        index, pos = found
 
     # Remove the false hit on the first value of the y_axis
-    try:
-        if dump[0]:
-            max_peaks.pop(0)
-        else:
-            min_peaks.pop(0)
-        del dump
-    except IndexError:
-        # no peaks were found, should the function return empty lists?
-        pass
+    peaks = peaks[1:]
+
+    max_peaks = [[x_axis[pos], y_axis[pos]] for is_max, pos in peaks if is_max]
+    min_peaks = [[x_axis[pos], y_axis[pos]] for is_max, pos in peaks if not is_max]
 
     return [max_peaks, min_peaks]
 
 
+def _sliding_max(y, n):
+    """
+    Returns the maximum of y[i:i+n] for every i in range(len(y) - n + 1), in
+    O(len(y)) independent of n (van Herk/Gil-Werman): the signal is cut into
+    blocks of n, for which the running maxima from the left and from the
+    right are calculated. Every window covers the end of one block and the
+    start of the next.
+    """
+    length = len(y)
+    nblocks = -(-length // n)
+    padded = np.full(nblocks * n, -np.inf)
+    padded[:length] = y
+    blocks = padded.reshape(nblocks, n)
+
+    from_left = np.maximum.accumulate(blocks, axis=1).ravel()
+    from_right = np.maximum.accumulate(blocks[:, ::-1], axis=1)[:, ::-1].ravel()
+
+    index = np.arange(length - n + 1)
+    return np.maximum(from_right[index], from_left[index + n - 1])
+
+
+def _find_peak(y_axis, ahead_max, start, stop, delta, blocksize=256):
+    """
+    Searches for the first maximum after start, as the loop in the original
+    peakdetect: the candidate mx is the running maximum of y_axis[start:index+1],
+    and is accepted at the first index where y_axis[index] < mx - delta and
+    y_axis[index:index+lookahead].max() (ahead_max[index]) < mx.
+
+    The running maximum is calculated with np.maximum.accumulate in blocks of
+    growing size, so that the work is proportional to the distance to the peak.
+
+    return -- (index, position of the maximum), or None if there is none
+        before stop
+    """
+    carry = None
+    i = start
+    while i < stop:
+        j = min(i + blocksize, stop)
+        y = y_axis[i:j]
+        mx = np.maximum.accumulate(y)
+        if carry is not None:
+            np.maximum(mx, carry, out=mx)
+        hit = (ahead_max[i:j] < mx)
+        if delta:
+            hit &= (y < mx - delta)
+        if hit.any():
+            index = i + hit.argmax()
+            # the first occurrence of the maximum is kept, as with 'y > mx'
+            return index, start + y_axis[start:index + 1].argmax()
+        carry = mx[-1]
+        i = j
+        blocksize *= 2
+    return None
+
+
 def peakdetect_fft(y_axis, x_axis, pad_len=5):
     """
     Performs a FFT calculation on the data and zero-pads the results to
@@ -215,13 +302,10 @@ def peakdetect_fft(y_axis, x_axis, pad_len=5):
     minimize spectral leakage by calculating the fft between two zero
     crossings for n amount of signal periods.
 
-    The biggest time eater in this function is the ifft and thereafter it's
-    the 'peakdetect' function which takes only half the time of the ifft.
-    Speed improvementd could include to check if 2**n points could be used for
-    fft and ifft or change the 'peakdetect' to the 'peakdetect_zero_crossing',
-    which is maybe 10 times faster than 'peakdetct'. The pro of 'peakdetect'
-    is that it resutls in one less lost peak. It should also be noted that the
-    time used by the ifft function can change greatly depending on the input.
+    The spectrum is calculated with rfft and zero-padded in a preallocated
+    array of 2**n samples before irfft. The peaks of the interpolated waveform
+    are found by 'peakdetect' as indices, which map directly onto the
+    interpolated x-axis.
 
     keyword arguments:
     y_axis -- A list containg the signal over which to find peaks
@@ -248,55 +332,65 @@ def peakdetect_fft(y_axis, x_axis, pad_len=5):
     # are discardable as any errors induced from not using whole periods
     # should mainly manifest in the beginning and the end of the signal, but
     # not in the rest of the signal
-    fft_data = fft(y_axis[zero_indices[0]:zero_indices[last_indice]])
-    padd = lambda x, c: x[:len(x) // 2] + [0] * c + x[len(x) // 2:]
-    n = lambda x: int(log(x)/log(2)) + 1
-    # padds to 2**n amount of samples
-    fft_padded = padd(list(fft_data), 2 **
-                      n(len(fft_data) * pad_len) - len(fft_data))
+    start, stop = zero_indices[0], zero_indices[last_indice]
+    segment = np.asarray(y_axis[start:stop], dtype=float)
+    length = len(segment)
+    fft_data = _rfft(segment)
+
+    # padds to 2**n amount of samples, the zeros go above the highest frequency
+    n_padded = 2 ** (int(log(length * pad_len) / log(2)) + 1)
+    fft_padded = np.zeros(n_padded // 2 + 1, dtype=complex)
+    fft_padded[:len(fft_data)] = fft_data
 
     # There is amplitude decrease directly proportional to the sample increase
-    sf = len(fft_padded) / float(len(fft_data))
-    # There might be a leakage giving the result an imaginary component
-    # Return only the real component
-    y_axis_ifft = ifft(fft_padded).real * sf  # (pad_len + 1)
-    x_axis_ifft = np.linspace(x_axis[zero_indices[0]], x_axis[zero_indices[last_indice]],
-                              len(y_axis_ifft))
-    # get the peaks to the interpolated waveform
-    max_peaks, min_peaks = peakdetect(y_axis_ifft, x_axis_ifft, 500,
+    sf = n_padded / float(length)
+    y_axis_ifft = np.fft.irfft(fft_padded, n_padded) * sf
+
+    # sample i of the interpolated waveform lies at (fractional) index
+    # start + i * length / n_padded of the input
+    index_ifft = start + np.arange(n_padded) * (length / float(n_padded))
+    x_axis_ifft = np.interp(index_ifft, np.arange(len(x_axis)), x_axis)
+
+    # get the peaks to the interpolated waveform, as indices
+    max_peaks, min_peaks = peakdetect(y_axis_ifft, None, 500,
                                       delta=abs(np.diff(y_axis).max() * 2))
-    # max_peaks, min_peaks = peakdetect_zero_crossing(y_axis_ifft, x_axis_ifft)
-
-    # store one 20th of a period as waveform data
-    data_len = int(np.diff(zero_indices).mean()) / 10
-    data_len += 1 - data_len & 1
-
-    fitted_wave = []
-    for peaks in [max_peaks, min_peaks]:
-        peak_fit_tmp = []
-        index = 0
-        for peak in peaks:
-            index = np.where(x_axis_ifft[index:] == peak[0])[0][0] + index
-            x_fit_lim = x_axis_ifft[index - data_len // 2:
-                                    index + data_len // 2 + 1]
-            y_fit_lim = y_axis_ifft[index - data_len // 2:
-                                    index + data_len // 2 + 1]
-
-            peak_fit_tmp.append([x_fit_lim, y_fit_lim])
-        fitted_wave.append(peak_fit_tmp)
-
-    # pylab.plot(range(len(fft_data)), fft_data)
-    # pylab.show()
 
-    pylab.plot(x_axis, y_axis)
-    pylab.hold(True)
-    pylab.plot(x_axis_ifft, y_axis_ifft)
-    # for max_p in max_peaks:
-    #    pylab.plot(max_p[0], max_p[1], 'xr')
-    pylab.show()
+    max_peaks = [[x_axis_ifft[index], y] for index, y in max_peaks]
+    min_peaks = [[x_axis_ifft[index], y] for index, y in min_peaks]
+
     return [max_peaks, min_peaks]
 
 
+def _rfft(y):
+    """
+    np.fft.rfft for any length. The segment between two zero crossings has an
+    arbitrary length, for which fftpack can be very slow (large prime factors).
+    Those lengths are transformed with Bluestein's algorithm instead, which
+    only needs power-of-two FFTs.
+    """
+    length = len(y)
+    rest = length
+    for p in (2, 3, 5):
+        while rest % p == 0:
+            rest //= p
+    if rest == 1:
+        return np.fft.rfft(y)
+
+    k = np.arange(length)
+    # k**2 modulo 2*length keeps the phase of the chirp accurate
+    chirp = np.exp(-1j * np.pi * ((k * k) % (2 * length)) / length)
+    n_fft = 2 ** int(np.ceil(np.log2(2 * length - 1)))
+
+    a = np.zeros(n_fft, dtype=complex)
+    a[:length] = y * chirp
+    b = np.zeros(n_fft, dtype=complex)
+    b[:length] = chirp.conj()
+    b[n_fft - length + 1:] = chirp[1:][::-1].conj()
+
+    conv = np.fft.ifft(np.fft.fft(a) * np.fft.fft(b))[:length // 2 + 1]
+    return conv * chirp[:length // 2 + 1]
+
+
 def peakdetect_parabole(y_axis, x_axis, points=9):
     """
     Function for detecting local maximas and minmias in a signal.
@@ -419,6 +513,8 @@ def peakdetect_sine(y_axis, x_axis, points=9, lock_frequency=False):
             Hz.append(np.mean(np.diff(peak_pos)))
     Hz = 1 / np.mean(Hz)
 
+    from scipy.optimize import curve_fit
+
     # model function
     # if cosine is used then tau could equal the x position of the peak
     # if sine were to be used then tau would be the first zero crossing
@@ -623,10 +719,7 @@ def _smooth(x, window_len=11, window='hanning'):
 
     s = np.r_[x[window_len-1:0:-1], x, x[-1:-window_len:-1]]
     # print(len(s))
-    if window == 'flat':  # moving average
-        w = np.ones(window_len, 'd')
-    else:
-        w = eval('np.' + window + '(window_len)')
+    w = windows[window](window_len)
 
     y = np.convolve(w / w.sum(), s, mode='valid')
     return y
@@ -666,62 +759,3 @@ def zero_crossings(y_axis, window=11):
 
     return indices
 
-
-def _test_zero():
-    _max, _min = peakdetect_zero_crossing(y, x)
-
-
-def _test():
-    _max, _min = peakdetect(y, x, delta=0.30)
-
-
-def _test_graph():
-    i = 10000
-    x = np.linspace(0, 3.7*pi, i)
-    y = (0.3*np.sin(x) + np.sin(1.3 * x) + 0.9 * np.sin(4.2 * x) + 0.06 *
-         np.random.randn(i))
-    y *= -1
-    x = range(i)
-
-    _max, _min = peakdetect(y, x, 750, 0.30)
-    xm = [p[0] for p in _max]
-    ym = [p[1] for p in _max]
-    xn = [p[0] for p in _min]
-    yn = [p[1] for p in _min]
-
-    plot = pylab.plot(x, y)
-    pylab.hold(True)
-    pylab.plot(xm, ym, 'r+')
-    pylab.plot(xn, yn, 'g+')
-
-    _max, _min = peakdetect(y, 0.7, x)
-    xm = [p[0] for p in _max]
-    ym = [p[1] for p in _max]
-    xn = [p[0] for p in _min]
-    yn = [p[1] for p in _min]
-    pylab.plot(xm, ym, 'y*')
-    pylab.plot(xn, yn, 'k*')
-    pylab.show()
-
-if __name__ == "__main__":
-    from math import pi
-    import pylab
-
-    i = 10000
-    x = np.linspace(0, 3.7*pi, i)
-    y = (0.3*np.sin(x) + np.sin(1.3 * x) + 0.9 * np.sin(4.2 * x) + 0.06 *
-         np.random.randn(i))
-    y *= -1
-
-    _max, _min = peakdetect(y, x, 750, 0.30)
-    xm = [p[0] for p in _max]
-    ym = [p[1] for p in _max]
-    xn = [p[0] for p in _min]
-    yn = [p[1] for p in _min]
-
-    plot = pylab.plot(x, y)
-    pylab.hold(True)
-    pylab.plot(xm, ym, 'r+')
-    pylab.plot(xn, yn, 'g+')
-
-    pylab.show()
@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+
+#    Lines - a python plotting program
+#    Copyright (C) 2015 Stef Smeets
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License along
+#    with this program; if not, write to the Free Software Foundation, Inc.,
+#    51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""Tests and plots for peakdetect.py, run this module to show the detected peaks of a test signal"""
+
+import numpy as np
+from math import pi
+
+from peakdetect import peakdetect, peakdetect_zero_crossing
+
+
+def test_signal(i=10000, stop=3.5*pi):
+    """Returns x, y of a sum of sines with noise"""
+    x = np.linspace(0, stop, i)
+    y = (0.3*np.sin(x) + np.sin(1.3 * x) + 0.9 * np.sin(4.2 * x) + 0.06 *
+         np.random.randn(i))
+    return x, y
+
+
+def _test_zero():
+    x, y = test_signal()
+    _max, _min = peakdetect_zero_crossing(y, x)
+
+
+def _test():
+    x, y = test_signal()
+    _max, _min = peakdetect(y, x, delta=0.30)
+
+
+def _plot_peaks(x, y, lookahead, delta, markers=('r+', 'g+')):
+    import matplotlib.pyplot as plt
+
+    _max, _min = peakdetect(y, x, lookahead, delta)
+    xm = [p[0] for p in _max]
+    ym = [p[1] for p in _max]
+    xn = [p[0] for p in _min]
+    yn = [p[1] for p in _min]
+
+    plt.plot(xm, ym, markers[0])
+    plt.plot(xn, yn, markers[1])
+
+
+def _test_graph():
+    import matplotlib.pyplot as plt
+
+    x, y = test_signal(stop=3.7*pi)
+    y *= -1
+    x = np.arange(len(y))
+
+    plt.plot(x, y)
+    _plot_peaks(x, y, 750, 0.30)
+    _plot_peaks(x, y, 750, 0.7, markers=('y*', 'k*'))
+    plt.show()
+
+
+def main():
+    import matplotlib.pyplot as plt
+
+    x, y = test_signal(stop=3.7*pi)
+    y *= -1
+
+    plt.plot(x, y)
+    _plot_peaks(x, y, 750, 0.30)
+    plt.show()
+
+
+if __name__ == '__main__':
+    main()
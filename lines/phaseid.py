@@ -0,0 +1,264 @@
+#!/usr/bin/env python
+
+#    Lines - a python plotting program
+#    Copyright (C) 2015 Stef Smeets
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License along
+#    with this program; if not, write to the Free Software Foundation, Inc.,
+#    51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""Search/match of observed peak positions against a library of reference phases.
+
+The lines of all references are kept in one index, sorted by d-spacing, so that
+it does not depend on the wavelength of the unknown. For every observed peak the
+candidate lines are found with np.searchsorted in a window of +-tolerance
+(given in degrees 2theta, converted to a window in d for every peak), and
+scored per reference with np.bincount. No loop over the references is needed.
+
+Only lists of lines (d, intensity) are indexed. The lines of cif files are
+taken from library.py (precomputed for zeolite_database, or calculated with
+library.cif_lines), tick files are read directly. Reference intensities are
+stored without Lorentz-polarization; it is applied for the wavelength of the
+unknown at match time.
+
+The figure of merit of a reference is the product of
+    - the fraction of the observed intensity that is explained by its lines
+    - the fraction of its intensity (within the observed range) that is observed
+    - 1 - mean(position error) / (2*tolerance)
+so that 1.0 is a perfect match."""
+
+import os
+import glob
+import json
+import hashlib
+
+import numpy as np
+
+import cache
+from core import LINESDIR, twotheta2d, d2twotheta, lorentz_polarization
+from library import get_library, framework_code, cif_lines
+
+# lines weaker than this (percentage of the strongest line, approximate
+# Lorentz-polarization) are not included in the index
+min_intensity = 0.5
+
+
+class PeakIndex(object):
+    """Lines of many references, sorted by d-spacing
+
+    d: d-spacings of all lines
+    intensity: intensities of all lines, without Lorentz-polarization
+    ref: index in names of the reference every line belongs to"""
+
+    def __init__(self, names, d, intensity, ref):
+        order = np.argsort(d, kind='mergesort')
+        self.names = list(names)
+        self.d = np.asarray(d, dtype=float)[order]
+        self.intensity = np.asarray(intensity, dtype=float)[order]
+        self.ref = np.asarray(ref, dtype=int)[order]
+
+    def __len__(self):
+        return len(self.names)
+
+    @classmethod
+    def from_references(cls, references):
+        """Builds index from list of (name, d, intensity)"""
+        names, ds, intensities, refs = [], [], [], []
+        for name, d, intensity in references:
+            d = np.asarray(d, dtype=float)
+            intensity = np.asarray(intensity, dtype=float)
+            if not len(d) or not intensity.max() > 0:
+                print ' >> Skipping {}: no lines'.format(name)
+                continue
+
+            # approximate LP factor (~d^2) to select the visible lines independent of wavelength
+            visible = intensity * d**2
+            sel = visible >= visible.max() * min_intensity / 100.0
+            d = d[sel]
+            intensity = intensity[sel] / visible.max() * 100
+
+            refs.append(np.full(len(d), len(names), dtype=int))
+            names.append(name)
+            ds.append(d)
+            intensities.append(intensity)
+
+        if not names:
+            return cls([], [], [], [])
+        return cls(names, np.concatenate(ds), np.concatenate(intensities), np.concatenate(refs))
+
+    @classmethod
+    def load(cls, fn):
+        f = np.load(fn)
+        return cls(f['names'].tolist(), f['d'], f['intensity'], f['ref'])
+
+    def save(self, fn):
+        np.savez(fn, names=np.array(self.names), d=self.d, intensity=self.intensity, ref=self.ref)
+
+    def merge(self, other):
+        """Returns new index with the references of self and other"""
+        n = len(self.names)
+        return PeakIndex(self.names + other.names,
+                         np.concatenate((self.d, other.d)),
+                         np.concatenate((self.intensity, other.intensity)),
+                         np.concatenate((self.ref, other.ref + n)))
+
+    def match(self, twotheta, intensity=None, wl=1.0, tolerance=0.05, top=10):
+        """Matches observed peaks (degrees 2theta at wavelength wl) against all references.
+
+        Returns list of (fom, name, nmatched, explained, observed) for the top best
+        references, sorted by fom (see module docstring)"""
+        twotheta = np.asarray(twotheta, dtype=float)
+        if intensity is None:
+            intensity = np.ones_like(twotheta)
+        intensity = np.asarray(intensity, dtype=float)
+        nref = len(self.names)
+
+        if not len(twotheta) or not nref:
+            return []
+
+        d_obs = twotheta2d(twotheta, wl)
+        # d = wl / 2sin(th) -> delta_d = d * cot(th) * delta_2th / 2
+        delta = d_obs / np.tan(np.radians(twotheta / 2)) * np.radians(tolerance) / 2
+
+        # lines below wl/2 cannot be observed
+        dlim = np.searchsorted(self.d, wl / 2.0, side='right')
+
+        lo = np.maximum(np.searchsorted(self.d, d_obs - delta, side='left'), dlim)
+        hi = np.searchsorted(self.d, d_obs + delta, side='right')
+        counts = np.maximum(hi - lo, 0)
+        total = counts.sum()
+        if not total:
+            return []
+
+        # all (observed peak, candidate line) pairs in the windows
+        obs = np.repeat(np.arange(len(d_obs)), counts)
+        line = np.arange(total) - np.repeat(np.cumsum(counts) - counts, counts) + np.repeat(lo, counts)
+        ref = self.ref[line]
+        err = np.abs(self.d[line] - d_obs[obs]) / delta[obs]
+
+        # per reference, every observed peak is assigned to its nearest line
+        order = np.lexsort((err, obs, ref))
+        obs, line, ref, err = obs[order], line[order], ref[order], err[order]
+        first = np.ones(len(obs), dtype=bool)
+        first[1:] = (ref[1:] != ref[:-1]) | (obs[1:] != obs[:-1])
+        obs, line, ref, err = obs[first], line[first], ref[first], err[first]
+
+        nmatched = np.bincount(ref, minlength=nref)
+        explained = np.bincount(ref, weights=intensity[obs], minlength=nref) / intensity.sum()
+        mean_err = np.bincount(ref, weights=err, minlength=nref) / np.maximum(nmatched, 1)
+
+        # reference intensity at the wavelength of the unknown, in the observed range
+        start = max(np.searchsorted(self.d, (d_obs - delta).min(), side='left'), dlim)
+        stop = np.searchsorted(self.d, (d_obs + delta).max(), side='right')
+        lp = lorentz_polarization(d2twotheta(self.d[start:stop], wl))
+        in_range = np.bincount(self.ref[start:stop], weights=self.intensity[start:stop] * lp, minlength=nref)
+
+        line = np.unique(line)
+        lp = lorentz_polarization(d2twotheta(self.d[line], wl))
+        found = np.bincount(self.ref[line], weights=self.intensity[line] * lp, minlength=nref)
+        observed = found / np.where(in_range > 0, in_range, 1)
+
+        fom = explained * observed * (1 - mean_err / 2)
+
+        best = np.argsort(-fom, kind='mergesort')[:top]
+        best = best[nmatched[best] > 0]
+        return [(fom[i], self.names[i], nmatched[i], explained[i], observed[i]) for i in best]
+
+
+def reference_lines(fn, wl=1.0, dmin=1.0):
+    """Returns (name, d, intensity) for reference fn: a cif file, or a text file with
+    tick marks in degrees 2theta at wavelength wl (first column) and optionally
+    their intensities (second column)"""
+    name = os.path.splitext(os.path.basename(fn))[0]
+
+    if fn.lower().endswith('.cif'):
+        d, intensity = cif_lines(fn, dmin=dmin)
+        return name, d, intensity
+
+    arr = np.atleast_2d(np.loadtxt(fn, ndmin=2))
+    twotheta = arr[:, 0]
+    if arr.shape[1] > 1:
+        intensity = arr[:, 1]
+    else:
+        intensity = np.ones_like(twotheta)
+    sel = (twotheta > 0) & (intensity > 0)
+    twotheta, intensity = twotheta[sel], intensity[sel]
+
+    # observed intensities include Lorentz-polarization, the index does not
+    return name, twotheta2d(twotheta, wl), intensity / lorentz_polarization(twotheta)
+
+
+def _database_lines(fn, dmin=1.0):
+    """Module level for imap_files, database entries are named after the framework code"""
+    name, d, intensity = reference_lines(fn, dmin=dmin)
+    return framework_code(fn), d, intensity
+
+
+def database_index(dmin=1.0, jobs=1):
+    """Returns PeakIndex of all cif files in zeolite_database, from the library (see
+    library.py) if it has been built. Otherwise, the lines are calculated and the
+    index is stored in the cache directory, and only rebuilt when the database changes"""
+    from batch import imap_files
+
+    lib = get_library()
+    if lib and lib.header['dmin'] <= dmin:
+        references = []
+        for code in lib.codes():
+            d, intensity = lib.lines(code)
+            sel = d >= dmin
+            references.append((code, d[sel], intensity[sel]))
+        return PeakIndex.from_references(references)
+
+    fns = sorted(glob.glob(os.path.join(LINESDIR, 'zeolite_database', '*.cif')))
+
+    key = json.dumps([dmin, min_intensity] + [(os.path.basename(fn), os.path.getsize(fn),
+                                               os.path.getmtime(fn)) for fn in fns])
+    root = os.path.join(cache.CACHE_DIR, 'phaseid-' + hashlib.sha1(key).hexdigest())
+
+    if cache.enabled and os.path.exists(root + '.npz'):
+        try:
+            return PeakIndex.load(root + '.npz')
+        except (IOError, ValueError, KeyError):
+            pass
+
+    print 'Indexing {} structures in zeolite_database (once)...'.format(len(fns))
+
+    references = []
+    for fn, result, error in imap_files(_database_lines, fns, jobs=jobs, dmin=dmin):
+        if error:
+            print ' >> Skipping {}: {}'.format(fn, error)
+        else:
+            references.append(result)
+    index = PeakIndex.from_references(references)
+
+    if cache.enabled:
+        try:
+            if not os.path.isdir(cache.CACHE_DIR):
+                os.makedirs(cache.CACHE_DIR)
+            tmp = '{}.{}.npz.tmp'.format(root, os.getpid())
+            with open(tmp, 'wb') as f:
+                index.save(f)
+            cache._replace(tmp, root + '.npz')
+        except (IOError, OSError), e:
+            print ' >> Could not write index to cache: {}'.format(e)
+
+    return index
+
+
+def build_index(fns=(), wl=1.0, dmin=1.0, database=True, jobs=1):
+    """Returns PeakIndex of the reference files fns (see reference_lines), and the
+    structures in zeolite_database if database is True"""
+    index = PeakIndex.from_references([reference_lines(fn, wl=wl, dmin=dmin) for fn in fns])
+    if database:
+        index = index.merge(database_index(dmin=dmin, jobs=jobs))
+    return index
@@ -0,0 +1,386 @@
+#!/usr/bin/env python
+
+#    Lines - a python plotting program
+#    Copyright (C) 2015 Stef Smeets
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License along
+#    with this program; if not, write to the Free Software Foundation, Inc.,
+#    51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""Similarity between powder patterns (lines --compare).
+
+All patterns are resampled once on a common grid into a matrix with one pattern
+per row. The correlation coefficients for all pairs are then obtained as
+matrix products:
+
+    pearson:  rows centered and scaled to unit length, R = Z.Z^T
+    spearman: the same, on the ranks of every row (computed once per pattern)
+    kendall:  tau-b, the normalized product of the signs of all pairwise
+              differences within every row, accumulated per lag
+
+The left operand can be processed in chunks of rows to limit memory use.
+
+To tolerate zero-shift errors, the best shift between every pair of patterns can
+be found from their cross-correlation (computed with FFT). Only the pairs with
+a non-zero shift are then compared again, with one pattern shifted."""
+
+import numpy as np
+
+# number of shifted pairs that are compared at once by similarity()
+pair_blocksize = 2048
+
+
+def common_grid(patterns, start=None, stop=None, step=None):
+    """Returns grid for resample(). By default, the range where all patterns overlap
+    is used, with the largest step size of all patterns"""
+    if start is None:
+        start = max(d.x.min() for d in patterns)
+    if stop is None:
+        stop = min(d.x.max() for d in patterns)
+    if step is None:
+        step = max(np.median(np.diff(d.x)) for d in patterns)
+    if stop <= start:
+        raise ValueError('Patterns do not overlap, specify a range for the comparison')
+    return np.arange(start, stop + 0.5*step, step)
+
+
+def resample(patterns, xvals):
+    """Returns matrix with the y values of all patterns (list of Data) interpolated
+    at xvals, one row per pattern. Points outside the range of a pattern are NaN"""
+    Y = np.empty((len(patterns), len(xvals)))
+    for i, d in enumerate(patterns):
+        Y[i] = np.interp(xvals, d.x, d.y, left=np.nan, right=np.nan)
+    return Y
+
+
+def rank_rows(Y):
+    """Ranks (1..m) of the values in every row of Y, ties get their average rank
+    (like scipy.stats.rankdata)"""
+    n, m = Y.shape
+    order = Y.argsort(axis=1, kind='mergesort')
+    rows = np.arange(n)[:, np.newaxis]
+    s = Y[rows, order]
+
+    # start of every group of equal values, groups do not run across rows
+    first = np.ones((n, m), dtype=bool)
+    first[:, 1:] = s[:, 1:] != s[:, :-1]
+    first = first.ravel()
+
+    group = np.cumsum(first) - 1
+    start = np.flatnonzero(first) % m
+    count = np.bincount(group)
+    avg = start + (count - 1) / 2.0 + 1
+
+    ranks = np.empty((n, m))
+    ranks[rows, order] = avg[group].reshape(n, m)
+    return ranks
+
+
+def _standardize(Y):
+    Z = Y - Y.mean(axis=1)[:, np.newaxis]
+    norm = np.sqrt((Z**2).sum(axis=1))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return Z / norm[:, np.newaxis]  # constant rows -> NaN
+
+
+def _chunked_dot(A, B, chunksize=None):
+    """A.B^T, computed for chunksize rows of A at a time"""
+    if not chunksize:
+        return np.dot(A, B.T)
+    out = np.empty((len(A), len(B)))
+    for i in range(0, len(A), chunksize):
+        out[i:i+chunksize] = np.dot(A[i:i+chunksize], B.T)
+    return out
+
+
+def pearson_matrix(A, B=None, chunksize=None):
+    """Pearson correlation coefficients between all rows of A and all rows of B
+    (default: B = A), shape (len(A), len(B))"""
+    ZA = _standardize(A)
+    ZB = ZA if B is None else _standardize(B)
+    return np.clip(_chunked_dot(ZA, ZB, chunksize=chunksize), -1, 1)
+
+
+def spearman_matrix(A, B=None, chunksize=None):
+    """Spearman rank correlation coefficients between all rows of A and B"""
+    RA = rank_rows(A)
+    RB = RA if B is None else rank_rows(B)
+    return pearson_matrix(RA, RB, chunksize=chunksize)
+
+
+def kendall_matrix(A, B=None, chunksize=None):
+    """Kendall's tau-b between all rows of A and B (same as scipy.stats.kendalltau).
+    The number of operations scales with the square of the number of columns, so
+    usually a subsample of the columns is passed"""
+    same = B is None
+    if same:
+        B = A
+
+    m = A.shape[1]
+    num = np.zeros((len(A), len(B)))
+    na = np.zeros(len(A))
+    nb = np.zeros(len(B))
+
+    for lag in range(1, m):
+        SA = np.sign(A[:, lag:] - A[:, :-lag]).astype(np.float32)
+        SB = SA if same else np.sign(B[:, lag:] - B[:, :-lag]).astype(np.float32)
+        num += _chunked_dot(SA, SB, chunksize=chunksize)
+        na += np.abs(SA).sum(axis=1)
+        nb += np.abs(SB).sum(axis=1)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return num / np.sqrt(na[:, np.newaxis] * nb[np.newaxis, :])
+
+
+def _sorted_groups(s):
+    """Flags for the first element of every group of equal values in the rows of s
+    (sorted along axis 1), and the number of tied pairs in every row"""
+    n, m = s.shape
+    first = np.ones((n, m), dtype=bool)
+    first[:, 1:] = s[:, 1:] != s[:, :-1]
+
+    starts = np.flatnonzero(first)
+    t = np.diff(np.r_[starts, n*m])
+    ties = np.bincount(starts // m, weights=t*(t-1)/2.0, minlength=n)
+    return first, ties
+
+
+def _dense_ranks(Y):
+    """Ranks 0, 1, 2 ... of the values in every row, equal values get the same rank"""
+    n, m = Y.shape
+    order = Y.argsort(axis=1, kind='mergesort')
+    rows = np.arange(n)[:, np.newaxis]
+    first, ties = _sorted_groups(Y[rows, order])
+
+    ranks = np.empty((n, m), dtype=int)
+    ranks[rows, order] = np.cumsum(first, axis=1) - 1
+    return ranks, ties
+
+
+def kendall_pairs(A, B):
+    """Kendall's tau-b between A[i] and B[i], for every row i. Uses Knight's
+    algorithm (sort by A, count the discordant pairs as inversions in B with a
+    binary indexed tree), which runs in m log m steps for all rows at once"""
+    n, m = A.shape
+    rows = np.arange(n)[:, np.newaxis]
+
+    ra, ties_a = _dense_ranks(A)
+    rb, ties_b = _dense_ranks(B)
+
+    # sort by a, then b
+    order = np.argsort(ra * m + rb, axis=1, kind='mergesort')
+    sa = ra[rows, order]
+    sb = rb[rows, order]
+    ties_ab = _sorted_groups(sa * m + sb)[1]
+
+    # count pairs that come later in this order, but have a lower rank in b
+    levels = int(m).bit_length()
+    width = 2**levels + 1  # the last column collects the overflow of the updates
+    tree = np.zeros(n*width, dtype=int)
+    offset = np.arange(n) * width
+    swaps = np.zeros(n)
+
+    for k in range(m):
+        v = sb[:, k] + 1
+
+        idx = v.copy()
+        smaller_or_equal = np.zeros(n, dtype=int)
+        for _ in range(levels):
+            smaller_or_equal += tree[offset + idx]
+            idx -= idx & -idx
+        swaps += k - smaller_or_equal
+
+        idx = v.copy()
+        for _ in range(levels + 1):
+            tree[offset + np.minimum(idx, width-1)] += 1
+            idx += idx & -idx
+
+    n0 = m * (m - 1) / 2.0
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return (n0 - ties_a - ties_b + ties_ab - 2*swaps) / np.sqrt((n0 - ties_a) * (n0 - ties_b))
+
+
+def best_shifts(A, B=None, maxshift=1):
+    """Returns shifts s (in steps, |s| <= maxshift) with the highest cross-correlation
+    between the rows of A and B (default: B = A), such that A[t] ~ B[t-s].
+    Cross-correlations are obtained from the FFTs of the standardized rows,
+    which are calculated once per pattern"""
+    same = B is None
+    m = A.shape[1]
+
+    # long enough to avoid wrap around for |s| <= maxshift
+    L = 2**int(np.ceil(np.log2(m + maxshift + 1)))
+    FA = np.fft.rfft(np.nan_to_num(_standardize(A)), L)
+    FB = FA if same else np.fft.rfft(np.nan_to_num(_standardize(B)), L)
+
+    lags = np.r_[np.arange(L-maxshift, L), np.arange(0, maxshift+1)]
+
+    shifts = np.zeros((len(A), len(FB)), dtype=int)
+    for i in range(len(A)):
+        j = i+1 if same else 0
+        if j == len(FB):
+            continue
+        cc = np.fft.irfft(FA[i] * FB[j:].conj(), L)[:, lags]
+        shifts[i, j:] = cc.argmax(axis=1) - maxshift
+        if same:
+            shifts[j:, i] = -shifts[i, j:]
+
+    return shifts
+
+
+def pearson_pvalue(r, n):
+    """Two-sided p-value for correlation coefficient r from n points (t-test, as
+    used by scipy.stats.pearsonr and spearmanr)"""
+    from scipy.stats import t as t_distribution
+
+    df = n - 2
+    with np.errstate(invalid='ignore', divide='ignore'):
+        t = r * np.sqrt(df / ((1.0 - r) * (1.0 + r)))
+    return 2 * t_distribution.sf(np.abs(t), df)
+
+
+def tie_sums(Y):
+    """Sums over the groups of equal values in every row of Y of t(t-1), t(t-1)(2t+5)
+    and t(t-1)(t-2), with t the size of the group, as array of shape (n, 3). These
+    are needed for the variance of Kendall's tau with ties, see kendall_pvalue()"""
+    n, m = Y.shape
+    first = _sorted_groups(np.sort(Y, axis=1))[0]
+    starts = np.flatnonzero(first)
+    t = np.diff(np.r_[starts, n*m]).astype(float)
+    row = starts // m
+    return np.column_stack([np.bincount(row, weights=w, minlength=n)
+                            for w in (t*(t-1), t*(t-1)*(2*t+5), t*(t-1)*(t-2))])
+
+
+def kendall_pvalue(tau, n, ties_a=None, ties_b=None):
+    """Two-sided p-value for Kendall's tau-b from n points (normal approximation, as
+    scipy.stats.kendalltau). ties_a and ties_b are the tie_sums() of the two
+    patterns, broadcast against tau; without them, no ties are assumed"""
+    from scipy.stats import norm
+
+    if ties_a is None:
+        ties_a = np.zeros(3)
+    if ties_b is None:
+        ties_b = np.zeros(3)
+    xa0, xa1, xa2 = np.moveaxis(ties_a, -1, 0)
+    xb0, xb1, xb2 = np.moveaxis(ties_b, -1, 0)
+
+    n = float(n)
+    n0 = n * (n - 1) / 2
+    s = tau * np.sqrt((n0 - xa0 / 2) * (n0 - xb0 / 2))
+    var = ((n * (n - 1) * (2*n + 5) - xa1 - xb1) / 18
+           + xa2 * xb2 / (9 * n * (n - 1) * (n - 2))
+           + xa0 * xb0 / (2 * n * (n - 1)))
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        z = s / np.sqrt(var)
+    return 2 * norm.sf(np.abs(z))
+
+
+def combined_value(spearmanr, kendallr, pearsonr):
+    """Geometric mean of the three coefficients"""
+    return (pearsonr * kendallr * spearmanr)**(1/3.0)
+
+
+def similarity(Y, reference=None, kendall_step=5, chunksize=None, maxshift=0):
+    """Calculates the agreement between the rows of Y, or between reference (1d) and
+    every row of Y. Only columns where all patterns are defined are used.
+
+    If maxshift > 0, patterns are compared at the shift (in steps) that gives the
+    best cross-correlation, see best_shifts(). The first and last maxshift points
+    are then left out of all comparisons, so that the number of points is the same
+    for every shift.
+
+    returns (combined, spearman, kendall, pearson), the p-values of the last three,
+    and the shifts, as matrices of shape (n, n), or (1, n) if a reference is given"""
+    valid = np.all(np.isfinite(Y), axis=0)
+    if reference is not None:
+        reference = np.atleast_2d(reference)
+        valid &= np.all(np.isfinite(reference), axis=0)
+
+    Y = Y[:, valid]
+    if reference is None:
+        A, B = Y, None
+    else:
+        A, B = reference[:, valid], Y
+
+    m = Y.shape[1]
+    window = slice(maxshift, m-maxshift)
+
+    if maxshift:
+        shifts = best_shifts(A, B, maxshift=maxshift)
+    else:
+        shifts = np.zeros((len(A), len(Y)), dtype=int)
+
+    Aw = A[:, window]
+    Bw = None if B is None else B[:, window]
+
+    pearsonr = pearson_matrix(Aw, Bw, chunksize=chunksize)
+    spearmanr = spearman_matrix(Aw, Bw, chunksize=chunksize)
+    kendallr = kendall_matrix(Aw[:, ::kendall_step], None if Bw is None else Bw[:, ::kendall_step],
+                              chunksize=chunksize)
+
+    n = len(range(maxshift, m-maxshift))
+    n_kendall = len(range(0, n, kendall_step))
+
+    ties_a = tie_sums(Aw[:, ::kendall_step])
+    ties_b = ties_a if Bw is None else tie_sums(Bw[:, ::kendall_step])
+    kendallp = kendall_pvalue(kendallr, n_kendall, ties_a[:, np.newaxis], ties_b[np.newaxis, :])
+
+    # compare the shifted pairs again, grouped by shift, so that every shifted
+    # pattern is standardized and ranked once
+    if B is None:
+        B = Y
+        ia, ib = np.nonzero(np.triu(shifts != 0, k=1))
+    else:
+        ia, ib = np.nonzero(shifts)
+
+    cols = np.arange(m)[window]
+    pair_shifts = shifts[ia, ib]
+
+    if len(ia):
+        ZA = _standardize(Aw)
+        ZRA = _standardize(rank_rows(Aw))
+
+    for s in np.unique(pair_shifts):
+        sel = np.flatnonzero(pair_shifts == s)
+        patterns, index = np.unique(ib[sel], return_inverse=True)
+
+        Bs = B[patterns][:, cols - s]
+        ZB = _standardize(Bs)
+        ZRB = _standardize(rank_rows(Bs))
+
+        for k in range(0, len(sel), pair_blocksize):
+            a = ia[sel[k:k+pair_blocksize]]
+            b = ib[sel[k:k+pair_blocksize]]
+            j = index[k:k+pair_blocksize]
+
+            pr = np.clip(np.einsum('ij,ij->i', ZA[a], ZB[j]), -1, 1)
+            sr = np.clip(np.einsum('ij,ij->i', ZRA[a], ZRB[j]), -1, 1)
+            kr = kendall_pairs(Aw[a, ::kendall_step], Bs[j, ::kendall_step])
+            kp = kendall_pvalue(kr, n_kendall, ties_a[a], tie_sums(Bs[j, ::kendall_step]))
+
+            for matrix, values in ((spearmanr, sr), (kendallr, kr), (kendallp, kp), (pearsonr, pr)):
+                matrix[a, b] = values
+                if reference is None:
+                    matrix[b, a] = values
+
+    with np.errstate(invalid='ignore'):
+        combined = combined_value(spearmanr, kendallr, pearsonr)
+
+    coefficients = (combined, spearmanr, kendallr, pearsonr)
+    pvalues = (pearson_pvalue(spearmanr, n),
+               kendallp,
+               pearson_pvalue(pearsonr, n))
+
+    return coefficients, pvalues, shifts
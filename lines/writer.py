@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+
+#    Lines - a python plotting program
+#    Copyright (C) 2015 Stef Smeets
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License along
+#    with this program; if not, write to the Free Software Foundation, Inc.,
+#    51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""Writing of column data (patterns, background points) to text files.
+
+Rows are not formatted one at a time: a block of rows is formatted with a
+single % operation on a repeated row format, and written with one call to
+write. The output format follows the extension of the file name: .npy is
+written with np.save, .gz and .bz2 are compressed text, anything else is
+plain text."""
+
+import os
+import gzip
+import bz2
+
+import numpy as np
+
+# rows per formatting operation, limits the size of the temporary strings
+blocksize = 2**16
+
+
+def open_output(fn):
+    """Opens fn for writing, compressed if the extension is .gz or .bz2"""
+    ext = os.path.splitext(fn)[1].lower()
+    if ext == '.gz':
+        return gzip.open(fn, 'wb')
+    elif ext == '.bz2':
+        return bz2.BZ2File(fn, 'wb')
+    else:
+        return open(fn, 'w', 2**20)
+
+
+def format_block(arr, fmt):
+    """Formats all rows of arr (n*m) with row format fmt (m fields, no newline)"""
+    if not len(arr):
+        return ''
+    return ((fmt + '\n') * len(arr)) % tuple(arr.ravel().tolist())
+
+
+def format_columns(arr, fmts, prefix='', nan='skip'):
+    """Yields blocks of text with the rows of arr, column i formatted with fmts[i].
+
+    nan='skip': rows with a NaN in any column are left out
+    nan='blank': NaN fields are left empty (i.e. optional esds)
+    nan=None: NaN is written as is"""
+    arr = np.asarray(arr, dtype=float)
+    isnan = np.isnan(arr)
+
+    if nan != 'blank':
+        if nan == 'skip':
+            arr = arr[~isnan.any(axis=1)]
+        fmt = prefix + ''.join(fmts)
+        for i in range(0, len(arr), blocksize):
+            yield format_block(arr[i:i+blocksize], fmt)
+        return
+
+    for i in range(0, len(arr), blocksize):
+        block = arr[i:i+blocksize]
+        blockmask = isnan[i:i+blocksize]
+
+        if not blockmask.any():
+            yield format_block(block, prefix + ''.join(fmts))
+            continue
+
+        # rows are grouped by which fields are missing, and put back in order
+        rows = np.empty(len(block), dtype=object)
+        patterns, inverse = np.unique(blockmask, axis=0, return_inverse=True)
+        for j, pattern in enumerate(patterns):
+            sel = inverse == j
+            fmt = prefix + ''.join(f for f, missing in zip(fmts, pattern) if not missing)
+            text = format_block(block[sel][:, ~pattern], fmt)
+            rows[sel] = text.splitlines()
+
+        yield '\n'.join(rows) + '\n'
+
+
+def write_columns(fn, columns, fmts, prefix='', pre=(), post=(), nan='skip'):
+    """Writes columns (sequence of equally long 1d arrays) to fn, see format_columns.
+    pre and post are lines (with newline) written before and after the data.
+
+    If fn ends with .npy, the columns are saved with np.save (pre/post are ignored)"""
+    arr = np.column_stack(columns)
+
+    if fn.lower().endswith('.npy'):
+        if nan == 'skip':
+            arr = arr[~np.isnan(arr).any(axis=1)]
+        np.save(fn, arr)
+        return
+
+    f = open_output(fn)
+    try:
+        f.write(''.join(pre))
+        for text in format_columns(arr, fmts, prefix=prefix, nan=nan):
+            f.write(text)
+        f.write(''.join(post))
+    finally:
+        f.close()
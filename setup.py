@@ -25,13 +25,15 @@ setup(
 
     package_data={
         "": ["LICENCE",  "readme.md", "setup.py"],
-        "zeolite_database": ["*.cif"],
+        "zeolite_database": ["*.cif", "library.bin"],
     },
 
     entry_points={
         'console_scripts': [
             'lines = lines.lines:main',
+            'lines_batch = lines.batch:main',
             'cif2xy = lines.cif2xy:main',
+            'lines_library = lines.library:main',
         ]
     }
 